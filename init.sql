@@ -1,14 +1,37 @@
+-- Lessons are partitioned by month on their datetime, the partitions themselves are created and
+-- archived by the maintenance routine in usc_sign_in_bot/maintenance.py
 CREATE TABLE IF NOT EXISTS lessons (
-    lesson_id TEXT PRIMARY KEY,
+    lesson_id TEXT NOT NULL,
     user_id TEXT,
-    datetime TIMESTAMP,  -- Use TIMESTAMP for date-time values
+    datetime TIMESTAMP NOT NULL,  -- Use TIMESTAMP for date-time values
     sport TEXT NOT NULL,
     trainer TEXT,
     message_sent BOOLEAN,
     response TEXT,
+    message_id BIGINT,  -- The message the lesson was sent in, to edit it when the lesson changes
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (lesson_id, datetime),
     UNIQUE (sport, datetime, user_id)
+) PARTITION BY RANGE (datetime);
+
+-- Databases created before the messages were edited when their lesson changes
+ALTER TABLE lessons ADD COLUMN IF NOT EXISTS message_id BIGINT;
+ALTER TABLE lessons ADD COLUMN IF NOT EXISTS cancelled BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- The key of every lesson with the datetime of the lesson. The lessons are partitioned, so their
+-- key can't be unique in the lessons table itself. A lesson keeps its key when it moves, so a new
+-- lesson at the time it moved from would get the same key, which this table refuses
+CREATE TABLE IF NOT EXISTS lesson_keys (
+    lesson_id TEXT PRIMARY KEY,
+    datetime TIMESTAMP NOT NULL
 );
 
+-- Databases created before the keys were kept apart get the keys of their lessons once
+INSERT INTO lesson_keys (lesson_id, datetime)
+SELECT lesson_id, datetime FROM lessons
+WHERE NOT EXISTS (SELECT 1 FROM lesson_keys)
+ON CONFLICT DO NOTHING;
+
 CREATE TABLE IF NOT EXISTS users (
     user_id TEXT PRIMARY KEY,
     sign_up_date TIMESTAMP NOT NULL DEFAULT NOW(),  -- Use NOW() for current timestamp
@@ -16,5 +39,104 @@ CREATE TABLE IF NOT EXISTS users (
     sport TEXT,
     username TEXT,
     password TEXT, -- Note to user: Hash your passwords before saving please
-    telegram_id BIGINT
+    telegram_id BIGINT,
+    active BOOLEAN NOT NULL DEFAULT TRUE  -- False once the user blocked the bot
+);
+
+-- Databases created before users could be deactivated
+ALTER TABLE users ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT TRUE;
+
+-- The job only reads the active users of a sport
+CREATE INDEX IF NOT EXISTS users_active_sport ON users (sport) WHERE active;
+
+-- A user has a single row. Users with a legacy key who signed up again before the telegram_id was
+-- unique got a second row with a compact key, which replaces the legacy row. Their lessons and
+-- preferences are moved over to the compact key when the keys are compacted
+DELETE FROM users WHERE length(user_id) = 60 AND telegram_id IN (
+    SELECT telegram_id FROM users WHERE length(user_id) <> 60
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id ON users (telegram_id);
+
+-- Messages written by the job, which are sent by the long-running bot or a dispatcher. A message is
+-- pending until it is claimed, in_flight while it is being sent, and sent or failed after. Messages
+-- that could not be sent are pending again from next_attempt_at. Dispatchers are woken up through a
+-- NOTIFY on the usc_outbox channel. A digest asks about several lessons, the lesson_id holds all
+-- their ids separated by spaces
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    lesson_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending'
+        CHECK (state IN ('pending', 'in_flight', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    claimed_at TIMESTAMP,
+    last_error TEXT,
+    message_id BIGINT,
+    reply_markup TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+-- Only the messages that still have to be sent are looked at by the dispatchers
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at)
+    WHERE state IN ('pending', 'in_flight');
+
+-- Databases created before the messages were edited. Messages with a message_id from the start are
+-- edits of a message that was sent before, with the buttons it keeps as JSON
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS reply_markup TEXT;
+
+-- The messages are looked up by their chat and Telegram id to edit them
+CREATE INDEX IF NOT EXISTS outbox_message ON outbox (telegram_id, message_id)
+    WHERE message_id IS NOT NULL;
+
+-- Lessons created before the compact keys, by their old key. Messages sent before the keys were
+-- compacted still have the old key in their buttons, the aliases are removed by the maintenance
+-- routine once those messages are too old to answer
+CREATE TABLE IF NOT EXISTS lesson_key_aliases (
+    legacy_key TEXT PRIMARY KEY,
+    lesson_id TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Lessons announced once in a group chat or channel per sport, instead of to every user. The
+-- lessons of the users are added when they answer the announcement
+CREATE TABLE IF NOT EXISTS broadcasts (
+    broadcast_id TEXT PRIMARY KEY,
+    sport TEXT NOT NULL,
+    datetime TIMESTAMP NOT NULL,
+    trainer TEXT,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT,
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    UNIQUE (sport, datetime)
+);
+
+-- The lessons of the last scrape per sport, to find the lessons that changed since
+CREATE TABLE IF NOT EXISTS schedule (
+    sport TEXT NOT NULL,
+    datetime TIMESTAMP NOT NULL,
+    trainer TEXT,
+    scraped_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (sport, datetime)
+);
+
+-- The preferences of the users, which lessons they want to be asked about. A user is asked about a
+-- lesson if it matches one of their preferences of every kind they have
+CREATE TABLE IF NOT EXISTS preferences (
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('day', 'time', 'trainer')),
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, value)
+);
+
+-- The state of the sign up conversations, such that a restarted bot continues where users were
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,  -- The chat and user id of the conversation as a JSON list
+    state TEXT NOT NULL,  -- The state of the conversation as JSON
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (name, key)
 );
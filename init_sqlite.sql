@@ -0,0 +1,107 @@
+-- The schema of init.sql for the embedded SQLite backend. Lessons are kept in a single table, as
+-- SQLite has no partitions
+CREATE TABLE IF NOT EXISTS lessons (
+    lesson_id TEXT NOT NULL,
+    user_id TEXT,
+    datetime TIMESTAMP NOT NULL,
+    sport TEXT NOT NULL,
+    trainer TEXT,
+    message_sent BOOLEAN,
+    response TEXT,
+    message_id BIGINT,
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (lesson_id, datetime),
+    UNIQUE (sport, datetime, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS lesson_keys (
+    lesson_id TEXT PRIMARY KEY,
+    datetime TIMESTAMP NOT NULL
+);
+
+INSERT INTO lesson_keys (lesson_id, datetime)
+SELECT lesson_id, datetime FROM lessons
+WHERE NOT EXISTS (SELECT 1 FROM lesson_keys)
+ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    sign_up_date TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    login_method TEXT NOT NULL,
+    sport TEXT,
+    username TEXT,
+    password TEXT,
+    telegram_id BIGINT,
+    active BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE INDEX IF NOT EXISTS users_active_sport ON users (sport) WHERE active;
+
+DELETE FROM users WHERE length(user_id) = 60 AND telegram_id IN (
+    SELECT telegram_id FROM users WHERE length(user_id) <> 60
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id ON users (telegram_id);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id INTEGER PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    lesson_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending'
+        CHECK (state IN ('pending', 'in_flight', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    claimed_at TIMESTAMP,
+    last_error TEXT,
+    message_id BIGINT,
+    reply_markup TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at)
+    WHERE state IN ('pending', 'in_flight');
+
+CREATE INDEX IF NOT EXISTS outbox_message ON outbox (telegram_id, message_id)
+    WHERE message_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS lesson_key_aliases (
+    legacy_key TEXT PRIMARY KEY,
+    lesson_id TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+    broadcast_id TEXT PRIMARY KEY,
+    sport TEXT NOT NULL,
+    datetime TIMESTAMP NOT NULL,
+    trainer TEXT,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT,
+    cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    UNIQUE (sport, datetime)
+);
+
+CREATE TABLE IF NOT EXISTS schedule (
+    sport TEXT NOT NULL,
+    datetime TIMESTAMP NOT NULL,
+    trainer TEXT,
+    scraped_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (sport, datetime)
+);
+
+CREATE TABLE IF NOT EXISTS preferences (
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('day', 'time', 'trainer')),
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, value)
+);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    PRIMARY KEY (name, key)
+);
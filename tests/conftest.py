@@ -0,0 +1,15 @@
+"""Fixtures shared by the test modules"""
+
+import pytest
+
+from usc_sign_in_bot.backends import SqliteBackend
+from usc_sign_in_bot.db_helpers import UscDataBase
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Fixture for a database stored in a temporary SQLite file"""
+    monkeypatch.setenv("ENCRYPT_KEY", "test_key")
+
+    with UscDataBase(backend=SqliteBackend(str(tmp_path / "usc.db"))) as database:
+        yield database
@@ -0,0 +1,167 @@
+"""
+A local fake of the Telegram Bot API, to run the bot against without Telegram.
+
+The fake answers the methods the bot uses, hands out the updates that are pushed to it through
+`getUpdates` or by calling the webhook that was set, and records the messages the bot sends. This
+makes it possible to benchmark receiving updates by polling against a webhook offline.
+"""
+
+import asyncio
+import json
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Fake",
+    "username": "fake_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+# pylint: disable=too-many-instance-attributes
+class FakeBotApi:
+    """
+    Serve a fake Bot API on a free local port, for as long as it is started.
+
+    Point the bot to it with `base_url`, e.g. `Application.builder().base_url(fake.base_url)`.
+
+    Attributes
+    ----------
+    sent : asyncio.Queue
+        The messages the bot sent, with the time they were received by the fake.
+    webhook : dict or None
+        The URL, secret and allowed updates of the webhook the bot set, if any.
+    """
+
+    def __init__(self):
+        self.sent = asyncio.Queue()
+        self.webhook = None
+
+        self._updates = []
+        self._new_update = asyncio.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._server = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        """The URL to use as base URL of the bot, the token is added to it"""
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self) -> None:
+        """Start serving the fake Bot API"""
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+
+        app = Application([(r"/bot[^/]+/(\w+)", _MethodHandler, {"api": self})])
+        self._server = HTTPServer(app)
+        self._server.add_sockets(sockets)
+
+    async def stop(self) -> None:
+        """Stop serving the fake Bot API"""
+        self._server.stop()
+        await self._server.close_all_connections()
+
+    async def push_update(self, update: dict) -> None:
+        """Hand an update to the bot, through its webhook if it set one"""
+        update = {"update_id": self._next_update_id, **update}
+        self._next_update_id += 1
+
+        if self.webhook is None:
+            async with self._new_update:
+                self._updates.append(update)
+                self._new_update.notify_all()
+            return
+
+        headers = {"Content-Type": "application/json"}
+        if self.webhook["secret_token"]:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook["secret_token"]
+
+        await AsyncHTTPClient().fetch(
+            HTTPRequest(
+                self.webhook["url"],
+                method="POST",
+                headers=headers,
+                body=json.dumps(update),
+            )
+        )
+
+    async def call(self, method: str, params: dict) -> object:
+        """Answer a call of a method of the Bot API"""
+        if method == "getMe":
+            return BOT_USER
+
+        if method == "getUpdates":
+            return await self._get_updates(
+                int(params.get("offset", 0)), float(params.get("timeout", 0))
+            )
+
+        if method == "setWebhook":
+            self.webhook = {
+                "url": params["url"],
+                "secret_token": params.get("secret_token"),
+                "allowed_updates": json.loads(params.get("allowed_updates", "null")),
+            }
+            return True
+
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+
+        if method == "sendMessage":
+            message = {
+                "message_id": self._next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params["text"],
+            }
+            self._next_message_id += 1
+            await self.sent.put((time.perf_counter(), message))
+            return message
+
+        # The other methods, like answering a callback query, only have to succeed
+        return True
+
+    async def _get_updates(self, offset: int, timeout: float) -> list[dict]:
+        """Return the updates from the offset, waiting up to the timeout for one to arrive"""
+        async with self._new_update:
+            # The offset confirms all the updates before it, so they are not handed out again
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+
+            if not self._updates:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            return list(self._updates)
+
+
+# pylint: disable=abstract-method
+class _MethodHandler(RequestHandler):
+    """Pass the calls of the Bot API methods on to the fake"""
+
+    def initialize(self, api: FakeBotApi) -> None:
+        # pylint: disable=attribute-defined-outside-init
+        self.api = api
+
+    async def post(self, method: str) -> None:
+        """Answer the method with the parameters from the form, as the bot sends them"""
+        params = {
+            name: values[0].decode()
+            for name, values in self.request.body_arguments.items()
+        }
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+
+        result = await self.api.call(method, params)
+        self.write({"ok": True, "result": result})
@@ -0,0 +1,353 @@
+"""Test module to run the database against the embedded SQLite backend in the src file"""
+
+# pylint: disable=redefined-outer-name
+import hashlib
+from datetime import datetime, timedelta
+
+import pytest
+
+from usc_sign_in_bot.backends import get_backend
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.encryptor import Encryptor
+
+LESSON_TIME = datetime(2024, 12, 3, 18, 30)
+
+
+@pytest.fixture
+def user_id(sqlite_db):
+    """Fixture for a signed up user, returning the user_id"""
+    user_id = sqlite_db.insert_user(1234, datetime(2024, 11, 1), "uva")
+    sqlite_db.update_fields(
+        "users",
+        user_id,
+        sport="Schermen",
+        username="user@uva.nl",
+        password=Encryptor("test_key").encrypt_data("secret"),
+    )
+    return user_id
+
+
+def test_get_backend():
+    """Test if the backend is chosen by its name"""
+    assert get_backend("sqlite").name == "sqlite"
+    assert get_backend("postgres").name == "postgres"
+
+    with pytest.raises(ValueError):
+        get_backend("mysql")
+
+
+def test_wal_mode(sqlite_db):
+    """Test if the database is opened in WAL mode"""
+    sqlite_db.cursor.execute("PRAGMA journal_mode;")
+    assert sqlite_db.cursor.fetchone() == ("wal",)
+
+
+def test_insert_user_twice(sqlite_db, user_id):
+    """Test if inserting a user again keeps the existing user"""
+    assert sqlite_db.insert_user(1234, datetime(2024, 11, 2), "uva") == user_id
+
+    user = sqlite_db.get_user(1234, query_key="telegram_id")
+    assert user.sign_up_date == datetime(2024, 11, 1)
+    assert user.password == "secret"
+
+
+def test_job_path(sqlite_db, user_id):
+    """Test if lessons are added for the users, and their messages sent from the outbox"""
+    users = list(sqlite_db.iter_users_in_sport("Schermen"))
+    assert [user.user_id for user in users] == [user_id]
+
+    with sqlite_db.transaction():
+        key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+        sqlite_db.add_to_outbox(1234, key, "Would you like to go?")
+
+    assert sqlite_db.has_received_update("Schermen", LESSON_TIME, user_id)
+
+    (message,) = sqlite_db.claim_outbox(10)
+    assert (message.telegram_id, message.lesson_id, message.attempts) == (1234, key, 1)
+    assert not sqlite_db.claim_outbox(10)
+
+    sqlite_db.mark_outbox_sent(message.outbox_id, message_id=99)
+    assert sqlite_db.get_lesson_data_by_key(key).message_sent is True
+
+
+def test_digest_sent(sqlite_db, user_id):
+    """Test if all the lessons of a digest are marked as sent with it"""
+    with sqlite_db.transaction():
+        keys = [
+            sqlite_db.add_to_data(
+                "Schermen", LESSON_TIME + timedelta(days=day), user_id, False
+            )
+            for day in range(2)
+        ]
+        sqlite_db.add_to_outbox(1234, " ".join(keys), "Which would you like to go to?")
+
+    (message,) = sqlite_db.claim_outbox(10)
+    assert message.lesson_ids == keys
+
+    sqlite_db.mark_outbox_sent(message.outbox_id, message_id=99)
+    assert all(sqlite_db.get_lesson_data_by_key(key).message_sent for key in keys)
+
+
+def test_broadcast(sqlite_db, user_id):
+    """Test if the lesson of a user is added when they answer a broadcast"""
+    with sqlite_db.transaction():
+        broadcast = sqlite_db.add_broadcast("Schermen", LESSON_TIME, -100, "John")
+        sqlite_db.add_to_outbox(-100, broadcast, "Would you like to go?")
+
+    assert sqlite_db.has_broadcast("Schermen", LESSON_TIME)
+    assert not sqlite_db.has_received_update("Schermen", LESSON_TIME, user_id)
+    assert sqlite_db.join_broadcast(broadcast, 4321) is None
+
+    # The lesson gets the key the job would have given it, also when tapped again
+    key = sqlite_db.join_broadcast(broadcast, 1234)
+    assert key == sqlite_db.encrypt.generate_hash_key(
+        f"Schermen{LESSON_TIME.isoformat()}{user_id}"
+    )
+    assert sqlite_db.join_broadcast(broadcast, 1234) == key
+
+    assert sqlite_db.get_lesson_data_by_key(key).trainer == "John"
+    assert sqlite_db.claim_lesson_response(key, "Y", 1234).password == "secret"
+    assert sqlite_db.claim_lesson_response(key, "Y", 1234) is None
+
+
+@pytest.mark.usefixtures("user_id")
+def test_broadcast_cancelled(sqlite_db):
+    """Test if the lesson of a cancelled broadcast can't be booked"""
+    broadcast = sqlite_db.add_broadcast("Schermen", LESSON_TIME, -100, "John")
+    sqlite_db.change_lesson("Schermen", LESSON_TIME)
+
+    key = sqlite_db.join_broadcast(broadcast, 1234)
+    assert sqlite_db.claim_lesson_response(key, "Y", 1234) is None
+    assert sqlite_db.is_lesson_cancelled(key)
+
+
+def test_lesson_at_time_moved_from(sqlite_db, user_id):
+    """Test if a new lesson at the time a lesson moved from gets a key of its own"""
+    later = LESSON_TIME + timedelta(hours=1)
+    moved = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+    broadcast = sqlite_db.add_broadcast("Schermen", LESSON_TIME, -100)
+    sqlite_db.change_lesson("Schermen", LESSON_TIME, later, "John")
+
+    key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+    assert key != moved
+    assert sqlite_db.get_lesson_data_by_key(moved).trainer == "John"
+    assert sqlite_db.get_lesson_data_by_key(key).trainer is None
+    assert sqlite_db.add_broadcast("Schermen", LESSON_TIME, -100) != broadcast
+
+    # The key of the moved lesson is kept at its new time
+    sqlite_db.cursor.execute(
+        "SELECT lesson_id, datetime FROM lesson_keys ORDER BY datetime;"
+    )
+    assert sqlite_db.cursor.fetchall() == [(key, LESSON_TIME), (moved, later)]
+
+
+def test_lesson_keys_of_older_database(sqlite_db, user_id):
+    """Test if the keys of the lessons in a database from before the lesson keys are added"""
+    sqlite_db.cursor.execute(
+        """
+        INSERT INTO lessons (lesson_id, user_id, datetime, sport, message_sent)
+        VALUES ('older_key', %s, %s, 'Schermen', TRUE);
+    """,
+        (user_id, LESSON_TIME),
+    )
+    sqlite_db.conn.commit()
+
+    with UscDataBase(backend=sqlite_db.backend):
+        pass
+
+    sqlite_db.cursor.execute("SELECT lesson_id, datetime FROM lesson_keys;")
+    assert sqlite_db.cursor.fetchall() == [("older_key", LESSON_TIME)]
+
+
+def test_outbox_retry(sqlite_db, user_id):
+    """Test if a failed message is only claimed again once it is due"""
+    key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+    sqlite_db.add_to_outbox(1234, key, "Would you like to go?")
+    now = datetime.now()
+
+    (message,) = sqlite_db.claim_outbox(10, now=now)
+    sqlite_db.mark_outbox_failed(
+        message.outbox_id, "Timed out", retry_at=now + timedelta(minutes=1)
+    )
+
+    assert not sqlite_db.claim_outbox(10, now=now)
+    (message,) = sqlite_db.claim_outbox(10, now=now + timedelta(minutes=2))
+    assert message.attempts == 2
+
+
+def test_callback_path(sqlite_db, user_id):
+    """Test if a response can only be claimed once, by the user the lesson was sent to"""
+    key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, True)
+
+    assert sqlite_db.claim_lesson_response(key, "Y", 4321) is None
+
+    notification = sqlite_db.claim_lesson_response(key, "Y", 1234)
+    assert notification.datetime == LESSON_TIME
+    assert notification.username == "user@uva.nl"
+    assert notification.password == "secret"
+
+    assert sqlite_db.claim_lesson_response(key, "N", 1234) is None
+    assert sqlite_db.get_lesson_data_by_key(key).response == "Y"
+
+
+def test_deactivate_user(sqlite_db, user_id):
+    """Test if an inactive user is skipped, and their pending messages are failed"""
+    key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+    sqlite_db.add_to_outbox(1234, key, "Would you like to go?")
+
+    sqlite_db.deactivate_user(1234, "Forbidden")
+
+    assert not sqlite_db.get_all_users_in_sport("Schermen")
+    assert not sqlite_db.claim_outbox(10)
+
+
+def test_transaction_rollback(sqlite_db, user_id):
+    """Test if a failing transaction leaves nothing behind"""
+    with pytest.raises(RuntimeError):
+        with sqlite_db.transaction():
+            sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, False)
+            raise RuntimeError
+
+    assert not sqlite_db.has_received_update("Schermen", LESSON_TIME, user_id)
+
+
+def test_compact_keys(sqlite_db):
+    """Test if legacy keys are compacted, and the legacy lesson key still resolves"""
+    legacy_user = hashlib.sha256(b"1234").hexdigest()[:60]
+    legacy_lessons = [
+        hashlib.sha256(b"lesson").hexdigest()[:60],
+        hashlib.sha256(b"digest").hexdigest()[:60],
+    ]
+    legacy_lesson = legacy_lessons[0]
+    sqlite_db.cursor.execute(
+        "INSERT INTO users (user_id, login_method, telegram_id) VALUES (%s, 'uva', 1234);",
+        (legacy_user,),
+    )
+    for days, lesson in enumerate(legacy_lessons):
+        sqlite_db.cursor.execute(
+            """
+            INSERT INTO lessons (lesson_id, user_id, datetime, sport, message_sent)
+            VALUES (%s, %s, %s, 'Schermen', TRUE);
+        """,
+            (lesson, legacy_user, LESSON_TIME + timedelta(days=days)),
+        )
+        sqlite_db.cursor.execute(
+            "INSERT INTO lesson_keys (lesson_id, datetime) VALUES (%s, %s);",
+            (lesson, LESSON_TIME + timedelta(days=days)),
+        )
+    sqlite_db.add_to_outbox(1234, legacy_lesson, "Would you like to go?")
+    sqlite_db.add_to_outbox(1234, " ".join(legacy_lessons), "Digest")
+    sqlite_db.update_fields("users", legacy_user, sport="Schermen")
+    sqlite_db.add_preference(1234, "trainer", "John")
+
+    assert sqlite_db.compact_keys(batch_size=1) == 3
+    assert sqlite_db.compact_keys() == 0
+
+    user_id = Encryptor.generate_hash_key("1234")
+    assert sqlite_db.insert_user(1234, datetime(2024, 11, 2), "uva") == user_id
+    assert sqlite_db.has_received_update("Schermen", LESSON_TIME, user_id)
+    assert sqlite_db.get_preferences("Schermen") == [(user_id, "trainer", "John")]
+
+    key = sqlite_db.resolve_lesson_key(legacy_lesson)
+    assert key == Encryptor.compact_legacy_key(legacy_lesson)
+    assert sqlite_db.get_lesson_data_by_key(key).user_id == user_id
+    assert [message.lesson_id for message in sqlite_db.claim_outbox(10)] == [
+        key,
+        " ".join(Encryptor.compact_legacy_key(lesson) for lesson in legacy_lessons),
+    ]
+
+    assert sqlite_db.purge_lesson_key_aliases(datetime.now() + timedelta(days=1)) == 2
+    assert sqlite_db.resolve_lesson_key(legacy_lesson) == legacy_lesson
+
+
+def test_legacy_user_signs_up_again(sqlite_db):
+    """Test if a user with a legacy key keeps that key when signing up again"""
+    legacy_user = hashlib.sha256(b"1234").hexdigest()[:60]
+    sqlite_db.cursor.execute(
+        "INSERT INTO users (user_id, login_method, telegram_id) VALUES (%s, 'uva', 1234);",
+        (legacy_user,),
+    )
+    sqlite_db.conn.commit()
+
+    assert sqlite_db.insert_user(1234, datetime(2024, 11, 2), "uva") == legacy_user
+    sqlite_db.cursor.execute("SELECT user_id FROM users;")
+    assert sqlite_db.cursor.fetchall() == [(legacy_user,)]
+
+    assert sqlite_db.compact_keys() == 1
+    assert sqlite_db.insert_user(1234, datetime(2024, 11, 3), "uva") == (
+        Encryptor.generate_hash_key("1234")
+    )
+
+
+def test_compact_keys_merges_user_signed_up_twice(sqlite_db):
+    """Test if a user with rows under the legacy and the compact key ends up with a single user"""
+    legacy_user = hashlib.sha256(b"1234").hexdigest()[:60]
+    legacy_lesson = hashlib.sha256(b"lesson").hexdigest()[:60]
+
+    # Databases from before the telegram_id was unique can have both rows
+    sqlite_db.cursor.execute("DROP INDEX users_telegram_id;")
+    sqlite_db.cursor.execute(
+        "INSERT INTO users (user_id, login_method, telegram_id) VALUES (%s, 'uva', 1234);",
+        (legacy_user,),
+    )
+    user_id = sqlite_db.insert_user(1234, datetime(2024, 11, 2), "uva")
+    sqlite_db.cursor.execute(
+        """
+        INSERT INTO lessons (lesson_id, user_id, datetime, sport, message_sent)
+        VALUES (%s, %s, %s, 'Schermen', TRUE);
+    """,
+        (legacy_lesson, legacy_user, LESSON_TIME),
+    )
+    sqlite_db.cursor.execute(
+        "INSERT INTO lesson_keys (lesson_id, datetime) VALUES (%s, %s);",
+        (legacy_lesson, LESSON_TIME),
+    )
+    key = sqlite_db.add_to_data("Schermen", LESSON_TIME, user_id, True)
+    sqlite_db.cursor.execute(
+        "INSERT INTO preferences (user_id, kind, value) VALUES (%s, 'day', '1'), (%s, 'day', '1');",
+        (legacy_user, user_id),
+    )
+    sqlite_db.conn.commit()
+
+    with UscDataBase(backend=sqlite_db.backend) as database:
+        database.compact_keys()
+
+        database.cursor.execute("SELECT user_id FROM users;")
+        assert database.cursor.fetchall() == [(user_id,)]
+        database.cursor.execute("SELECT lesson_id, user_id FROM lessons;")
+        assert database.cursor.fetchall() == [(key, user_id)]
+        database.cursor.execute("SELECT lesson_id FROM lesson_keys;")
+        assert database.cursor.fetchall() == [(key,)]
+        assert database.get_user_preferences(1234) == [("day", "1")]
+
+
+def test_preferences(sqlite_db, user_id):
+    """Test if the preferences of the active users of a sport are added, listed and removed"""
+    assert sqlite_db.add_preference(1234, "day", "0")
+    assert sqlite_db.add_preference(1234, "day", "0")
+    assert sqlite_db.add_preference(1234, "trainer", "John")
+    assert not sqlite_db.add_preference(4321, "day", "1")
+
+    assert sqlite_db.get_preferences("Schermen") == [
+        (user_id, "day", "0"),
+        (user_id, "trainer", "John"),
+    ]
+    assert not sqlite_db.get_preferences("Roeien")
+    assert sqlite_db.get_user_preferences(1234) == [("day", "0"), ("trainer", "John")]
+
+    assert sqlite_db.remove_preferences(1234, "day", "1") == 0
+    assert sqlite_db.remove_preferences(1234, "day") == 1
+    assert sqlite_db.remove_preferences(1234) == 1
+    assert not sqlite_db.get_user_preferences(1234)
+
+
+def test_get_schedule_sports(sqlite_db):
+    """Test if the sports of the last scrape are listed once each"""
+    lessons = [
+        {"time": LESSON_TIME, "trainer": "John"},
+        {"time": LESSON_TIME + timedelta(days=1), "trainer": "Jane"},
+    ]
+    sqlite_db.save_schedule("Schermen", lessons)
+    sqlite_db.save_schedule("Roeien", lessons[:1])
+
+    assert sqlite_db.get_schedule_sports() == ["Roeien", "Schermen"]
@@ -0,0 +1,291 @@
+"""
+Benchmark the latency per operation of the job and the callback path on the storage backends, and
+of encrypting and decrypting the passwords, and of receiving updates by polling and by webhook
+against a local fake Bot API.
+
+The SQLite backend is always benchmarked. To compare it with Postgres, point the POSTGRES_*
+variables to a database that may be written to and set BENCHMARK_POSTGRES=1. The results are
+printed, so run with `python -m pytest tests/test_benchmarks.py -s` to see them.
+"""
+
+# pylint: disable=redefined-outer-name
+import asyncio
+import os
+import socket
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from telegram.ext import Application, CommandHandler
+
+from usc_sign_in_bot.backends import PostgresBackend, SqliteBackend
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.encryptor import Encryptor
+from usc_sign_in_bot.maintenance import ensure_lesson_partitions
+from usc_sign_in_bot.telegram_bot import ALLOWED_UPDATES, TelegramBot
+
+from .fake_bot_api import FakeBotApi
+
+# The number of times every operation is measured
+ROUNDS = int(os.environ.get("BENCHMARK_ROUNDS", 50))
+
+# The sport the benchmark data is stored under, such that it can be removed afterwards
+SPORT = "Benchmark"
+
+TELEGRAM_ID = 987654321
+
+BACKENDS = [
+    pytest.param(SqliteBackend, id="sqlite"),
+    pytest.param(
+        PostgresBackend,
+        id="postgres",
+        marks=pytest.mark.skipif(
+            not os.environ.get("BENCHMARK_POSTGRES"),
+            reason="Set BENCHMARK_POSTGRES=1 to benchmark against a Postgres database",
+        ),
+    ),
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def database(request, tmp_path, monkeypatch):
+    """Fixture for a database on each backend, with a signed up user"""
+    monkeypatch.setenv("ENCRYPT_KEY", "benchmark_key")
+
+    if request.param is SqliteBackend:
+        backend = SqliteBackend(str(tmp_path / "benchmark.db"))
+    else:
+        backend = PostgresBackend()
+
+    with UscDataBase(backend=backend) as database:
+        ensure_lesson_partitions(database)
+
+        user_id = database.insert_user(TELEGRAM_ID, datetime.now(), "uva")
+        database.update_fields(
+            "users",
+            user_id,
+            sport=SPORT,
+            password=Encryptor("benchmark_key").encrypt_data("secret"),
+        )
+
+        yield database
+
+        # Remove the benchmark data again, for when this ran against a real database
+        database.cursor.execute(
+            "DELETE FROM outbox WHERE telegram_id = %s;", (TELEGRAM_ID,)
+        )
+        database.cursor.execute(
+            "DELETE FROM lesson_keys WHERE lesson_id IN "
+            + "(SELECT lesson_id FROM lessons WHERE sport = %s);",
+            (SPORT,),
+        )
+        database.cursor.execute("DELETE FROM lessons WHERE sport = %s;", (SPORT,))
+        database.cursor.execute("DELETE FROM schedule WHERE sport = %s;", (SPORT,))
+        database.cursor.execute("DELETE FROM users WHERE user_id = %s;", (user_id,))
+        database.conn.commit()
+
+
+def measure(name: str, backend: str, operation) -> dict[str, float]:
+    """Measure the latency of an operation that is called with the round, and print it"""
+    latencies = []
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        operation(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return report(name, backend, latencies)
+
+
+def report(name: str, backend: str, latencies: list[float]) -> dict[str, float]:
+    """Print the mean and 95th percentile of the latencies in milliseconds, and return them"""
+    result = {
+        "mean_ms": statistics.mean(latencies),
+        "p95_ms": statistics.quantiles(latencies, n=20)[-1],
+    }
+    print(
+        f"{backend:>8} {name:<24} mean {result['mean_ms']:7.3f} ms  "
+        + f"p95 {result['p95_ms']:7.3f} ms"
+    )
+    return result
+
+
+def lesson_time(i: int) -> datetime:
+    """Return a unique time for the lesson of a round, within the coming partitions"""
+    return datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(
+        hours=i + 1
+    )
+
+
+def test_job_path(database):
+    """Benchmark checking, adding and sending a lesson, as the job and dispatcher do"""
+    backend = database.backend.name
+    user_id = database.get_user(TELEGRAM_ID, query_key="telegram_id").user_id
+
+    def add_lesson(i):
+        with database.transaction():
+            key = database.add_to_data(SPORT, lesson_time(i), user_id, False)
+            database.add_to_outbox(TELEGRAM_ID, key, "Would you like to go?")
+
+    def send_message(_):
+        (message,) = database.claim_outbox(1)
+        database.mark_outbox_sent(message.outbox_id, message_id=1)
+
+    measure(
+        "has_received_update",
+        backend,
+        lambda i: database.has_received_update(SPORT, lesson_time(i), user_id),
+    )
+    measure("add lesson and message", backend, add_lesson)
+    measure("claim and mark sent", backend, send_message)
+    measure(
+        "iter_users_in_sport",
+        backend,
+        lambda _: list(database.iter_users_in_sport(SPORT)),
+    )
+
+
+def test_callback_path(database):
+    """Benchmark claiming a response and reading the user with it, as the bot does on a press"""
+    backend = database.backend.name
+    user_id = database.get_user(TELEGRAM_ID, query_key="telegram_id").user_id
+
+    keys = [
+        database.add_to_data(SPORT, lesson_time(i), user_id, True)
+        for i in range(ROUNDS)
+    ]
+
+    measure(
+        "claim_lesson_response",
+        backend,
+        lambda i: database.claim_lesson_response(keys[i], "N", TELEGRAM_ID),
+    )
+
+
+def per_call_encrypt(key: str, text: str) -> str:
+    """Encrypt as the encryptor did before the key setup was cached, as a baseline"""
+    cipher = Cipher(
+        algorithms.AES(key.ljust(32)[:32].encode("utf-8")),
+        modes.CBC(os.urandom(16)),
+        backend=default_backend(),
+    )
+    encryptor = cipher.encryptor()
+    padder = padding.PKCS7(128).padder()
+    padded_data = padder.update(text.encode("utf-8")) + padder.finalize()
+    return encryptor.update(padded_data) + encryptor.finalize()
+
+
+def test_encryptor():
+    """Benchmark encrypting and decrypting per value, and in bulk, against the per call setup"""
+    encryptor = Encryptor("benchmark_key")
+    passwords = [f"password {i}" for i in range(ROUNDS)]
+
+    # Set up the key before measuring, as that is done only once per process
+    encrypted = encryptor.encrypt_many(passwords)
+    per_call_encrypt("benchmark_key", "warm up")
+
+    measure(
+        "per call setup",
+        "crypto",
+        lambda i: per_call_encrypt("benchmark_key", passwords[i]),
+    )
+    measure("encrypt_data", "crypto", lambda i: encryptor.encrypt_data(passwords[i]))
+    measure("decrypt_data", "crypto", lambda i: encryptor.decrypt_data(encrypted[i]))
+
+    # Measure the bulk operations once for all the values, and report them per value
+    bulk = measure(
+        "encrypt_many", "crypto", lambda _: encryptor.encrypt_many(passwords)
+    )
+    print(
+        f"{'crypto':>8} {'encrypt_many per value':<24} mean {bulk['mean_ms'] / ROUNDS:7.3f} ms"
+    )
+    bulk = measure(
+        "decrypt_many", "crypto", lambda _: encryptor.decrypt_many(encrypted)
+    )
+    print(
+        f"{'crypto':>8} {'decrypt_many per value':<24} mean {bulk['mean_ms'] / ROUNDS:7.3f} ms"
+    )
+
+    assert encryptor.decrypt_many(encrypted) == passwords
+
+
+def help_update(message_id: int) -> dict:
+    """Return an update with a /help command from the benchmark user"""
+    return {
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": TELEGRAM_ID, "type": "private"},
+            "from": {"id": TELEGRAM_ID, "is_bot": False, "first_name": "Benchmark"},
+            "text": "/help",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+        }
+    }
+
+
+async def start_bot(fake: FakeBotApi, mode: str) -> Application:
+    """Start an application answering /help, receiving its updates from the fake Bot API"""
+    app = Application.builder().token("1:benchmark").base_url(fake.base_url).build()
+    app.add_handler(CommandHandler("help", TelegramBot.help_command))
+    await app.initialize()
+
+    if mode == "webhook":
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        await app.updater.start_webhook(
+            listen="127.0.0.1",
+            port=port,
+            url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{port}/telegram",
+            secret_token="benchmark",
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        await app.updater.start_polling(
+            poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES
+        )
+
+    await app.start()
+    return app
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["polling", "webhook"])
+async def test_update_transport(mode):
+    """Benchmark the latency and throughput of answering updates, by polling and by webhook"""
+    fake = FakeBotApi()
+    await fake.start()
+    app = await start_bot(fake, mode)
+
+    try:
+        assert (fake.webhook is not None) == (mode == "webhook")
+
+        # The latency from handing out an update until the answer arrives, one update at a time
+        latencies = []
+        for i in range(ROUNDS):
+            start = time.perf_counter()
+            await fake.push_update(help_update(i))
+            received, message = await asyncio.wait_for(fake.sent.get(), 10)
+            latencies.append((received - start) * 1000)
+            assert message["chat"]["id"] == TELEGRAM_ID
+
+        report("update to answer", mode, latencies)
+
+        # The throughput when all the updates arrive at once
+        start = time.perf_counter()
+        await asyncio.gather(*(fake.push_update(help_update(i)) for i in range(ROUNDS)))
+        for _ in range(ROUNDS):
+            await asyncio.wait_for(fake.sent.get(), 10)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>8} {'updates per second':<24} {ROUNDS / elapsed:9.1f}")
+
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await fake.stop()
@@ -1,7 +1,9 @@
 """Test module to test the db_helpers module in the src file"""
 
 # pylint: disable=redefined-outer-name
-from datetime import datetime
+import gzip
+import os
+from datetime import datetime, timedelta
 from unittest.mock import ANY, MagicMock, patch
 
 import pytest
@@ -19,7 +21,7 @@ def mock_users():
 @pytest.fixture
 def mock_db():
     """Fixture to create a mock database instance."""
-    with patch("usc_sign_in_bot.db_helpers.psycopg2.connect") as mock_connect, patch(
+    with patch("usc_sign_in_bot.backends.psycopg2.connect") as mock_connect, patch(
         "usc_sign_in_bot.db_helpers.Encryptor"
     ) as mock_encryptor:
 
@@ -62,7 +64,8 @@ def test_insert_user(mock_db):
 
 def test_insert_user_already_exists(mock_db):
     """Test handling of a user already existing in the database."""
-    mock_db.cursor.execute = MagicMock(side_effect=UniqueViolation)
+    mock_db.cursor.execute = MagicMock(side_effect=[UniqueViolation, None])
+    mock_db.cursor.fetchone.return_value = ("legacy_value",)
     mock_db.conn.rollback = MagicMock()
 
     sign_up_time = datetime.now()
@@ -73,8 +76,9 @@ def test_insert_user_already_exists(mock_db):
     # Assert that rollback was called after UniqueViolation
     mock_db.conn.rollback.assert_called_once()
 
-    # Assert that the returned user_id is correct even on violation
-    assert user_id == "hashed_value"
+    # Assert that the user_id the user already has is returned
+    mock_db.cursor.execute.assert_called_with(ANY, ("123456789",))
+    assert user_id == "legacy_value"
 
 
 def test_add_to_data(mock_db):
@@ -87,8 +91,10 @@ def test_add_to_data(mock_db):
         "Fencing", lesson_time, "user_123", True, trainer="John Doe"
     )
 
-    # Assert that the insert query was executed with correct parameters
-    mock_db.cursor.execute.assert_called_once_with(
+    # Assert that the key was reserved, and the insert query was executed with correct parameters
+    assert mock_db.cursor.execute.call_count == 2
+    mock_db.cursor.execute.assert_any_call(ANY, ("hashed_value", str(lesson_time)))
+    mock_db.cursor.execute.assert_called_with(
         ANY,
         (
             "hashed_value",
@@ -105,6 +111,30 @@ def test_add_to_data(mock_db):
     assert lesson_key == "hashed_value"
 
 
+def test_add_to_data_key_taken(mock_db):
+    """Test if a lesson gets another key when its key is taken by a lesson that moved"""
+    mock_db.cursor.fetchone = MagicMock(side_effect=[None, ("hashed_value",)])
+    lesson_time = datetime(2024, 12, 3, 18, 30)
+
+    mock_db.add_to_data("Fencing", lesson_time, "user_123", False)
+
+    assert [call.args[0] for call in mock_db.encrypt.generate_hash_key.mock_calls] == [
+        "Fencing2024-12-03T18:30:00user_123",
+        "Fencing2024-12-03T18:30:00user_123#1",
+    ]
+    assert mock_db.cursor.execute.call_count == 3
+
+
+def test_add_to_data_no_free_key(mock_db):
+    """Test if adding a lesson stops when none of the keys is free"""
+    mock_db.cursor.fetchone = MagicMock(return_value=None)
+
+    with pytest.raises(ValueError):
+        mock_db.add_to_data("Fencing", datetime.now(), "user_123", False)
+
+    mock_db.conn.rollback.assert_called_once()
+
+
 def test_has_received_update(mock_db):
     """Test checking if a user has already received a message."""
     mock_db.cursor.execute = MagicMock()
@@ -117,7 +147,7 @@ def test_has_received_update(mock_db):
 
     # Assert that the select query was executed with correct parameters
     mock_db.cursor.execute.assert_called_once_with(
-        ANY, ("Fencing", str(lesson_time), True, "user_123")
+        ANY, ("Fencing", str(lesson_time), "user_123")
     )
 
     # Assert that the result is True when a record is found
@@ -136,6 +166,7 @@ def test_get_lesson_data_by_key(mock_db):
             "John Doe",
             True,
             None,
+            False,
         )
     )
     mock_db.cursor.description = [
@@ -146,13 +177,17 @@ def test_get_lesson_data_by_key(mock_db):
         ("trainer",),
         ("message_sent",),
         ("response",),
+        ("cancelled",),
     ]
 
     # Call the method
     lesson_data = mock_db.get_lesson_data_by_key("lesson_123")
 
     # Assert that the select query was executed with correct parameters
-    mock_db.cursor.execute.assert_called_once_with(ANY, ("lesson_123",))
+    mock_db.cursor.execute.assert_called_once_with(ANY, ("lesson_123", "lesson_123"))
+
+    # The datetime of the lesson is looked up as well, such that only its partition is read
+    assert "lesson_keys" in mock_db.cursor.execute.call_args[0][0]
 
     # Assert that the lesson data is returned correctly
     assert lesson_data["lesson_id"] == "lesson_123"
@@ -161,29 +196,44 @@ def test_get_lesson_data_by_key(mock_db):
 
 
 def test_get_user_success(mock_db):
-    """Test if the user is successfully retrieved with decrypted password."""
-    # Mock the database cursor description and fetched result
-    mock_db.cursor.description = [("user_id",), ("username",), ("password",)]
+    """Test if the user is successfully retrieved and the password is decrypted lazily."""
+    # Mock the fetched result, in the order of the selected columns
     mock_db.cursor.fetchone.return_value = (
         "user123",
+        datetime(2024, 9, 1),
+        "uva",
+        "Schermen",
         "test_user",
         "encrypted_password",
+        1234,
     )
 
     # Call the function
     result = mock_db.get_user("user123")
 
-    # Check that the cursor was called with the correct query
+    # Check that the cursor was called with the correct query and explicit columns
     mock_db.cursor.execute.assert_called_once_with(ANY, ("user123",))
+    assert "SELECT *" not in mock_db.cursor.execute.call_args[0][0]
+
+    # The password should not be decrypted before it is read
+    mock_db.encrypt.decrypt_data.assert_not_called()
+    assert result.telegram_id == 1234
+    mock_db.encrypt.decrypt_data.assert_not_called()
 
-    # Check if the password was decrypted
+    # Check if the password is decrypted once on first access
+    assert result["password"] == "decrypted_password"
+    assert result.password == "decrypted_password"
     mock_db.encrypt.decrypt_data.assert_called_once_with("encrypted_password")
 
     # Check if the result is as expected
     expected_result = {
         "user_id": "user123",
+        "sign_up_date": datetime(2024, 9, 1),
+        "login_method": "uva",
+        "sport": "Schermen",
         "username": "test_user",
         "password": "decrypted_password",
+        "telegram_id": 1234,
     }
     assert result == expected_result
 
@@ -204,29 +254,34 @@ def test_get_user_not_found(mock_db):
 def test_get_user_custom_query_key(mock_db):
     """Test if the function works with a custom query key."""
     # Mock the result
-    mock_db.cursor.description = [("email",), ("username",), ("password",)]
     mock_db.cursor.fetchone.return_value = (
-        "user@example.com",
+        "user123",
+        None,
+        "uva",
+        None,
         "test_user",
         "encrypted_password",
+        1234,
     )
 
     # Call the function with a custom query key
-    result = mock_db.get_user("user@example.com", query_key="email")
+    result = mock_db.get_user(1234, query_key="telegram_id")
 
     # Check that the cursor was called with the correct query and custom key
-    mock_db.cursor.execute.assert_called_once_with(ANY, ("user@example.com",))
-
-    # Check if the password was decrypted
-    mock_db.encrypt.decrypt_data.assert_called_once_with("encrypted_password")
+    mock_db.cursor.execute.assert_called_once_with(ANY, (1234,))
+    assert "WHERE telegram_id = %s" in mock_db.cursor.execute.call_args[0][0]
 
     # Check if the result is as expected
-    expected_result = {
-        "email": "user@example.com",
-        "username": "test_user",
-        "password": "decrypted_password",
-    }
-    assert result == expected_result
+    assert result.user_id == "user123"
+    assert result["username"] == "test_user"
+
+
+def test_get_user_unknown_query_key(mock_db):
+    """Test if users can only be looked up by their key columns"""
+    with pytest.raises(ValueError, match="can not be looked up by email"):
+        mock_db.get_user("user@example.com", query_key="email")
+
+    mock_db.cursor.execute.assert_not_called()
 
 
 def test_edit_data_point_success(mock_db):
@@ -256,17 +311,31 @@ def test_edit_data_point_error(mock_db):
     mock_db.conn.rollback.assert_called_once()
 
 
+def test_lesson_lookups_error(mock_db):
+    """Test if the lookups of the buttons roll back when there is an error"""
+    mock_db.cursor.execute.side_effect = Exception("Database error")
+
+    with pytest.raises(Exception):
+        mock_db.is_lesson_cancelled("key_les")
+    with pytest.raises(Exception):
+        mock_db.has_broadcast("Fencing", datetime.now())
+
+    assert mock_db.conn.rollback.call_count == 2
+
+
 def test_get_all_users_in_sport_success(mock_db: MagicMock, mock_users: list) -> None:
     """Test if you can sucessfully query all users"""
     # Test successful retrieval of users
-    mock_db.cursor.fetchall.return_value = mock_users
-    mock_db.cursor.description = [("user_id",), ("telegram_id",)]
+    mock_db.cursor.fetchall.return_value = [
+        (user["user_id"], user["telegram_id"]) for user in mock_users
+    ]
 
     # Call the function
     result = mock_db.get_all_users_in_sport("sport")
 
     # Assert if it works
     assert result == mock_users
+    assert result[0].telegram_id == "telegram_id"
     mock_db.cursor.execute.assert_called_once_with(ANY, ("sport",))
     mock_db.conn.rollback.assert_not_called()
     mock_db.conn.rollback.assert_not_called()
@@ -281,3 +350,343 @@ def test_get_all_users_in_sport_error(mock_db: MagicMock):
         mock_db.get_all_users_in_sport("sport")
 
     mock_db.conn.rollback.assert_called_once()
+
+
+def test_transaction_commits_once(mock_db):
+    """Test if all operations in a transaction are committed together at the end"""
+    with mock_db.transaction():
+        mock_db.edit_data_point("key_les", "col", "value", "table", "key_column")
+        mock_db.update_fields("lessons", "key_les", response="Y")
+
+        # Nothing should be committed while the transaction is still open
+        mock_db.conn.commit.assert_not_called()
+
+    mock_db.conn.commit.assert_called_once()
+    mock_db.conn.rollback.assert_not_called()
+    assert not mock_db.in_transaction
+
+
+def test_transaction_rolls_back_on_error(mock_db):
+    """Test if the transaction is rolled back once when an operation in it fails"""
+    mock_db.cursor.execute.side_effect = Exception("Database error")
+
+    with pytest.raises(Exception):
+        with mock_db.transaction():
+            mock_db.edit_data_point("key_les", "col", "value", "table", "key_column")
+
+    mock_db.conn.rollback.assert_called_once()
+    mock_db.conn.commit.assert_not_called()
+
+
+def test_insert_user_in_transaction_uses_savepoint(mock_db):
+    """Test if an existing user only rolls back to the savepoint within a transaction"""
+    mock_db.cursor.execute.side_effect = [None, UniqueViolation, None, None]
+    mock_db.cursor.fetchone.return_value = ("hashed_value",)
+
+    with mock_db.transaction():
+        user_id = mock_db.insert_user("123456789", datetime.now(), "uva")
+
+    mock_db.cursor.execute.assert_any_call("SAVEPOINT insert_user")
+    mock_db.cursor.execute.assert_any_call("ROLLBACK TO SAVEPOINT insert_user")
+    mock_db.conn.rollback.assert_not_called()
+    mock_db.conn.commit.assert_called_once()
+    assert user_id == "hashed_value"
+
+
+def test_update_fields(mock_db):
+    """Test if several columns are updated in a single statement"""
+    mock_db.update_fields(
+        "users", 1234, key_column="telegram_id", username="name", sport="Schermen"
+    )
+
+    mock_db.cursor.execute.assert_called_once_with(ANY, ("name", "Schermen", 1234))
+    query = mock_db.cursor.execute.call_args[0][0]
+    assert "SET username = %s, sport = %s" in query
+    assert "WHERE telegram_id = %s" in query
+    mock_db.conn.commit.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "table, key_column, cols",
+    [
+        ("not_a_table", None, {"sport": "Schermen"}),
+        ("users", "sport", {"username": "name"}),
+        ("users", None, {"user_id; DROP TABLE users": "x"}),
+        ("users", None, {}),
+    ],
+)
+def test_update_fields_refuses_unknown_columns(mock_db, table, key_column, cols):
+    """Test if columns outside of the whitelist never end up in a query"""
+    with pytest.raises(ValueError):
+        mock_db.update_fields(table, "key", key_column=key_column, **cols)
+
+    mock_db.cursor.execute.assert_not_called()
+
+
+def test_claim_lesson_response(mock_db):
+    """Test if a response is claimed and joined with the login fields in one query"""
+    mock_db.cursor.fetchone.return_value = (
+        "Fencing",
+        datetime(2024, 9, 17, 18),
+        "test_user",
+        "encrypted_password",
+        "uva",
+    )
+
+    result = mock_db.claim_lesson_response("lesson_123", "Y", 123456)
+
+    mock_db.cursor.execute.assert_called_once_with(
+        ANY, ("Y", "lesson_123", "lesson_123", 123456)
+    )
+    assert "response IS NULL" in mock_db.cursor.execute.call_args[0][0]
+    mock_db.conn.commit.assert_called_once()
+    assert result["password"] == "decrypted_password"
+    mock_db.encrypt.decrypt_data.assert_called_once_with("encrypted_password")
+    assert result == {
+        "sport": "Fencing",
+        "datetime": datetime(2024, 9, 17, 18),
+        "username": "test_user",
+        "password": "decrypted_password",
+        "login_method": "uva",
+    }
+
+
+def test_claim_lesson_response_no_skips_decryption(mock_db):
+    """Test if the password is not decrypted when the user does not want to go"""
+    mock_db.cursor.fetchone.return_value = ("Fencing", None, "user", "encrypted", "uva")
+
+    result = mock_db.claim_lesson_response("lesson_123", "N", 123456)
+
+    assert result.sport == "Fencing"
+    mock_db.encrypt.decrypt_data.assert_not_called()
+
+
+def test_claim_lesson_response_allready_claimed(mock_db):
+    """Test if a second claim on the same lesson returns None"""
+    mock_db.cursor.fetchone.return_value = None
+
+    assert mock_db.claim_lesson_response("lesson_123", "Y", 123456) is None
+    mock_db.encrypt.decrypt_data.assert_not_called()
+
+
+def test_iter_users_in_sport(mock_db):
+    """Test if users are streamed in batches from a named server-side cursor"""
+    server_cursor = MagicMock()
+    server_cursor.fetchmany.side_effect = [[("a", 1), ("b", 2)], [("c", 3)], []]
+    mock_db.conn.cursor.return_value = server_cursor
+
+    users = mock_db.iter_users_in_sport("sport", itersize=2)
+
+    # Nothing should be queried before the users are iterated over
+    server_cursor.execute.assert_not_called()
+
+    assert [user.telegram_id for user in users] == [1, 2, 3]
+    assert mock_db.conn.cursor.call_args.kwargs["withhold"] is True
+    assert mock_db.conn.cursor.call_args.kwargs["name"].startswith("users_in_sport_")
+    server_cursor.execute.assert_called_once_with(ANY, ("sport",))
+    server_cursor.fetchmany.assert_called_with(2)
+    server_cursor.close.assert_called_once()
+
+
+def test_iter_users_in_sport_error(mock_db):
+    """Test if the server-side cursor is closed and rolled back on an error"""
+    server_cursor = MagicMock()
+    server_cursor.fetchmany.side_effect = Exception("Database error")
+    mock_db.conn.cursor.return_value = server_cursor
+
+    with pytest.raises(Exception):
+        list(mock_db.iter_users_in_sport("sport"))
+
+    server_cursor.close.assert_called_once()
+    mock_db.conn.rollback.assert_called_once()
+
+
+def test_iter_passwords_to_rotate(mock_db):
+    """Test if the passwords of other keys are streamed in batches, in the order of the users"""
+    server_cursor = MagicMock()
+    server_cursor.fetchmany.side_effect = [[("a", "old$1"), ("b", "2")], []]
+    mock_db.conn.cursor.return_value = server_cursor
+
+    batches = list(mock_db.iter_passwords_to_rotate("abcd1234", itersize=2))
+
+    assert batches == [[("a", "old$1"), ("b", "2")]]
+    assert mock_db.conn.cursor.call_args.kwargs["name"].startswith(
+        "passwords_to_rotate_"
+    )
+    server_cursor.execute.assert_called_once_with(ANY, ("abcd1234$%",))
+    assert "ORDER BY user_id" in server_cursor.execute.call_args.args[0]
+    server_cursor.close.assert_called_once()
+
+
+def test_update_passwords(mock_db):
+    """Test if passwords are updated in a single statement, only if they did not change"""
+    mock_db.cursor.rowcount = 1
+
+    count = mock_db.update_passwords([("a", "old1", "new1"), ("b", "old2", "new2")])
+
+    assert count == 1
+    mock_db.cursor.execute.assert_called_once_with(
+        ANY, ("a", "old1", "new1", "b", "old2", "new2")
+    )
+    assert "users.password = v.column2" in mock_db.cursor.execute.call_args.args[0]
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_update_passwords_empty(mock_db):
+    """Test if nothing is executed without passwords to update"""
+    assert mock_db.update_passwords([]) == 0
+    mock_db.cursor.execute.assert_not_called()
+
+
+def test_methods_are_measured(mock_db):
+    """Test if the database methods are measured in the query statistics"""
+    with patch("usc_sign_in_bot.db_helpers.QUERY_STATS") as mock_stats:
+        mock_db.has_received_update("Fencing", datetime.now(), "user_123")
+
+    mock_stats.measure.assert_called_once_with("has_received_update")
+
+
+def test_create_lesson_partition(mock_db):
+    """Test if a monthly partition is created with the right bounds"""
+    name = mock_db.create_lesson_partition(datetime(2024, 12, 20, 18, 30))
+
+    assert name == "lessons_2024_12"
+    mock_db.cursor.execute.assert_called_once_with(
+        ANY, (datetime(2024, 12, 1), datetime(2025, 1, 1))
+    )
+    assert "PARTITION OF lessons" in mock_db.cursor.execute.call_args[0][0]
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_partition_lessons(mock_db, tmp_path):
+    """Test if the partitioned table is created from the init script of the backend"""
+    init_script = tmp_path / "init.sql"
+    init_script.write_text("CREATE TABLE lessons ();", encoding="UTF-8")
+    mock_db.backend.init_script = str(init_script)
+    mock_db.cursor.fetchall.return_value = [(datetime(2024, 12, 1),)]
+
+    mock_db.partition_lessons()
+
+    queries = [call.args[0] for call in mock_db.cursor.execute.call_args_list]
+    assert queries[0] == "ALTER TABLE lessons RENAME TO lessons_unpartitioned;"
+    assert queries[1] == "CREATE TABLE lessons ()"
+    assert "PARTITION OF lessons" in queries[3]
+    assert queries[-1] == "DROP TABLE lessons_unpartitioned;"
+
+
+def test_get_lesson_partitions(mock_db):
+    """Test if partitions are mapped to their month and unknown partitions are skipped"""
+    mock_db.cursor.fetchall.return_value = [("lessons_2024_12",), ("lessons_other",)]
+
+    assert mock_db.get_lesson_partitions() == {"lessons_2024_12": datetime(2024, 12, 1)}
+
+
+def test_archive_lesson_partition(mock_db, tmp_path):
+    """Test if a partition is exported to a compressed file and then removed"""
+    mock_db.cursor.fetchall.return_value = [("lessons_2024_04",)]
+    mock_db.cursor.copy_expert.side_effect = lambda _, file: file.write("lesson_id\n")
+    path = str(tmp_path / "lessons_2024_04.csv.gz")
+
+    mock_db.archive_lesson_partition("lessons_2024_04", path)
+
+    with gzip.open(path, "rt", encoding="UTF-8") as file:
+        assert file.read() == "lesson_id\n"
+    assert not os.path.exists(path + ".partial")
+    mock_db.cursor.execute.assert_any_call(
+        "ALTER TABLE lessons DETACH PARTITION lessons_2024_04;"
+    )
+    mock_db.cursor.execute.assert_called_with("DROP TABLE lessons_2024_04;")
+
+
+def test_archive_unknown_partition(mock_db, tmp_path):
+    """Test if only partitions of the lessons table can be archived"""
+    mock_db.cursor.fetchall.return_value = []
+
+    with pytest.raises(ValueError):
+        mock_db.archive_lesson_partition("users", str(tmp_path / "users.csv.gz"))
+
+    mock_db.cursor.copy_expert.assert_not_called()
+
+
+def test_add_to_outbox(mock_db):
+    """Test if a message is added to the outbox and the bot is notified"""
+    mock_db.cursor.fetchone.return_value = (7,)
+
+    assert mock_db.add_to_outbox(1234, "key", "Would you like to go?") == 7
+
+    query, params = mock_db.cursor.execute.call_args[0]
+    assert "INSERT INTO outbox" in query and "pg_notify" in query
+    assert params == (1234, "key", "Would you like to go?", "usc_outbox")
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_claim_outbox(mock_db):
+    """Test if a batch of due messages is claimed and returned in the order they were added"""
+    mock_db.cursor.fetchall.return_value = [
+        (2, 1002, "key2", "second", 1),
+        (1, 1001, "key1", "first", 2),
+    ]
+    now = datetime(2024, 12, 1, 12)
+
+    messages = mock_db.claim_outbox(10, lease=timedelta(minutes=5), now=now)
+
+    assert [message.text for message in messages] == ["first", "second"]
+    query, params = mock_db.cursor.execute.call_args[0]
+    assert "FOR UPDATE SKIP LOCKED" in query
+    assert params == (now, now, datetime(2024, 12, 1, 11, 55), 10)
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_mark_outbox_sent(mock_db):
+    """Test if the message and its lesson are marked as sent in one statement"""
+    now = datetime(2024, 12, 1, 12)
+
+    mock_db.mark_outbox_sent(7, message_id=99, now=now)
+
+    query, params = mock_db.cursor.execute.call_args[0]
+    assert "UPDATE lessons SET message_sent = TRUE" in query
+    assert params == (now, 99, 7, " ")
+    mock_db.conn.commit.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "retry_at, state",
+    [(datetime(2024, 12, 1, 12), "pending"), (None, "failed")],
+)
+def test_mark_outbox_failed(mock_db, retry_at, state):
+    """Test if a failed message is retried later, or failed for good without a retry time"""
+    mock_db.mark_outbox_failed(7, "Timed out", retry_at=retry_at)
+
+    mock_db.cursor.execute.assert_called_once_with(
+        ANY, (state, "Timed out", retry_at, 7)
+    )
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_process_outbox_notifications(mock_db):
+    """Test if all pending notifications are consumed at once"""
+    mock_db.conn.notifies = [MagicMock(), MagicMock()]
+
+    assert mock_db.process_outbox_notifications() == 2
+    assert not mock_db.conn.notifies
+
+
+def test_deactivate_user(mock_db):
+    """Test if a user is deactivated together with their pending messages in one transaction"""
+    mock_db.deactivate_user(1234, "Forbidden: bot was blocked by the user")
+
+    mock_db.cursor.execute.assert_any_call(ANY, (False, 1234))
+    mock_db.cursor.execute.assert_called_with(
+        ANY, ("Forbidden: bot was blocked by the user", 1234)
+    )
+    assert "UPDATE outbox" in mock_db.cursor.execute.call_args[0][0]
+    mock_db.conn.commit.assert_called_once()
+
+
+def test_inactive_users_are_skipped(mock_db):
+    """Test if only the active users of a sport are selected"""
+    mock_db.cursor.fetchall.return_value = []
+
+    mock_db.get_all_users_in_sport("Fencing")
+
+    assert "AND active" in mock_db.cursor.execute.call_args[0][0]
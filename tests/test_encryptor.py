@@ -1,12 +1,17 @@
 """Test module to test the Encryptor module in the src file"""
 
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name, protected-access
 import hashlib
-from base64 import b64decode
+import os
+from base64 import b64decode, b64encode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from usc_sign_in_bot import Encryptor  # Replace with the actual module name
+from usc_sign_in_bot.encryptor import _derive_key
 
 
 @pytest.fixture
@@ -19,15 +24,37 @@ def encryptor():
 def test_generate_hash_key():
     """Test generating a hash key."""
     test_str = "test_sport_2024-09-19"
-    expected_hash = hashlib.sha256(test_str.encode()).hexdigest()[:60]
-    assert Encryptor.generate_hash_key(test_str) == expected_hash
+    expected_hash = urlsafe_b64encode(hashlib.sha256(test_str.encode()).digest()[:12])
+    assert Encryptor.generate_hash_key(test_str) == expected_hash.decode()
+    assert len(Encryptor.generate_hash_key(test_str)) == 16
 
 
-def test_get_key(encryptor):
-    """Test if the key is correctly padded and encoded."""
+def test_compact_legacy_key():
+    """Test if a legacy key is compacted into the key that is generated now."""
+    test_str = "test_sport_2024-09-19"
+    legacy_key = hashlib.sha256(test_str.encode()).hexdigest()[:60]
+
+    assert Encryptor.is_legacy_key(legacy_key)
+    assert not Encryptor.is_legacy_key(Encryptor.generate_hash_key(test_str))
+    assert Encryptor.compact_legacy_key(legacy_key) == Encryptor.generate_hash_key(
+        test_str
+    )
+
+
+def test_broadcast_key():
+    """Test if the keys of broadcasts are told apart from the keys of lessons."""
+    key = Encryptor.generate_broadcast_key("test_sport_2024-09-19")
+
+    assert Encryptor.is_broadcast_key(key)
+    assert not Encryptor.is_broadcast_key(Encryptor.generate_hash_key("test_sport"))
+    assert not Encryptor.is_legacy_key(key)
+
+
+def test_get_legacy_key(encryptor):
+    """Test if the legacy key is correctly padded and encoded."""
     key = "test_encrypt_key"
     expected_key = key.ljust(32)[:32].encode("utf-8")
-    assert encryptor._get_key() == expected_key  # pylint: disable=protected-access
+    assert encryptor._get_legacy_key() == expected_key
 
 
 def test_encrypt_data(encryptor):
@@ -35,10 +62,12 @@ def test_encrypt_data(encryptor):
     plaintext = "This is a test"
     encrypted_data = encryptor.encrypt_data(plaintext)
 
-    # Ensure the result is a base64-encoded string
+    # Ensure the result is a base64-encoded string prefixed with the key id
     assert isinstance(encrypted_data, str)
+    key_id, _, encoded = encrypted_data.partition("$")
+    assert key_id == encryptor.key_id
 
-    decoded = b64decode(encrypted_data)
+    decoded = b64decode(encoded)
     # Ensure IV is 16 bytes
     assert len(decoded[:16]) == 16
     # Ensure ciphertext exists
@@ -61,3 +90,74 @@ def test_encrypt_decrypt_roundtrip(encryptor):
     decrypted = encryptor.decrypt_data(encrypted)
 
     assert decrypted == plaintext
+
+
+def test_decrypt_legacy_data(encryptor):
+    """Test if values encrypted with the padded key, before the key derivation, still decrypt."""
+    rand_iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(b"Legacy password") + padder.finalize()
+    cipher = Cipher(
+        algorithms.AES(b"test_encrypt_key".ljust(32)), modes.CBC(rand_iv)
+    ).encryptor()
+    legacy = b64encode(rand_iv + cipher.update(padded) + cipher.finalize()).decode()
+
+    assert encryptor.decrypt_data(legacy) == "Legacy password"
+
+
+def test_encrypt_many_roundtrip(encryptor):
+    """Test if values encrypted in one go decrypt in one go, each with its own IV."""
+    texts = ["first", "second", "second", ""]
+
+    encrypted = encryptor.encrypt_many(texts)
+
+    assert len(set(encrypted)) == len(texts)
+    assert encryptor.decrypt_many(encrypted) == texts
+    assert encryptor.decrypt_data(encrypted[0]) == "first"
+
+
+def test_key_derived_once():
+    """Test if the key is derived only once, also when several threads need it at once."""
+    misses = _derive_key.cache_info().misses
+
+    encryptors = [Encryptor("derived_once_key") for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda enc: enc.encrypt_data("text"), encryptors))
+
+    assert _derive_key.cache_info().misses == misses + 1
+    assert encryptors[0].decrypt_many(results) == ["text"] * 8
+
+
+def test_derive_keys():
+    """Test if the keys can be derived up front, such that using them derives nothing."""
+    encryptor = Encryptor("derived_up_front_key", "derived_up_front_previous")
+    misses = _derive_key.cache_info().misses
+
+    encryptor.derive_keys()
+    assert _derive_key.cache_info().misses == misses + 2
+
+    assert encryptor.decrypt_data(encryptor.encrypt_data("text")) == "text"
+    assert _derive_key.cache_info().misses == misses + 2
+
+
+def test_rotate_key():
+    """Test if values of the previous key decrypt after a rotation, and are re-encrypted."""
+    old = Encryptor("old_rotation_key")
+    new = Encryptor("new_rotation_key", previous_key="old_rotation_key")
+    encrypted = old.encrypt_data("password")
+
+    assert new.key_id != old.key_id
+    assert new.needs_rotation(encrypted)
+    assert new.decrypt_data(encrypted) == "password"
+
+    rotated = new.encrypt_data(new.decrypt_data(encrypted))
+    assert not new.needs_rotation(rotated)
+    assert new.decrypt_data(rotated) == "password"
+
+
+def test_decrypt_unknown_key(encryptor):
+    """Test if a value of a key the encryptor does not know is refused."""
+    encrypted = Encryptor("other_unknown_key").encrypt_data("password")
+
+    with pytest.raises(ValueError):
+        encryptor.decrypt_data(encrypted)
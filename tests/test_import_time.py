@@ -0,0 +1,94 @@
+"""
+Test module to keep the start up of the modes of the bot small, by checking what they import and
+how long that takes with `python -X importtime`.
+
+The budget is generous, such that it holds on slow machines as well, and can be set with
+IMPORT_BUDGET_MS. Run with `python -m pytest tests/test_import_time.py -s` to see the times.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import usc_sign_in_bot
+
+# The maximum number of milliseconds importing the module of a mode may take
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", 1500))
+
+# Modules only the job needs, to scrape the lessons and book them
+HEAVY_MODULES = ("selenium", "bs4", "webdriver_manager")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(statement: str) -> dict[str, int]:
+    """Run the statement in a new interpreter, return the microseconds every import took"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    )
+
+    # The lines read "import time: <self> | <cumulative> | <module>", after a header line
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def imported_heavy_modules(times: dict[str, int]) -> list[str]:
+    """Return the heavy modules among the imported modules"""
+    return [name for name in times if name.split(".")[0] in HEAVY_MODULES]
+
+
+def test_package_import():
+    """Test if importing the package itself does not import any of its modules yet"""
+    times = import_times("import usc_sign_in_bot")
+
+    assert not [name for name in times if name.startswith("usc_sign_in_bot.")]
+    assert "psycopg2" not in times
+
+
+def test_lazy_attributes():
+    """Test if the classes of the package are still available from the package"""
+    assert usc_sign_in_bot.Encryptor.generate_hash_key("test")
+
+    with pytest.raises(AttributeError):
+        _ = usc_sign_in_bot.Unknown
+
+
+def test_main_import():
+    """Test if the main module only imports the modules of the mode it runs"""
+    times = import_times("import usc_sign_in_bot.__main__")
+
+    assert "usc_sign_in_bot.db_helpers" not in times
+    assert "telegram" not in times
+
+
+@pytest.mark.parametrize(
+    "mode, module",
+    [
+        ("bot", "usc_sign_in_bot.telegram_bot"),
+        ("dispatch", "usc_sign_in_bot.outbox"),
+        ("maintenance", "usc_sign_in_bot.maintenance"),
+        ("rotate-keys", "usc_sign_in_bot.key_rotation"),
+    ],
+)
+def test_mode_import(mode, module):
+    """Test if the modes that don't scrape don't load selenium, and start within the budget"""
+    times = import_times(f"import {module}")
+    elapsed_ms = times[module] / 1000
+
+    print(f"{mode:>12} import {elapsed_ms:8.1f} ms")
+
+    assert not imported_heavy_modules(times)
+    assert elapsed_ms < IMPORT_BUDGET_MS
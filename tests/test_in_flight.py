@@ -0,0 +1,81 @@
+"""Test module to test the coalescing of duplicate calls in the src file"""
+
+import asyncio
+
+import pytest
+
+from usc_sign_in_bot.in_flight import InFlightRegistry, KeyedLocks
+
+
+@pytest.mark.asyncio
+async def test_duplicates_coalesced():
+    """Test if duplicate calls wait for the running call instead of doing the work again"""
+    registry = InFlightRegistry()
+    calls = []
+
+    async def book(lesson):
+        calls.append(lesson)
+        await asyncio.sleep(0.01)
+        return "booked"
+
+    results = await asyncio.gather(
+        registry.run("lesson", book, "lesson"),
+        registry.run("lesson", book, "lesson"),
+        registry.run("other", book, "other"),
+    )
+
+    assert results == [(True, "booked"), (False, None), (True, "booked")]
+    assert calls == ["lesson", "other"]
+    assert not registry
+
+
+@pytest.mark.asyncio
+async def test_run_again_after_done():
+    """Test if a call after the running call is done does the work again"""
+    registry = InFlightRegistry()
+
+    async def book():
+        return "booked"
+
+    assert await registry.run("lesson", book) == (True, "booked")
+    assert "lesson" not in registry
+    assert await registry.run("lesson", book) == (True, "booked")
+
+
+@pytest.mark.asyncio
+async def test_error_only_raised_once():
+    """Test if an error is only raised to the call that did the work"""
+    registry = InFlightRegistry()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("Booking failed")
+
+    first, duplicate = await asyncio.gather(
+        registry.run("lesson", fail),
+        registry.run("lesson", fail),
+        return_exceptions=True,
+    )
+
+    assert isinstance(first, RuntimeError)
+    assert duplicate == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_keyed_locks():
+    """Test if the work for a key is done one at a time, and the lock is forgotten after"""
+    locks = KeyedLocks()
+    calls = []
+
+    async def edit(key, name):
+        async with locks.hold(key):
+            calls.append(f"start {name}")
+            await asyncio.sleep(0.01)
+            calls.append(f"end {name}")
+
+    await asyncio.gather(edit(99, "a"), edit(99, "b"), edit(98, "c"))
+
+    # The other key does not wait
+    assert calls.index("end a") < calls.index("start b")
+    assert calls.index("start c") < calls.index("end a")
+    assert not locks
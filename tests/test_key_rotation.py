@@ -0,0 +1,104 @@
+"""Test module to test the rotation of the encryption key in the src file"""
+
+# pylint: disable=redefined-outer-name
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.encryptor import Encryptor
+from usc_sign_in_bot.key_rotation import rotate_passwords
+
+
+@pytest.fixture
+def sqlite_db(sqlite_db, monkeypatch):
+    """Fixture for a database with passwords encrypted with the old key, opened with the new key"""
+    old = Encryptor("old_key")
+    for telegram_id in range(5):
+        user_id = sqlite_db.insert_user(telegram_id, datetime(2024, 11, 1), "uva")
+        sqlite_db.update_fields(
+            "users", user_id, password=old.encrypt_data(f"secret{telegram_id}")
+        )
+
+    monkeypatch.setenv("ENCRYPT_KEY", "new_key")
+    monkeypatch.setenv("ENCRYPT_KEY_PREVIOUS", "old_key")
+
+    with UscDataBase(backend=sqlite_db.backend) as database:
+        yield database
+
+
+def stored_passwords(usc_db: UscDataBase) -> list[str]:
+    """Return the encrypted passwords in the database, in the order of the users"""
+    usc_db.cursor.execute("SELECT password FROM users ORDER BY user_id;")
+    return [row[0] for row in usc_db.cursor.fetchall()]
+
+
+def test_rotate_passwords_batches():
+    """Test if every batch is re-encrypted and written back in a single update"""
+    usc_db = MagicMock()
+    usc_db.encrypt.key_id = "new"
+    usc_db.encrypt.decrypt_many.side_effect = lambda values: [v + "!" for v in values]
+    usc_db.encrypt.encrypt_many.side_effect = lambda values: [
+        f"new${v}" for v in values
+    ]
+    usc_db.iter_passwords_to_rotate.return_value = iter(
+        [[("a", "1"), ("b", "2")], [("c", "3")]]
+    )
+    usc_db.update_passwords.side_effect = len
+
+    with patch("usc_sign_in_bot.key_rotation.time.sleep") as mock_sleep:
+        assert rotate_passwords(usc_db, batch_size=2, pause=0.1) == 3
+
+    usc_db.iter_passwords_to_rotate.assert_called_once_with("new", 2)
+    usc_db.update_passwords.assert_any_call(
+        [("a", "1", "new$1!"), ("b", "2", "new$2!")]
+    )
+    usc_db.update_passwords.assert_any_call([("c", "3", "new$3!")])
+    assert mock_sleep.call_count == 2
+
+
+def test_rotate_passwords_sqlite(sqlite_db):
+    """Test if all the passwords end up encrypted with the new key and still decrypt"""
+    assert rotate_passwords(sqlite_db, batch_size=2, pause=0) == 5
+
+    passwords = stored_passwords(sqlite_db)
+    assert not any(sqlite_db.encrypt.needs_rotation(value) for value in passwords)
+    assert sorted(Encryptor("new_key").decrypt_many(passwords)) == [
+        f"secret{telegram_id}" for telegram_id in range(5)
+    ]
+
+
+def test_rotate_passwords_resumes(sqlite_db):
+    """Test if a rotation that was interrupted continues with the passwords that are left"""
+    update_passwords = sqlite_db.update_passwords
+
+    def interrupt_second_batch(changes):
+        if interrupt_second_batch.batches == 1:
+            raise KeyboardInterrupt()
+        interrupt_second_batch.batches += 1
+        return update_passwords(changes)
+
+    interrupt_second_batch.batches = 0
+
+    with patch.object(sqlite_db, "update_passwords", interrupt_second_batch):
+        with pytest.raises(KeyboardInterrupt):
+            rotate_passwords(sqlite_db, batch_size=2, pause=0)
+
+    assert (
+        sum(sqlite_db.encrypt.needs_rotation(v) for v in stored_passwords(sqlite_db))
+        == 3
+    )
+    assert rotate_passwords(sqlite_db, batch_size=2, pause=0) == 3
+
+
+def test_update_passwords_changed_meanwhile(sqlite_db):
+    """Test if a password the user changed during the rotation is not overwritten"""
+    batch = next(sqlite_db.iter_passwords_to_rotate(sqlite_db.encrypt.key_id, 1))
+    ((user_id, old_password),) = batch
+
+    changed = sqlite_db.encrypt.encrypt_data("changed")
+    sqlite_db.update_fields("users", user_id, password=changed)
+
+    assert sqlite_db.update_passwords([(user_id, old_password, "stale")]) == 0
+    assert stored_passwords(sqlite_db)[0] == changed
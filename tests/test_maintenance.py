@@ -0,0 +1,85 @@
+"""Test module to test the database maintenance in the src file"""
+
+# pylint: disable=redefined-outer-name
+import os
+from datetime import datetime as dt
+from unittest.mock import MagicMock, call
+
+import pytest
+
+from usc_sign_in_bot.maintenance import (add_months, archive_old_lessons,
+                                         ensure_lesson_partitions,
+                                         expire_lesson_key_aliases)
+
+
+@pytest.fixture
+def mock_db():
+    """Fixture for a database with a partitioned lessons table"""
+    db_mock = MagicMock()
+    db_mock.lessons_partitioned.return_value = True
+    db_mock.create_lesson_partition.side_effect = lambda month: month.strftime(
+        "lessons_%Y_%m"
+    )
+    return db_mock
+
+
+@pytest.mark.parametrize(
+    "month, months, expected",
+    [
+        (dt(2024, 11, 15, 12), 1, dt(2024, 12, 1)),
+        (dt(2024, 12, 31), 1, dt(2025, 1, 1)),
+        (dt(2024, 1, 31), -1, dt(2023, 12, 1)),
+        (dt(2024, 5, 2), -6, dt(2023, 11, 1)),
+    ],
+)
+def test_add_months(month, months, expected):
+    """Test moving a number of months forwards and backwards"""
+    assert add_months(month, months) == expected
+
+
+def test_ensure_lesson_partitions(mock_db):
+    """Test if the partitions for this month and the coming months are created"""
+    partitions = ensure_lesson_partitions(mock_db, dt(2024, 12, 20), months_ahead=2)
+
+    assert partitions == ["lessons_2024_12", "lessons_2025_01", "lessons_2025_02"]
+    mock_db.partition_lessons.assert_not_called()
+
+
+def test_ensure_lesson_partitions_converts_plain_table(mock_db):
+    """Test if a plain lessons table of an older database is converted first"""
+    mock_db.lessons_partitioned.return_value = False
+
+    ensure_lesson_partitions(mock_db, dt(2024, 12, 20), months_ahead=0)
+
+    mock_db.partition_lessons.assert_called_once()
+    mock_db.create_lesson_partition.assert_called_once_with(dt(2024, 12, 1))
+
+
+def test_archive_old_lessons(mock_db, tmp_path):
+    """Test if only the partitions older than the retention period are archived"""
+    mock_db.get_lesson_partitions.return_value = {
+        "lessons_2024_03": dt(2024, 3, 1),
+        "lessons_2024_04": dt(2024, 4, 1),
+        "lessons_2024_05": dt(2024, 5, 1),
+    }
+
+    archived = archive_old_lessons(
+        mock_db, dt(2024, 11, 20), retention_months=6, archive_dir=str(tmp_path)
+    )
+
+    expected = [
+        os.path.join(tmp_path, "lessons_2024_03.csv.gz"),
+        os.path.join(tmp_path, "lessons_2024_04.csv.gz"),
+    ]
+    assert archived == expected
+    mock_db.archive_lesson_partition.assert_has_calls(
+        [call("lessons_2024_03", expected[0]), call("lessons_2024_04", expected[1])]
+    )
+
+
+def test_expire_lesson_key_aliases(mock_db):
+    """Test if the legacy lesson keys older than the alias period are removed"""
+    mock_db.purge_lesson_key_aliases.return_value = 3
+
+    assert expire_lesson_key_aliases(mock_db, dt(2024, 12, 31), alias_days=30) == 3
+    mock_db.purge_lesson_key_aliases.assert_called_once_with(dt(2024, 12, 1))
@@ -0,0 +1,60 @@
+"""Test module to test the row objects in the src file"""
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from usc_sign_in_bot.models import Lesson, Notification, User
+
+
+def test_row_uses_slots():
+    """Test if rows don't carry a dictionary per row"""
+    lesson = Lesson(("key", "user", None, "Schermen", "John", True, None))
+
+    assert not hasattr(lesson, "__dict__")
+    assert lesson.sport == lesson["sport"] == "Schermen"
+
+
+def test_projected_row():
+    """Test if a row created with part of its columns only exposes those columns"""
+    user = User(("user_id", 1234), ("user_id", "telegram_id"))
+
+    assert user.username is None
+    assert "username" not in user
+    assert user.get("username", "default") == "default"
+    assert user.to_dict() == {"user_id": "user_id", "telegram_id": 1234}
+    assert dict(user) == user.to_dict()
+
+
+def test_row_is_read_only():
+    """Test if a row can't be changed once created"""
+    user = User(("user_id", 1234), ("user_id", "telegram_id"))
+
+    with pytest.raises(AttributeError):
+        user.telegram_id = 5678
+
+    with pytest.raises(KeyError):
+        _ = user["not_a_column"]
+
+
+def test_password_is_decrypted_lazily():
+    """Test if the password is only decrypted on first access"""
+    encryptor = MagicMock()
+    encryptor.decrypt_data.return_value = "password"
+    notification = Notification(
+        ("Schermen", None, "user", "encrypted", "uva"), encryptor=encryptor
+    )
+
+    encryptor.decrypt_data.assert_not_called()
+    assert notification.password == "password"
+    assert notification["password"] == "password"
+    assert notification.password == "password"
+    encryptor.decrypt_data.assert_called_once_with("encrypted")
+
+
+def test_repr_hides_password():
+    """Test if the password does not end up in logs through the representation"""
+    user = User(("user_id", "encrypted"), ("user_id", "password"))
+
+    assert "encrypted" not in repr(user)
+    assert "user_id='user_id'" in repr(user)
@@ -0,0 +1,186 @@
+"""Test module to test the sending of the outbox in the src file"""
+
+# pylint: disable=redefined-outer-name, protected-access
+import asyncio
+from datetime import datetime as dt
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from usc_sign_in_bot.models import OutboxMessage
+from usc_sign_in_bot.outbox import OutboxDispatcher
+
+
+@pytest.fixture
+def messages():
+    """Fixture for a batch of messages in the outbox"""
+    return [OutboxMessage((i, 1000 + i, f"key{i}", f"text {i}", 1)) for i in range(3)]
+
+
+@pytest.fixture
+def dispatcher(messages):
+    """Fixture for a dispatcher with an outbox holding a single batch"""
+    bot = MagicMock()
+    bot.send_message = AsyncMock(return_value=MagicMock(message_id=99))
+
+    dispatcher = OutboxDispatcher(bot, batch_size=3, messages_per_second=1000)
+    dispatcher.database = MagicMock()
+    dispatcher.database.claim_outbox.side_effect = [messages, []]
+    return dispatcher
+
+
+@pytest.mark.asyncio
+async def test_drain(dispatcher):
+    """Test if all the messages are sent with their buttons until the outbox is empty"""
+    assert await dispatcher.drain() == 3
+
+    assert dispatcher.bot.send_message.call_count == 3
+    args, kwargs = dispatcher.bot.send_message.call_args
+    assert args == (1002, "text 2")
+    button = kwargs["reply_markup"].inline_keyboard[0][0]
+    assert button.callback_data == "key2,Y"
+    dispatcher.database.claim_outbox.assert_called_with(3, lease=ANY)
+    dispatcher.database.mark_outbox_sent.assert_called_with(2, 99)
+
+
+@pytest.mark.asyncio
+async def test_send_digest(dispatcher):
+    """Test if a digest is sent with a row of buttons for every lesson"""
+    await dispatcher.send(OutboxMessage((7, 1007, "key1 key2", "Digest", 1)))
+
+    rows = dispatcher.bot.send_message.call_args.kwargs["reply_markup"].inline_keyboard
+    assert [[button.text for button in row] for row in rows] == [
+        ["1: Yes", "1: No"],
+        ["2: Yes", "2: No"],
+    ]
+    assert rows[1][0].callback_data == "key2,Y"
+
+
+@pytest.mark.asyncio
+async def test_send_edit(dispatcher):
+    """Test if an edit changes the message that was sent before, with the buttons it keeps"""
+    markup = '{"inline_keyboard": [[{"text": "Yes", "callback_data": "key7,Y"}]]}'
+    dispatcher.bot.edit_message_text = AsyncMock()
+
+    await dispatcher.send(OutboxMessage((7, 1007, "key7", "Moved", 1, 42, markup)))
+
+    dispatcher.bot.send_message.assert_not_called()
+    args, kwargs = dispatcher.bot.edit_message_text.call_args
+    assert args == ("Moved",)
+    assert (kwargs["chat_id"], kwargs["message_id"]) == (1007, 42)
+    assert kwargs["reply_markup"].inline_keyboard[0][0].callback_data == "key7,Y"
+    dispatcher.database.mark_outbox_sent.assert_called_once_with(7, 42)
+
+
+@pytest.mark.asyncio
+async def test_send_edit_not_modified(dispatcher):
+    """Test if an edit that changes nothing counts as done"""
+    dispatcher.bot.edit_message_text = AsyncMock(
+        side_effect=BadRequest("Message is not modified")
+    )
+
+    await dispatcher.send(OutboxMessage((7, 1007, "key7", "Same", 1, 42, None)))
+
+    dispatcher.bot.edit_message_text.assert_called_once_with(
+        "Same", chat_id=1007, message_id=42, reply_markup=None
+    )
+    dispatcher.database.mark_outbox_sent.assert_called_once_with(7, 42)
+    dispatcher.database.mark_outbox_failed.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.outbox.logger.warning")
+async def test_drain_continues_on_forbidden(mock_logger, dispatcher):
+    """Test if a user blocking the bot is deactivated, but the other messages are still sent"""
+    dispatcher.bot.send_message.side_effect = [
+        Forbidden("blocked"),
+        MagicMock(message_id=1),
+        MagicMock(message_id=2),
+    ]
+
+    assert await dispatcher.drain() == 3
+
+    mock_logger.assert_called_once()
+    dispatcher.database.mark_outbox_failed.assert_called_once_with(0, "blocked")
+    dispatcher.database.deactivate_user.assert_called_once_with(1000, "blocked")
+    assert dispatcher.database.mark_outbox_sent.call_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "error, deactivated",
+    [("Chat not found", True), ("Message is too long", False)],
+)
+async def test_bad_request(dispatcher, error, deactivated):
+    """Test if a bad request fails the message, and only deactivates a user without a chat"""
+    dispatcher.bot.send_message.side_effect = BadRequest(error)
+
+    await dispatcher.send(OutboxMessage((7, 1007, "key7", "text 7", 1)))
+
+    dispatcher.database.mark_outbox_failed.assert_called_once_with(7, error)
+    assert dispatcher.database.deactivate_user.called is deactivated
+
+
+@pytest.mark.asyncio
+async def test_retry_with_backoff(dispatcher):
+    """Test if a message that failed on the network is retried later, with a growing delay"""
+    dispatcher.bot.send_message.side_effect = NetworkError("Timed out")
+    message = OutboxMessage((7, 1007, "key7", "text 7", 3))
+
+    start = dt.now()
+    await dispatcher.send(message)
+
+    dispatcher.database.mark_outbox_sent.assert_not_called()
+    _, error = dispatcher.database.mark_outbox_failed.call_args[0]
+    retry_at = dispatcher.database.mark_outbox_failed.call_args[1]["retry_at"]
+    assert error == "Timed out"
+    assert (retry_at - start).total_seconds() >= 4 * 30
+
+
+@pytest.mark.asyncio
+async def test_retry_after_flood_control(dispatcher):
+    """Test if a message hitting the flood control is retried after the time Telegram asks for"""
+    dispatcher.bot.send_message.side_effect = RetryAfter(12)
+    message = OutboxMessage((7, 1007, "key7", "text 7", 9))
+
+    await dispatcher.send(message)
+
+    retry_at = dispatcher.database.mark_outbox_failed.call_args[1]["retry_at"]
+    assert 11 <= (retry_at - dt.now()).total_seconds() <= 12
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.outbox.OUTBOX_MAX_ATTEMPTS", 3)
+async def test_give_up_after_max_attempts(dispatcher):
+    """Test if a message is failed for good once it has used up its attempts"""
+    dispatcher.bot.send_message.side_effect = NetworkError("Timed out")
+
+    await dispatcher.send(OutboxMessage((7, 1007, "key7", "text 7", 3)))
+
+    dispatcher.database.mark_outbox_failed.assert_called_once_with(7, "Timed out")
+
+
+@pytest.mark.asyncio
+async def test_throttle(dispatcher):
+    """Test if the messages are spread out according to the rate limit"""
+    dispatcher.messages_per_second = 20
+    loop = asyncio.get_running_loop()
+
+    start = loop.time()
+    for _ in range(3):
+        await dispatcher._throttle()
+
+    assert loop.time() - start >= 0.1
+
+
+def test_wake_up_on_notification(dispatcher):
+    """Test if the dispatcher is only woken up when there were notifications"""
+    dispatcher.listener = MagicMock()
+    dispatcher.listener.process_outbox_notifications.return_value = 0
+    dispatcher._on_notification()
+    assert not dispatcher._wakeup.is_set()
+
+    dispatcher.listener.process_outbox_notifications.return_value = 2
+    dispatcher._on_notification()
+    assert dispatcher._wakeup.is_set()
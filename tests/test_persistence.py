@@ -0,0 +1,61 @@
+"""Test module to test storing the conversations in the database in the src file"""
+
+# pylint: disable=redefined-outer-name
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.persistence import DatabasePersistence
+
+
+@pytest.fixture
+def sqlite_path(sqlite_db):
+    """Fixture for a SQLite database the persistence connects to"""
+    with patch(
+        "usc_sign_in_bot.persistence.UscDataBase",
+        lambda **kwargs: UscDataBase(backend=sqlite_db.backend, **kwargs),
+    ):
+        yield sqlite_db.backend.path
+
+
+@pytest.mark.asyncio
+async def test_conversations_written_together():
+    """Test if the conversations handed over at once are written in a single transaction"""
+    persistence = DatabasePersistence()
+    persistence.database = MagicMock()
+
+    await asyncio.gather(
+        persistence.update_conversation("sign_up", (1, 1), 0),
+        persistence.update_conversation("sign_up", (2, 2), 1),
+        persistence.update_conversation("sign_up", (3, 3), None),
+    )
+
+    persistence.database.save_conversations.assert_called_once_with(
+        {
+            ("sign_up", "[1, 1]"): "0",
+            ("sign_up", "[2, 2]"): "1",
+            ("sign_up", "[3, 3]"): None,
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_conversations_survive_restart(
+    sqlite_path,
+):  # pylint: disable=unused-argument
+    """Test if a new persistence continues with the conversations stored by the previous one"""
+    persistence = DatabasePersistence()
+    await persistence.update_conversation("sign_up", (1, 1), 0)
+    await persistence.update_conversation("sign_up", (2, 2), 1)
+    await persistence.update_conversation("sign_up", (1, 1), 2)
+    await persistence.flush()
+
+    restarted = DatabasePersistence()
+    assert await restarted.get_conversations("sign_up") == {(1, 1): 2, (2, 2): 1}
+    assert not await restarted.get_conversations("other")
+
+    await restarted.update_conversation("sign_up", (2, 2), None)
+    assert await restarted.get_conversations("sign_up") == {(1, 1): 2}
+    await restarted.flush()
@@ -0,0 +1,96 @@
+"""Test module to test the preferences of the users in the src file"""
+
+from datetime import datetime
+
+import pytest
+
+from usc_sign_in_bot.preferences import PreferenceIndex, parse_preference
+
+# A Monday
+MONDAY = datetime(2024, 12, 2)
+
+
+def lesson(day: int, hour: int, minute: int = 0, trainer: str = "John") -> dict:
+    """Return a lesson on the day of the week at the time"""
+    return {
+        "time": MONDAY.replace(day=MONDAY.day + day, hour=hour, minute=minute),
+        "trainer": trainer,
+    }
+
+
+@pytest.mark.parametrize(
+    "kind, value, stored",
+    [
+        ("day", "Tuesday", "1"),
+        ("day", "sa", "5"),
+        ("time", "8:00 - 9:30", "08:00-09:30"),
+        ("trainer", " Jane Doe ", "Jane Doe"),
+    ],
+)
+def test_parse_preference(kind, value, stored):
+    """Test if the preferences are stored in a single form"""
+    assert parse_preference(kind, value) == stored
+
+
+@pytest.mark.parametrize(
+    "kind, value",
+    [
+        ("day", "t"),
+        ("day", "someday"),
+        ("time", "18:00"),
+        ("time", "21:00-18:00"),
+        ("trainer", " "),
+        ("colour", "red"),
+    ],
+)
+def test_parse_invalid_preference(kind, value):
+    """Test if preferences that do not fit their kind are refused"""
+    with pytest.raises(ValueError):
+        parse_preference(kind, value)
+
+
+def test_users_without_preferences_match_everything():
+    """Test if users without preferences, or without any preferences, match every lesson"""
+    matches = PreferenceIndex([]).matching_users(lesson(0, 18))
+    assert "a" in matches
+
+    matches = PreferenceIndex([("a", "day", "1")]).matching_users(lesson(0, 18))
+    assert "a" not in matches
+    assert "b" in matches
+
+
+def test_every_kind_must_match():
+    """Test if a lesson matches one preference of every kind the user has preferences of"""
+    index = PreferenceIndex(
+        [
+            ("a", "day", "0"),
+            ("a", "day", "2"),
+            ("a", "time", "18:00-20:00"),
+            ("a", "trainer", "john"),
+            ("b", "trainer", "Jane"),
+        ]
+    )
+
+    assert "a" in index.matching_users(lesson(2, 19))
+    assert "a" not in index.matching_users(lesson(1, 19))
+    assert "a" not in index.matching_users(lesson(0, 19, trainer="Jane"))
+    assert "b" in index.matching_users(lesson(1, 8, trainer="jane"))
+    assert "b" not in index.matching_users(lesson(0, 18))
+
+
+def test_time_ranges():
+    """Test if the time ranges include their bounds, also where ranges overlap"""
+    index = PreferenceIndex(
+        [
+            ("a", "time", "18:00-20:00"),
+            ("a", "time", "19:00-21:00"),
+            ("b", "time", "20:00-20:00"),
+        ]
+    )
+
+    assert "a" not in index.matching_users(lesson(0, 17, 59))
+    assert "a" in index.matching_users(lesson(0, 18))
+    assert "a" in index.matching_users(lesson(0, 21))
+    assert "a" not in index.matching_users(lesson(0, 21, 1))
+    assert "b" in index.matching_users(lesson(0, 20))
+    assert "b" not in index.matching_users(lesson(0, 20, 1))
@@ -0,0 +1,174 @@
+"""Test module to test the query statistics in the src file"""
+
+# pylint: disable=redefined-outer-name
+from unittest.mock import ANY, MagicMock, call, patch
+
+import pytest
+
+from usc_sign_in_bot.query_stats import (QUERY_STATS, UNATTRIBUTED, QueryStats,
+                                         TimedCursor)
+
+
+@pytest.fixture
+def stats():
+    """Fixture for statistics that consider every statement slow and explain all of them"""
+    return QueryStats(slow_query_ms=0, explain_sample_rate=1)
+
+
+@pytest.fixture
+def cursor():
+    """Fixture for a cursor that affected two rows"""
+    cursor = MagicMock()
+    cursor.rowcount = 2
+    cursor.connection.autocommit = False
+    explain_cursor = cursor.connection.cursor.return_value.__enter__.return_value
+    explain_cursor.fetchall.return_value = [("Seq Scan on lessons",), ("Buffers: 1",)]
+    cursor.query_plan.side_effect = lambda query, params: TimedCursor.query_plan(
+        cursor, query, params
+    )
+    return cursor
+
+
+def test_measure_collects_round_trips_and_rows(stats, cursor):
+    """Test if the statements within a method are added to the statistics of that method"""
+    with stats.measure("has_received_update"):
+        stats.record_statement(cursor, "UPDATE lessons", None, 0.5)
+        stats.record_statement(cursor, "UPDATE lessons", None, 0.5)
+
+    result = stats.snapshot()["has_received_update"]
+    assert result["calls"] == 1
+    assert result["round_trips"] == 2
+    assert result["rows"] == 4
+    assert result["errors"] == 0
+    assert sum(result["buckets"].values()) == 1
+
+
+def test_measure_counts_errors(stats):
+    """Test if a failing method is counted as an error"""
+    with pytest.raises(ValueError):
+        with stats.measure("get_user"):
+            raise ValueError("User not found")
+
+    assert stats.snapshot()["get_user"]["errors"] == 1
+
+
+def test_unattributed_statement(stats, cursor):
+    """Test if statements outside of a measured method are still counted"""
+    stats.record_statement(cursor, "CREATE TABLE lessons ()", None, 0.5)
+
+    assert stats.snapshot()[UNATTRIBUTED]["round_trips"] == 1
+
+
+def test_histogram_and_percentile():
+    """Test if latencies end up in the right bucket and the percentile is estimated from those"""
+    stats = QueryStats()
+    with patch(
+        "usc_sign_in_bot.query_stats.time.perf_counter", side_effect=[0, 0.0015]
+    ):
+        with stats.measure("get_user"):
+            pass
+
+    result = stats.snapshot()["get_user"]
+    assert result["buckets"][2] == 1
+    assert result["p95_ms"] == 2
+    assert result["max_ms"] == pytest.approx(1.5)
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_slow_select_is_logged_and_explained(mock_warning, stats, cursor):
+    """Test if a slow select is logged without its parameters and with its query plan"""
+    with stats.measure("get_user"):
+        stats.record_statement(
+            cursor, "SELECT *\n  FROM users WHERE user_id = %s", ("secret",), 5
+        )
+
+    # The plan is estimated in a savepoint, such that the statement is not executed again and a
+    # failure does not abort the transaction
+    explain_cursor = cursor.connection.cursor.return_value.__enter__.return_value
+    assert explain_cursor.execute.call_args_list == [
+        call("SAVEPOINT explain_slow_query;"),
+        call("EXPLAIN SELECT *\n  FROM users WHERE user_id = %s", ("secret",)),
+        call("ROLLBACK TO SAVEPOINT explain_slow_query;"),
+        call("RELEASE SAVEPOINT explain_slow_query;"),
+    ]
+
+    mock_warning.assert_any_call(
+        "Slow query in %s took %.1f ms: %s",
+        "get_user",
+        5,
+        "SELECT * FROM users WHERE user_id = %s",
+    )
+    mock_warning.assert_any_call(
+        "Query plan of slow query in %s:\n%s",
+        "get_user",
+        "Seq Scan on lessons\nBuffers: 1",
+    )
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_slow_update_is_not_explained(mock_warning, stats, cursor):
+    """Test if slow writes are not explained"""
+    stats.record_statement(cursor, "UPDATE lessons SET response = %s", ("Y",), 5)
+
+    cursor.connection.cursor.assert_not_called()
+    mock_warning.assert_called_once()
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_select_calling_functions_is_not_explained(mock_warning, stats, cursor):
+    """Test if selects calling functions that might have side effects are not explained"""
+    stats.record_statement(cursor, "SELECT pg_notify(%s, '')", ("usc_outbox",), 5)
+    stats.record_statement(
+        cursor, "SELECT count(*) FROM lessons WHERE lesson_id IN (%s)", ("key",), 5
+    )
+
+    explain_cursor = cursor.connection.cursor.return_value.__enter__.return_value
+    assert explain_cursor.execute.call_args_list[1] == call(
+        "EXPLAIN SELECT count(*) FROM lessons WHERE lesson_id IN (%s)", ("key",)
+    )
+    assert mock_warning.call_count == 3
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_failed_explain_rolls_back_to_savepoint(mock_warning, stats, cursor):
+    """Test if a failed plan is rolled back, such that the transaction of the caller goes on"""
+    explain_cursor = cursor.connection.cursor.return_value.__enter__.return_value
+    explain_cursor.execute.side_effect = [
+        None,
+        RuntimeError("syntax error"),
+        None,
+        None,
+    ]
+
+    stats.record_statement(cursor, "SELECT 1", None, 5)
+
+    assert explain_cursor.execute.call_args_list[2:] == [
+        call("ROLLBACK TO SAVEPOINT explain_slow_query;"),
+        call("RELEASE SAVEPOINT explain_slow_query;"),
+    ]
+    mock_warning.assert_called_with(
+        "Could not explain slow query in %s: %s", UNATTRIBUTED, ANY
+    )
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_fast_query_is_not_logged(mock_warning, cursor):
+    """Test if statements under the threshold are not logged"""
+    QueryStats(slow_query_ms=100).record_statement(cursor, "SELECT 1", None, 5)
+
+    mock_warning.assert_not_called()
+
+
+@patch("usc_sign_in_bot.query_stats.logger.warning")
+def test_slow_select_is_explained_on_sqlite(mock_warning, sqlite_db, monkeypatch):
+    """Test if the plan of a slow select is made with the explain statement of SQLite"""
+    monkeypatch.setattr(QUERY_STATS, "slow_query_ms", 0)
+    monkeypatch.setattr(QUERY_STATS, "explain_sample_rate", 1)
+
+    sqlite_db.cursor.execute("SELECT sport FROM lessons WHERE lesson_id = %s", ("key",))
+
+    mock_warning.assert_any_call(
+        "Query plan of slow query in %s:\n%s", UNATTRIBUTED, ANY
+    )
+    plan = mock_warning.call_args_list[-1].args[2]
+    assert plan.startswith("SEARCH lessons")
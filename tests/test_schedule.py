@@ -0,0 +1,283 @@
+"""Test module to test editing the messages of changed lessons in the src file"""
+
+# pylint: disable=redefined-outer-name
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.models import ScheduledLesson
+from usc_sign_in_bot.schedule import (ScheduleCache, diff_schedule,
+                                      render_edits, update_schedule)
+
+NOW = datetime(2024, 12, 1, 12)
+MONDAY = datetime(2024, 12, 2, 18)
+TUESDAY = datetime(2024, 12, 3, 18)
+
+
+def scraped(time: datetime, trainer: str) -> dict:
+    """Return a lesson as it is scraped"""
+    return {"time": time, "trainer": trainer}
+
+
+def stored(time: datetime, trainer: str) -> ScheduledLesson:
+    """Return a lesson as it is stored from the last scrape"""
+    return ScheduledLesson(("Schermen", time, trainer, NOW))
+
+
+@pytest.fixture
+def sqlite_db(sqlite_db):
+    """Fixture for the SQLite database with a signed up user"""
+    user_id = sqlite_db.insert_user(1234, datetime(2024, 11, 1), "uva")
+    sqlite_db.update_fields("users", user_id, sport="Schermen")
+    return sqlite_db
+
+
+def send(usc_db: UscDataBase, lessons: list[dict], message_id: int) -> list[str]:
+    """Add the lessons for the user in a single message, and send it"""
+    user_id = usc_db.get_user(1234, query_key="telegram_id").user_id
+    with usc_db.transaction():
+        keys = [
+            usc_db.add_to_data(
+                "Schermen", les["time"], user_id, False, trainer=les["trainer"]
+            )
+            for les in lessons
+        ]
+        usc_db.add_to_outbox(1234, " ".join(keys), "Would you like to go?")
+
+    (message,) = usc_db.claim_outbox(10)
+    usc_db.mark_outbox_sent(message.outbox_id, message_id)
+    return keys
+
+
+def test_diff_trainer_changed():
+    """Test if a lesson with another trainer is changed"""
+    changes = diff_schedule(
+        [stored(MONDAY, "John"), stored(TUESDAY, "Jane")],
+        [scraped(MONDAY, "Bob"), scraped(TUESDAY, "Jane")],
+        NOW,
+    )
+    assert changes == [(MONDAY, scraped(MONDAY, "Bob"))]
+
+
+def test_diff_moved_and_cancelled():
+    """Test if a lesson is moved within its day, and cancelled if it is gone from the day"""
+    later = MONDAY + timedelta(hours=1)
+    changes = diff_schedule(
+        [stored(MONDAY, "John"), stored(TUESDAY, "Jane")],
+        [scraped(later, "John"), scraped(TUESDAY + timedelta(days=1), "Jane")],
+        NOW,
+    )
+    assert changes == [(MONDAY, scraped(later, "John")), (TUESDAY, None)]
+
+
+def test_diff_only_scraped_future_lessons():
+    """Test if lessons that are over, or after the new scrape, are not cancelled"""
+    previous = [
+        stored(NOW - timedelta(days=1), "John"),
+        stored(MONDAY, "John"),
+        stored(TUESDAY, "Jane"),
+    ]
+
+    assert not diff_schedule(previous, [scraped(MONDAY, "John")], NOW)
+    assert not diff_schedule(previous, [], NOW)
+
+
+def test_edit_changed_lessons(sqlite_db):
+    """Test if the messages of a changed and a moved lesson are edited, with their buttons"""
+    lessons = [scraped(MONDAY, "John"), scraped(TUESDAY, "Jane")]
+    sqlite_db.save_schedule("Schermen", lessons, NOW)
+    monday = send(sqlite_db, lessons[:1], 98)
+    tuesday = send(sqlite_db, lessons[1:], 99)
+
+    later = TUESDAY + timedelta(hours=1)
+    edited = update_schedule(
+        sqlite_db, "Schermen", [scraped(MONDAY, "Bob"), scraped(later, "Jane")], NOW
+    )
+    assert edited == 2
+
+    edits = sqlite_db.claim_outbox(10)
+    assert [(edit.message_id, edit.lesson_ids) for edit in edits] == [
+        (98, monday),
+        (99, tuesday),
+    ]
+    assert "The trainer is Bob" in edits[0].text
+    assert "at 19:00" in edits[1].text
+    assert json.loads(edits[1].reply_markup)["inline_keyboard"][0][0][
+        "callback_data"
+    ] == (tuesday[0] + ",Y")
+
+    # The moved lesson keeps its key, so it is not asked about again at its new time
+    user_id = sqlite_db.get_user(1234, query_key="telegram_id").user_id
+    assert sqlite_db.has_received_update("Schermen", later, user_id)
+    assert [les.datetime for les in sqlite_db.get_schedule("Schermen")] == [
+        MONDAY,
+        later,
+    ]
+
+
+def test_edit_cancelled_lesson_in_digest(sqlite_db):
+    """Test if a cancelled lesson is marked in its digest, which keeps the other answers"""
+    lessons = [scraped(MONDAY, "John"), scraped(TUESDAY, "Jane")]
+    sqlite_db.save_schedule("Schermen", lessons, NOW)
+    keys = send(sqlite_db, lessons, 99)
+    sqlite_db.claim_lesson_response(keys[1], "N", 1234)
+
+    # Nothing changed, so nothing is edited
+    assert not update_schedule(sqlite_db, "Schermen", lessons, NOW)
+
+    assert update_schedule(sqlite_db, "Schermen", lessons[1:], NOW) == 1
+
+    (edit,) = sqlite_db.claim_outbox(10)
+    assert edit.text == (
+        "There are new fencing lessons:\n"
+        "1. The fencing lesson Monday at 18:00 has been cancelled.\n"
+        "2. Tuesday at 18:00, the trainer is Jane.\n"
+        "Which would you like to go to?\n\n"
+        "We have recorded your choice for lesson 2 as being No. Good luck!"
+    )
+    assert edit.reply_markup is None
+    assert sqlite_db.get_lesson_data_by_key(keys[0]).cancelled is True
+
+
+def test_claim_cancelled_lesson(sqlite_db):
+    """Test if the response to a cancelled lesson is not claimed, so it is not booked"""
+    lessons = [scraped(MONDAY, "John")]
+    sqlite_db.save_schedule("Schermen", lessons, NOW)
+    (key,) = send(sqlite_db, lessons, 99)
+
+    assert update_schedule(sqlite_db, "Schermen", [scraped(TUESDAY, "Jane")], NOW) == 1
+
+    assert sqlite_db.claim_lesson_response(key, "Y", 1234) is None
+    assert sqlite_db.is_lesson_cancelled(key)
+    assert sqlite_db.get_lesson_data_by_key(key).response is None
+
+
+def test_move_onto_lesson_of_user(sqlite_db):
+    """Test if a lesson that can't move onto the lesson the user has there is cancelled"""
+    later = MONDAY + timedelta(hours=1)
+    (moved,) = send(sqlite_db, [scraped(MONDAY, "John")], 98)
+    (kept,) = send(sqlite_db, [scraped(later, "Jane")], 99)
+
+    messages = sqlite_db.change_lesson("Schermen", MONDAY, later, "John")
+
+    assert messages == [(1234, 98)]
+    lesson = sqlite_db.get_lesson_data_by_key(moved)
+    assert (lesson.datetime, lesson.cancelled) == (MONDAY, True)
+    lesson = sqlite_db.get_lesson_data_by_key(kept)
+    assert (lesson.trainer, lesson.cancelled) == ("Jane", False)
+
+    edits = render_edits(sqlite_db, messages)
+    assert [edit[:3] for edit in edits] == [(1234, 98, moved)]
+    assert "has been cancelled" in edits[0][3]
+    assert edits[0][4] is None
+
+
+def test_edit_broadcast(sqlite_db):
+    """Test if the announcement of a moved lesson is edited, and keeps its buttons"""
+    sqlite_db.save_schedule("Schermen", [scraped(MONDAY, "John")], NOW)
+    with sqlite_db.transaction():
+        key = sqlite_db.add_broadcast("Schermen", MONDAY, -100, "John")
+        sqlite_db.add_to_outbox(-100, key, "Would you like to go?")
+    (message,) = sqlite_db.claim_outbox(10)
+    sqlite_db.mark_outbox_sent(message.outbox_id, 42)
+
+    later = MONDAY + timedelta(hours=2)
+    assert update_schedule(sqlite_db, "Schermen", [scraped(later, "John")], NOW) == 1
+
+    (edit,) = sqlite_db.claim_outbox(10)
+    assert (edit.telegram_id, edit.message_id, edit.lesson_id) == (-100, 42, key)
+    assert "at 20:00" in edit.text
+    assert json.loads(edit.reply_markup)["inline_keyboard"][0][0]["callback_data"] == (
+        key + ",Y"
+    )
+    assert sqlite_db.has_broadcast("Schermen", later)
+
+
+def test_empty_scrape_keeps_schedule(sqlite_db):
+    """Test if a scrape without lessons keeps the last scrape, to find the changes after it"""
+    lessons = [scraped(MONDAY, "John"), scraped(TUESDAY, "Jane")]
+    sqlite_db.save_schedule("Schermen", lessons, NOW)
+    (key,) = send(sqlite_db, lessons[:1], 99)
+
+    assert update_schedule(sqlite_db, "Schermen", [], NOW) == 0
+    assert [les.datetime for les in sqlite_db.get_schedule("Schermen")] == [
+        MONDAY,
+        TUESDAY,
+    ]
+
+    # The lesson moved during the failed scrape is still found to have moved
+    later = MONDAY + timedelta(hours=1)
+    assert update_schedule(sqlite_db, "Schermen", [scraped(later, "John")], NOW) == 1
+    assert sqlite_db.get_lesson_data_by_key(key).datetime == later
+
+    # The lessons after the last scraped lesson were not scraped, so they are kept
+    assert [les.datetime for les in sqlite_db.get_schedule("Schermen")] == [
+        later,
+        TUESDAY,
+    ]
+
+
+def test_get_message_lessons_unknown(sqlite_db):
+    """Test if a message that is not known has no lessons"""
+    assert sqlite_db.get_message_lessons(1234, 5) == []
+
+
+def test_schedule_cache():
+    """Test if the lessons are rendered once per day, and read again after the time to live"""
+    clock = [0.0]
+    loads = []
+    lessons = [
+        stored(MONDAY, "John"),
+        stored(MONDAY + timedelta(hours=2), "Jane"),
+        stored(TUESDAY, "Jane"),
+    ]
+    cache = ScheduleCache(ttl=60, clock=lambda: clock[0])
+
+    def load():
+        loads.append(1)
+        return lessons
+
+    message = cache.lessons_message("Schermen", 1, load, today=MONDAY.date())
+    assert message == (
+        "The Schermen lessons of the next 1 days, as found Sunday 01 December at 12:00:\n\n"
+        "Monday 02 December:\n"
+        "18:00, the trainer is John\n"
+        "20:00, the trainer is Jane"
+    )
+    assert "Tuesday 03 December:\n18:00, the trainer is Jane" in cache.lessons_message(
+        "Schermen", 7, load, today=NOW.date()
+    )
+    assert len(loads) == 1
+
+    clock[0] = 61
+    assert cache.lessons_message(
+        "Schermen", 7, load, today=TUESDAY.date() + timedelta(1)
+    ) == ("There are no Schermen lessons in the next 7 days")
+    assert len(loads) == 2
+
+
+def test_schedule_cache_from_database(sqlite_db):
+    """Test if the lessons of the last scrape are listed from the database"""
+    sqlite_db.save_schedule("Schermen", [scraped(MONDAY, "John")], NOW)
+
+    message = ScheduleCache().lessons_message(
+        "Schermen", 7, lambda: sqlite_db.get_schedule("Schermen"), today=NOW.date()
+    )
+    assert message.endswith("Monday 02 December:\n18:00, the trainer is John")
+
+
+def test_schedule_cache_bounded():
+    """Test if the least recently used sport is dropped, and the sports are read once"""
+    cache = ScheduleCache(max_size=2)
+    for sport in ("Schermen", "Roeien", "Schermen", "Tennis"):
+        cache.get_days(sport, list)
+
+    assert len(cache) == 2
+    loads = []
+    cache.get_days("Roeien", lambda: loads.append(1) or [])
+    assert loads == [1]
+
+    assert cache.get_sports(lambda: ["Schermen"]) == ["Schermen"]
+    assert cache.get_sports(lambda: ["Roeien"]) == ["Schermen"]
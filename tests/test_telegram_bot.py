@@ -1,14 +1,20 @@
 """Test module to test the Encryptor module in the src file"""
 
 # pylint: disable=redefined-outer-name
+import asyncio
 import os
+import threading
+from datetime import datetime
 from unittest.mock import ANY, AsyncMock, MagicMock, patch
 
 import pytest
 from telegram import Update
 from telegram.ext import ConversationHandler
 
+from usc_sign_in_bot.messages import digest_markup
+from usc_sign_in_bot.outbox import OUTBOX_BATCH_SIZE
 from usc_sign_in_bot.telegram_bot import TelegramBot
+from usc_sign_in_bot.update_processor import UPDATE_CONCURRENCY
 
 LOGIN_METHOD, USERNAME, PASSWORD, WRAP_UP = range(4)
 
@@ -30,8 +36,45 @@ def bot(mock_builder, mock_db):
     return bot
 
 
+@patch("usc_sign_in_bot.telegram_bot.make_request")
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+@patch("usc_sign_in_bot.telegram_bot.Application.builder")
+def test_shared_request(mock_builder, _, mock_make_request):
+    """Test if the bot makes its calls through a pool of connections for the outbox and updates"""
+    TelegramBot()
+
+    builder = mock_builder.return_value.token.return_value
+    builder.request.assert_called_once_with(mock_make_request.return_value)
+    assert [call.args for call in mock_make_request.call_args_list] == [
+        (OUTBOX_BATCH_SIZE + UPDATE_CONCURRENCY,),
+        (1,),
+    ]
+
+
 @pytest.mark.asyncio
-async def test_start(bot):
+@patch("usc_sign_in_bot.telegram_bot.Encryptor")
+@patch("usc_sign_in_bot.telegram_bot.OutboxDispatcher")
+async def test_post_init_derives_keys(mock_outbox, mock_encryptor, bot, monkeypatch):
+    """Test if the keys are derived at start up in a thread, outside of the event loop"""
+    monkeypatch.setenv("ENCRYPT_KEY", "new_key")
+    monkeypatch.setenv("ENCRYPT_KEY_PREVIOUS", "old_key")
+    mock_outbox.return_value.start = AsyncMock()
+    threads = []
+    mock_encryptor.return_value.derive_keys.side_effect = lambda: threads.append(
+        threading.current_thread()
+    )
+
+    await bot.post_init(MagicMock())
+
+    mock_outbox.return_value.start.assert_awaited_once()
+    mock_encryptor.assert_called_once_with("new_key", "old_key")
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_start(mock_database, bot):
     """Test the start command."""
     update = AsyncMock(spec=Update)
     update.effective_user.id = 1234
@@ -44,6 +87,9 @@ async def test_start(bot):
         "Heyhoy user_1234, Welcome in our service for USC sports. To start, I need some info from "
         + "you. What login method would you like to use? You can try (uva)"
     )
+    mock_database.return_value.update_fields.assert_called_once_with(
+        "users", 1234, key_column="telegram_id", active=True
+    )
     assert result == LOGIN_METHOD
 
 
@@ -71,9 +117,10 @@ async def test_ask_username(mock_database, bot):
 
     result = await bot.ask_username(update, AsyncMock())
 
+    mock_db.transaction.assert_called_once()
     mock_db.insert_user.assert_called_once_with(1234, ANY, "uva")
-    mock_db.edit_data_point.assert_called_once_with(
-        1234, "sport", "Schermen", table="users", key_column="telegram_id"
+    mock_db.update_fields.assert_called_once_with(
+        "users", 1234, key_column="telegram_id", sport="Schermen"
     )
     update.message.reply_html.assert_called_once_with(
         "Because the way this scraper work, we need to be able to log in on your behalf. If you "
@@ -83,6 +130,7 @@ async def test_ask_username(mock_database, bot):
     )
     assert result == USERNAME
 
+
 # @pytest.mark.asyncio
 # @patch("usc_sign_in_bot.telegram_bot.UscDataBase")
 # async def test_ask_sports_valid_method(mock_database, bot):
@@ -224,13 +272,120 @@ async def test_help_command(bot):
     # 1. Verify that reply_text is called with the expected message
     update.message.reply_text.assert_called_once_with(
         "We'll send you updates on all the trainings. You can sign up via the buttons. To stop, "
-        + "use the /cancel command"
+        + "use the /cancel command. To only get the trainings you like, use /prefer day <day>, "
+        + "/prefer time <from>-<to> or /prefer trainer <name>. See them with /preferences and "
+        + "remove them with /unprefer. To see the coming trainings, use /lessons [sport] [days]"
     )
 
     # 2. Verify that the function doesn't return anything
     assert result is None
 
 
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_prefer(mock_db_builder, bot):
+    """Test if a preference is stored as parsed from the arguments of the command"""
+    update = MagicMock()
+    update.effective_user.id = 1234
+    update.message.reply_text = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.add_preference.return_value = True
+
+    await bot.prefer(update, MagicMock(args=["Day", "tue"]))
+
+    mock_db.add_preference.assert_called_once_with(1234, "day", "1")
+    update.message.reply_text.assert_called_once_with(
+        "You will only get the trainings with day Tuesday, next to your other preferences of "
+        + "this kind"
+    )
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_prefer_invalid(mock_db_builder, bot):
+    """Test if an invalid preference is explained and not stored"""
+    update = MagicMock()
+    update.message.reply_text = AsyncMock()
+
+    await bot.prefer(update, MagicMock(args=["time", "21:00-18:00"]))
+    await bot.prefer(update, MagicMock(args=["colour", "red"]))
+
+    mock_db_builder.return_value.add_preference.assert_not_called()
+    assert [call.args[0] for call in update.message.reply_text.call_args_list] == [
+        "The time range 21:00-18:00 ends before it starts",
+        "Please use /prefer day <day>, /prefer time <from>-<to> or /prefer trainer <name>",
+    ]
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_list_and_remove_preferences(mock_db_builder, bot):
+    """Test if the preferences are listed, and removed by kind and value"""
+    update = MagicMock()
+    update.effective_user.id = 1234
+    update.message.reply_text = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.get_user_preferences.return_value = [("day", "0"), ("trainer", "John")]
+    mock_db.remove_preferences.return_value = 1
+
+    await bot.list_preferences(update, MagicMock())
+    await bot.unprefer(update, MagicMock(args=["time", "18:00-21:00"]))
+
+    mock_db.remove_preferences.assert_called_once_with(1234, "time", "18:00-21:00")
+    assert [call.args[0] for call in update.message.reply_text.call_args_list] == [
+        "You get the trainings with:\nday Monday\ntrainer John",
+        "Removed 1 preferences",
+    ]
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_handlers_share_database(mock_db_builder, bot):
+    """Test if the handlers use one connection to the database, closed when the bot stops"""
+    update = MagicMock()
+    update.effective_user.id = 1234
+    update.message.reply_html = AsyncMock()
+    update.message.reply_text = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.get_user_preferences.return_value = []
+
+    await bot.start(update, MagicMock())
+    await bot.ask_password(update, MagicMock())
+    await bot.list_preferences(update, MagicMock())
+    await bot.unprefer(update, MagicMock(args=[]))
+    await bot.post_stop(MagicMock())
+
+    mock_db_builder.assert_called_once_with(create_if_not_exists=False)
+    mock_db.__exit__.assert_called_once_with(None, None, None)
+    assert bot.database is None
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_list_lessons(mock_db_builder, bot):
+    """Test if the lessons are read from the last scrape once, and shared by the users"""
+    update = MagicMock()
+    update.message.reply_text = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.get_schedule_sports.return_value = ["Roeien"]
+    mock_db.get_schedule.return_value = []
+
+    await bot.list_lessons(update, MagicMock(args=["roeien", "30"]))
+    await bot.list_lessons(update, MagicMock(args=["Roeien"]))
+    await bot.list_lessons(update, MagicMock(args=["a"]))
+
+    # The database is opened once, and the sports and lessons are read once
+    mock_db_builder.assert_called_once_with(create_if_not_exists=False)
+    mock_db.get_schedule_sports.assert_called_once_with()
+    mock_db.get_schedule.assert_called_once_with("Roeien")
+    assert len(bot.schedule) == 1
+    assert [call.args[0] for call in update.message.reply_text.call_args_list] == [
+        "There are no Roeien lessons in the next 14 days",
+        "There are no Roeien lessons in the next 7 days",
+        "There are no lessons of a, try one of Schermen, Roeien",
+    ]
+
+
 @pytest.mark.asyncio
 @patch("logging.error")
 @patch("logging.info")
@@ -332,7 +487,7 @@ async def test_error_handler_generic_message_error(mock_error, bot):
 
 
 @pytest.mark.asyncio
-@patch("usc_sign_in_bot.telegram_bot.UscInterface")
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
 @patch("usc_sign_in_bot.telegram_bot.UscDataBase")
 async def test_message_handler_yes_choice(mock_db_builder, mock_usc_interface, bot):
     """Check if hte app works corerctly when a user wants to sign up"""
@@ -347,21 +502,16 @@ async def test_message_handler_yes_choice(mock_db_builder, mock_usc_interface, b
     mock_db = mock_db_builder.return_value
 
     # Mock database behavior
-    mock_db.get_lesson_data_by_key = MagicMock(
+    mock_db.claim_lesson_response = MagicMock(
         return_value={
             "sport": "Basketball",
             "datetime": "2024-09-30 10:00:00",
-            "response": None,
-        }
-    )
-    mock_db.get_user = MagicMock(
-        return_value={
             "username": "user123",
             "password": "password",
             "login_method": "uva",
         }
     )
-    mock_db.edit_data_point = MagicMock()
+    mock_db.get_message_lessons.return_value = []
 
     # Mock the context manager behavior of UscInterface
     mock_usc = mock_usc_interface.return_value
@@ -372,9 +522,10 @@ async def test_message_handler_yes_choice(mock_db_builder, mock_usc_interface, b
     await bot.message_handler(update, MagicMock())
 
     # Assertions:
-    # 1. Ensure the database methods were called with correct arguments
-    mock_db.get_lesson_data_by_key.assert_called_once_with("some_key")
-    mock_db.edit_data_point.assert_called_once_with("some_key", "response", "Y")
+    # 1. Ensure the response is claimed in a single database call
+    mock_db.claim_lesson_response.assert_called_once_with("some_key", "Y", 123456)
+    mock_db.get_lesson_data_by_key.assert_not_called()
+    mock_db.get_user.assert_not_called()
 
     # 2. Ensure the UscInterface was initialized and used correctly
     mock_usc_interface.assert_called_once_with("user123", "password", uva_login=True)
@@ -389,7 +540,7 @@ async def test_message_handler_yes_choice(mock_db_builder, mock_usc_interface, b
 
 
 @pytest.mark.asyncio
-@patch("usc_sign_in_bot.telegram_bot.UscInterface")
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
 @patch("usc_sign_in_bot.telegram_bot.UscDataBase")
 async def test_message_handler_no_choice(mock_db_builder, mock_interface, bot):
     """Check if the app works correctly when a user chooses no"""
@@ -404,22 +555,23 @@ async def test_message_handler_no_choice(mock_db_builder, mock_interface, bot):
 
     # Mock database behavior
     mock_db = mock_db_builder.return_value
-    mock_db.get_lesson_data_by_key = MagicMock(
+    mock_db.claim_lesson_response = MagicMock(
         return_value={
             "sport": "Basketball",
             "datetime": "2024-09-30 10:00:00",
-            "response": None,
+            "username": "user123",
+            "password": None,
+            "login_method": "uva",
         }
     )
-    mock_db.edit_data_point = MagicMock()
+    mock_db.get_message_lessons.return_value = []
 
     # Call the message_handler function
     await bot.message_handler(update, MagicMock())
 
     # Assertions:
     # 1. Ensure the database methods were called with correct arguments
-    mock_db.get_lesson_data_by_key.assert_called_once_with("some_key")
-    mock_db.edit_data_point.assert_called_once_with("some_key", "response", "N")
+    mock_db.claim_lesson_response.assert_called_once_with("some_key", "N", 123456)
 
     # 2. Ensure UscInterface was not called (since choice is 'No')
     # Check that UscInterface is not instantiated or used
@@ -432,7 +584,132 @@ async def test_message_handler_no_choice(mock_db_builder, mock_interface, bot):
 
 
 @pytest.mark.asyncio
-@patch("usc_sign_in_bot.telegram_bot.UscInterface")
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_broadcast(mock_db_builder, bot):
+    """Test if a tap on a broadcast adds the lesson of the user and only tells them"""
+    update = MagicMock()
+    update.effective_user.id = 123456
+    update.callback_query.data = "#broadcast,N"
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.join_broadcast.return_value = "lesson_key"
+    mock_db.claim_lesson_response.return_value = {"password": None}
+
+    await bot.message_handler(update, MagicMock())
+
+    mock_db.join_broadcast.assert_called_once_with("#broadcast", 123456)
+    mock_db.claim_lesson_response.assert_called_once_with("lesson_key", "N", 123456)
+    update.callback_query.answer.assert_called_once_with(
+        "We have recorded your choice as being No. Good luck!"
+    )
+    update.callback_query.edit_message_text.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_broadcast_unknown_user(mock_db_builder, bot):
+    """Test if a user that did not sign up is asked to do so when tapping a broadcast"""
+    update = MagicMock()
+    update.callback_query.data = "#broadcast,Y"
+    update.callback_query.answer = AsyncMock()
+    mock_db = mock_db_builder.return_value
+    mock_db.join_broadcast.return_value = None
+
+    await bot.message_handler(update, MagicMock())
+
+    mock_db.claim_lesson_response.assert_not_called()
+    update.callback_query.answer.assert_called_once_with(ANY, show_alert=True)
+
+
+@pytest.mark.asyncio
+@patch("logging.error")
+async def test_error_handler_group_chat(_, bot):
+    """Test if an error in a group chat is only shown to the user, not edited into the message"""
+    update = MagicMock()
+    update.callback_query.message.chat.type = "supergroup"
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+
+    await bot.error_handler(update, MagicMock())
+
+    update.callback_query.answer.assert_called_once_with(ANY, show_alert=True)
+    update.callback_query.edit_message_text.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_digest(mock_db_builder, bot):
+    """Test if answering a lesson of a digest keeps the buttons of the other lessons"""
+    update = MagicMock()
+    update.effective_user.id = 123456
+    update.callback_query.data = "key2,N"
+    update.callback_query.message.text = "Digest"
+    update.callback_query.message.reply_markup = digest_markup(["key1", "key2", "key3"])
+    update.callback_query.edit_message_text = AsyncMock()
+    mock_db_builder.return_value.claim_lesson_response.return_value = {"password": None}
+    mock_db_builder.return_value.get_message_lessons.return_value = []
+
+    await bot.message_handler(update, MagicMock())
+
+    args, kwargs = update.callback_query.edit_message_text.call_args
+    assert args == (
+        "Digest\n\nWe have recorded your choice for lesson 2 as being No. Good luck!",
+    )
+    rows = kwargs["reply_markup"].inline_keyboard
+    assert [[button.callback_data for button in row] for row in rows] == [
+        ["key1,Y", "key1,N"],
+        ["key3,Y", "key3,N"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_message_handler_digest_concurrent_taps(bot, sqlite_db):
+    """Test if two taps at once on lessons of a digest both show up in the last edit"""
+    user_id = sqlite_db.insert_user(1234, datetime(2024, 11, 1), "uva")
+    with sqlite_db.transaction():
+        keys = [
+            sqlite_db.add_to_data(
+                "Schermen",
+                datetime(2024, 12, day, 18),
+                user_id,
+                False,
+                trainer="John",
+            )
+            for day in (2, 3)
+        ]
+        sqlite_db.add_to_outbox(1234, " ".join(keys), "Digest")
+    (message,) = sqlite_db.claim_outbox(10)
+    sqlite_db.mark_outbox_sent(message.outbox_id, 99)
+
+    edits = []
+
+    async def edit(text, reply_markup=None):
+        # Let the other tap go on while this one is editing
+        await asyncio.sleep(0.01)
+        edits.append((text, reply_markup))
+
+    updates = []
+    for key in keys:
+        update = MagicMock()
+        update.effective_user.id = 1234
+        update.callback_query.data = key + ",N"
+        update.callback_query.message.chat_id = 1234
+        update.callback_query.message.message_id = 99
+        update.callback_query.edit_message_text = edit
+        updates.append(update)
+
+    with patch("usc_sign_in_bot.telegram_bot.UscDataBase", return_value=sqlite_db):
+        await asyncio.gather(*(bot.message_handler(u, MagicMock()) for u in updates))
+
+    text, markup = edits[-1]
+    assert "choice for lesson 1 as being No" in text
+    assert "choice for lesson 2 as being No" in text
+    assert markup is None
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
 @patch("usc_sign_in_bot.telegram_bot.UscDataBase")
 async def test_message_handler_known_choice(mock_db_builder, mock_interface, bot):
     """Tests if it handles a message where the response is allready known"""
@@ -440,17 +717,133 @@ async def test_message_handler_known_choice(mock_db_builder, mock_interface, bot
     update = MagicMock()
     update.effective_user.id = 123456  # Simulate Telegram user ID
     update.callback_query.data = "some_key,Y"
+    update.callback_query.edit_message_text = AsyncMock()
+
+    # Mock database behavior, the claim fails as the response is allready known
+    mock_db = mock_db_builder.return_value
+    mock_db.claim_lesson_response = MagicMock(return_value=None)
+    mock_db.is_lesson_cancelled.return_value = False
+
+    await bot.message_handler(update, MagicMock())
+
+    mock_interface.assert_not_called()
+    update.callback_query.edit_message_text.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_cancelled(mock_db_builder, mock_interface, bot):
+    """Tests if a tap on a lesson that was cancelled is answered, and not booked"""
+    update = MagicMock()
+    update.effective_user.id = 123456
+    update.callback_query.data = "some_key,Y"
+    update.callback_query.answer = AsyncMock()
+
+    mock_db = mock_db_builder.return_value
+    mock_db.claim_lesson_response.return_value = None
+    mock_db.is_lesson_cancelled.return_value = True
+
+    await bot.message_handler(update, MagicMock())
+
+    mock_db.is_lesson_cancelled.assert_called_once_with("some_key")
+    update.callback_query.answer.assert_called_once_with(
+        "This lesson was cancelled", show_alert=True
+    )
+    mock_interface.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_legacy_key(mock_db_builder, mock_interface, bot):
+    """Tests if the legacy key in the buttons of an older message is resolved"""
+    update = MagicMock()
+    update.effective_user.id = 123456
+    update.callback_query.data = "a" * 60 + ",N"
+    update.callback_query.edit_message_text = AsyncMock()
+
+    mock_db = mock_db_builder.return_value
+    mock_db.resolve_lesson_key.return_value = "compact_key"
+    mock_db.claim_lesson_response = MagicMock(return_value=None)
+    mock_db.is_lesson_cancelled.return_value = False
+
+    await bot.message_handler(update, MagicMock())
+
+    mock_db.resolve_lesson_key.assert_called_once_with("a" * 60)
+    mock_db.claim_lesson_response.assert_called_once_with("compact_key", "N", 123456)
+    mock_interface.assert_not_called()
+
+
+def test_run_polling(bot):
+    """Test if polling only asks for the updates the bot handles"""
+    bot.app = MagicMock()
+
+    bot.run()
+
+    bot.app.run_polling.assert_called_once_with(
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY]
+    )
+    bot.app.run_webhook.assert_not_called()
+
+
+@patch("usc_sign_in_bot.telegram_bot.WEBHOOK_SECRET", "secret")
+@patch("usc_sign_in_bot.telegram_bot.WEBHOOK_URL", "https://bot.example.com/")
+@patch("usc_sign_in_bot.telegram_bot.TELEGRAM_MODE", "webhook")
+def test_run_webhook(bot):
+    """Test if the webhook mode serves the updates on the configured URL"""
+    bot.app = MagicMock()
+
+    bot.run()
+
+    bot.app.run_webhook.assert_called_once_with(
+        listen="0.0.0.0",
+        port=8443,
+        url_path="telegram",
+        webhook_url="https://bot.example.com/telegram",
+        secret_token="secret",
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+    )
+    bot.app.run_polling.assert_not_called()
+
+
+@patch("usc_sign_in_bot.telegram_bot.WEBHOOK_URL", None)
+@patch("usc_sign_in_bot.telegram_bot.TELEGRAM_MODE", "webhook")
+def test_run_webhook_without_url(bot):
+    """Test if the webhook mode refuses to start without a public URL"""
+    with pytest.raises(ValueError):
+        bot.run()
+
+
+@pytest.mark.asyncio
+@patch("usc_sign_in_bot.usc_interface.UscInterface")
+@patch("usc_sign_in_bot.telegram_bot.UscDataBase")
+async def test_message_handler_double_tap(mock_db_builder, mock_usc_interface, bot):
+    """Tests if a double tap on yes books the lesson only once"""
+    updates = []
+    for _ in range(2):
+        update = MagicMock()
+        update.effective_user.id = 123456
+        update.callback_query.data = "some_key,Y"
+        update.callback_query.message.text = "Initial message"
+        update.callback_query.edit_message_text = AsyncMock()
+        updates.append(update)
 
-    # Mock database behavior
     mock_db = mock_db_builder.return_value
-    mock_db.get_lesson_data_by_key = MagicMock(
+    mock_db.claim_lesson_response = MagicMock(
         return_value={
             "sport": "Basketball",
             "datetime": "2024-09-30 10:00:00",
-            "response": "Y",
+            "username": "user123",
+            "password": "password",
+            "login_method": "uva",
         }
     )
-    await bot.message_handler(update, MagicMock())
+    mock_db.get_message_lessons.return_value = []
 
-    mock_interface.assert_not_called()
-    mock_db.edit_data_point.assert_not_called()
+    await asyncio.gather(*(bot.message_handler(u, MagicMock()) for u in updates))
+
+    mock_db.claim_lesson_response.assert_called_once_with("some_key", "Y", 123456)
+    mock_usc_interface.assert_called_once()
+    updates[0].callback_query.edit_message_text.assert_called_once()
+    updates[1].callback_query.edit_message_text.assert_not_called()
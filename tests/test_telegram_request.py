@@ -0,0 +1,24 @@
+"""Test module to test the connections to the Telegram Bot API in the src file"""
+
+import pytest
+
+from usc_sign_in_bot.telegram_request import make_request
+
+
+@pytest.mark.asyncio
+async def test_make_request():
+    """Test if the calls share a pool of kept-alive HTTP/2 connections, with the timeouts"""
+    request = make_request(20)
+    await request.initialize()
+
+    try:
+        # pylint: disable=protected-access
+        kwargs = request._client_kwargs
+        assert kwargs["http2"] and not kwargs["http1"]
+        assert kwargs["limits"].max_connections == 20
+        assert kwargs["limits"].max_keepalive_connections == 20
+        assert kwargs["limits"].keepalive_expiry == 60
+        assert kwargs["timeout"].connect == 5
+        assert request.read_timeout == 10
+    finally:
+        await request.shutdown()
@@ -0,0 +1,132 @@
+"""Test module to test the processing of updates per user in the src file"""
+
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from telegram import Update
+
+from usc_sign_in_bot.update_processor import PerUserUpdateProcessor
+
+
+def user_update(user_id: int | None) -> MagicMock:
+    """Return an update from the user with the id, or from no user at all"""
+    update = MagicMock(spec=Update)
+    update.effective_user = None if user_id is None else MagicMock(id=user_id)
+    update.effective_chat = None
+    update.callback_query = None
+    return update
+
+
+async def step(log: list, name: str, delay: float = 0.01) -> None:
+    """Log the start and end of a step of an update, which takes the delay"""
+    log.append(f"start {name}")
+    await asyncio.sleep(delay)
+    log.append(f"end {name}")
+
+
+@pytest.mark.asyncio
+async def test_same_user_in_order():
+    """Test if the updates of a user are processed one by one, in the order they arrived"""
+    processor = PerUserUpdateProcessor(4)
+    log = []
+
+    await asyncio.gather(
+        processor.process_update(user_update(1), step(log, "username", 0.02)),
+        processor.process_update(user_update(1), step(log, "password")),
+    )
+
+    assert log == ["start username", "end username", "start password", "end password"]
+    assert not processor._queues  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_other_users_concurrently():
+    """Test if the updates of other users don't wait for a slow update"""
+    processor = PerUserUpdateProcessor(4)
+    log = []
+
+    await asyncio.gather(
+        processor.process_update(user_update(1), step(log, "booking", 0.05)),
+        processor.process_update(user_update(2), step(log, "start")),
+        processor.process_update(user_update(None), step(log, "other")),
+    )
+
+    assert log.index("end start") < log.index("end booking")
+    assert log.index("end other") < log.index("end booking")
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    """Test if no more updates than the limit are processed at the same time"""
+    processor = PerUserUpdateProcessor(2)
+    running = []
+    peak = 0
+
+    async def track():
+        nonlocal peak
+        running.append(1)
+        peak = max(peak, len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    await asyncio.gather(
+        *(processor.process_update(user_update(i), track()) for i in range(6))
+    )
+
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_callback_queries_not_serialized():
+    """Test if a tap on a button does not wait for the other updates of the user"""
+    processor = PerUserUpdateProcessor(4)
+    tap = user_update(1)
+    tap.callback_query = MagicMock()
+    log = []
+
+    await asyncio.gather(
+        processor.process_update(user_update(1), step(log, "username", 0.05)),
+        processor.process_update(tap, step(log, "tap")),
+    )
+
+    assert log.index("end tap") < log.index("end username")
+
+
+@pytest.mark.asyncio
+async def test_flooding_user_takes_one_place():
+    """Test if a user sending many updates at once doesn't hold up the updates of another user"""
+    processor = PerUserUpdateProcessor(2)
+    log = []
+
+    flood = [
+        processor.process_update(user_update(1), step(log, f"flood {i}"))
+        for i in range(4)
+    ]
+    await asyncio.gather(
+        *flood,
+        processor.process_update(user_update(2), step(log, "other")),
+    )
+
+    assert log.index("start other") < log.index("end flood 0")
+    assert [entry for entry in log if entry.startswith("end flood")] == [
+        f"end flood {i}" for i in range(4)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_failed_update_does_not_stop_the_next():
+    """Test if the updates queued after an update that fails are still processed"""
+    processor = PerUserUpdateProcessor(2)
+    log = []
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("Handler failed")
+
+    await asyncio.gather(
+        processor.process_update(user_update(1), fail()),
+        processor.process_update(user_update(1), step(log, "next")),
+    )
+
+    assert log == ["start next", "end next"]
@@ -1,10 +1,10 @@
 # pylint: disable=redefined-outer-name, protected-access
 """Define tests for the usc bot job in this module"""
+
 from datetime import datetime as dt
-from unittest.mock import ANY, AsyncMock, MagicMock, patch
+from unittest.mock import MagicMock, patch
 
 import pytest
-from telegram.error import Forbidden
 
 from usc_sign_in_bot.usc_bot import main
 
@@ -26,56 +26,143 @@ def mock_usc():
     return usc_mock
 
 
-@pytest.fixture
-def mock_application():
-    """Mock the Telegram bot application."""
-    app_mock = MagicMock()
-    app_mock.bot.send_message = AsyncMock()
-    return app_mock
-
-
 @pytest.fixture
 def mock_db():
     """Mock the database object (usc_db)."""
     db_mock = MagicMock()
-    db_mock.get_all_users_in_sport.return_value = [
-        {"user_id": 1, "telegram_id": 1001},
-        {"user_id": 2, "telegram_id": 1002},
-    ]
+    db_mock.iter_users_in_sport.return_value = iter(
+        [
+            {"user_id": 1, "telegram_id": 1001},
+            {"user_id": 2, "telegram_id": 1002},
+        ]
+    )
     db_mock.has_received_update.return_value = False
     db_mock.add_to_data.return_value = "key123"
     return db_mock
 
 
-@pytest.mark.asyncio
-async def test_send_messages(mock_application, mock_usc, mock_db):
-    """Test that messages are sent to users."""
-    await main(mock_application, mock_usc, mock_db)
+def test_add_messages_to_outbox(mock_usc, mock_db):
+    """Test that a message is put in the outbox for every user and lesson."""
+    main(mock_usc, mock_db)
 
-    assert mock_application.bot.send_message.call_count == 4
-    mock_application.bot.send_message.assert_called_with(
+    assert mock_db.add_to_outbox.call_count == 4
+    mock_db.add_to_outbox.assert_called_with(
         1002,
+        "key123",
         "There is a fencing lesson Friday at 20:00. The trainer is Doe John. Would you like to go?",
-        reply_markup=ANY,
     )
+    mock_db.get_all_users_in_sport.assert_not_called()
 
 
-@pytest.mark.asyncio
-async def test_skip_if_received_update(mock_application, mock_usc, mock_db):
+def test_lesson_and_message_in_one_transaction(mock_usc, mock_db):
+    """Test that the lesson and its message are added within a single transaction."""
+    calls = []
+    transaction = mock_db.transaction.return_value
+    transaction.__enter__.side_effect = lambda: calls.append("begin")
+    transaction.__exit__.side_effect = lambda *_: calls.append("commit")
+    mock_db.add_to_data.side_effect = lambda *_, **__: calls.append("lesson") or "key"
+    mock_db.add_to_outbox.side_effect = lambda *_: calls.append("message")
+
+    main(mock_usc, mock_db)
+
+    assert calls == ["begin", "lesson", "message", "commit"] * 4
+
+
+def test_skip_if_received_update(mock_usc, mock_db):
     """Test that messages are skipped if the user has already received updates."""
     # Set has_received_update to return True to simulate users who already received an update
     mock_db.has_received_update.return_value = True
-    await main(mock_application, mock_usc, mock_db)
+    main(mock_usc, mock_db)
+
+    mock_db.add_to_data.assert_not_called()
+    mock_db.add_to_outbox.assert_not_called()
 
-    mock_application.bot.send_message.assert_not_called()
 
+def test_only_preferred_lessons(mock_usc, mock_db):
+    """Test that users with preferences are only asked about the lessons matching them."""
+    mock_db.get_preferences.return_value = [(1, "day", "4"), (3, "trainer", "John Doe")]
 
-@pytest.mark.asyncio
-@patch("usc_sign_in_bot.usc_bot.logger.error")
-async def test_handle_forbidden_error(mock_logger, mock_application, mock_usc, mock_db):
-    """Test that Forbidden errors are logged and the process continues."""
-    # Simulate a Forbidden error when trying to send a message
-    mock_application.bot.send_message.side_effect = Forbidden("User blocked the bot")
+    main(mock_usc, mock_db)
+
+    mock_db.get_preferences.assert_called_once_with("Schermen")
+    assert [call.args[0] for call in mock_db.add_to_outbox.call_args_list] == [
+        1001,
+        1002,
+        1002,
+    ]
+    assert "Friday" in mock_db.add_to_outbox.call_args_list[0].args[2]
+
+
+def test_digest(mock_usc, mock_db):
+    """Test that every user gets a single digest asking about all the new lessons."""
+    mock_db.add_to_data.side_effect = ["key1", "key2", "key3", "key4"]
+
+    main(mock_usc, mock_db, mode="digest")
+
+    assert mock_db.add_to_data.call_count == 4
+    assert mock_db.add_to_outbox.call_count == 2
+    mock_db.add_to_outbox.assert_called_with(
+        1002,
+        "key3 key4",
+        "There are new fencing lessons:\n"
+        "1. Tuesday at 18:00, the trainer is John Doe.\n"
+        "2. Friday at 20:00, the trainer is Doe John.\n"
+        "Which would you like to go to?",
+    )
 
-    await main(mock_application, mock_usc, mock_db)
-    assert mock_logger.call_count == 4
+
+def test_digest_skips_received_lessons(mock_usc, mock_db):
+    """Test that a digest only holds the lessons the user has not been asked about."""
+    mock_db.has_received_update.side_effect = lambda _, time, __: time.day == 17
+
+    main(mock_usc, mock_db, mode="digest")
+
+    assert mock_db.add_to_outbox.call_count == 2
+    assert "1. Friday at 20:00" in mock_db.add_to_outbox.call_args.args[2]
+
+
+def test_unknown_mode(mock_usc, mock_db):
+    """Test that an unknown notification mode is refused."""
+    with pytest.raises(ValueError):
+        main(mock_usc, mock_db, mode="carrier pigeon")
+
+
+@patch.dict("usc_sign_in_bot.usc_bot.BROADCAST_CHATS", {"Schermen": -100})
+def test_broadcast(mock_usc, mock_db):
+    """Test that every lesson is announced once in the group chat, not to every user."""
+    mock_db.has_broadcast.side_effect = [True, False]
+    mock_db.add_broadcast.return_value = "#key"
+
+    main(mock_usc, mock_db, mode="group")
+
+    mock_db.iter_users_in_sport.assert_not_called()
+    mock_db.add_broadcast.assert_called_once_with(
+        "Schermen", dt(2024, 9, 20, 20), -100, trainer="Doe John"
+    )
+    mock_db.add_to_outbox.assert_called_once_with(
+        -100,
+        "#key",
+        "There is a fencing lesson Friday at 20:00. The trainer is Doe John. Would you like to go?",
+    )
+
+
+@patch.dict("usc_sign_in_bot.usc_bot.BROADCAST_CHATS", {}, clear=True)
+def test_broadcast_without_chat(mock_usc, mock_db):
+    """Test that broadcasting needs a group chat for the sport."""
+    with pytest.raises(ValueError):
+        main(mock_usc, mock_db, mode="group")
+
+
+@patch("usc_sign_in_bot.usc_bot.update_schedule")
+def test_update_schedule_first(mock_update_schedule, mock_usc, mock_db):
+    """Test that the changed lessons are handled before the new lessons are added."""
+    mock_update_schedule.side_effect = (
+        lambda *_: mock_db.add_to_data.assert_not_called()
+    )
+
+    main(mock_usc, mock_db)
+
+    mock_update_schedule.assert_called_once_with(
+        mock_db, "Schermen", mock_usc.get_all_lessons.return_value
+    )
+    assert mock_db.add_to_data.call_count == 4
@@ -1,5 +1,24 @@
 """Initiation file for package with imports"""
 
-from usc_sign_in_bot.db_helpers import UscDataBase
-from usc_sign_in_bot.encryptor import Encryptor
-from usc_sign_in_bot.usc_interface import UscInterface
+import importlib
+
+# The classes of the package by the module they are in. They are only imported when they are
+# first used, such that each mode of the bot only loads what it needs. Especially the
+# `UscInterface` is heavy, as it loads selenium
+_LAZY_IMPORTS = {
+    "UscDataBase": "usc_sign_in_bot.db_helpers",
+    "Encryptor": "usc_sign_in_bot.encryptor",
+    "UscInterface": "usc_sign_in_bot.usc_interface",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name: str):
+    """Import the classes of the package when they are first used"""
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    globals()[name] = value
+    return value
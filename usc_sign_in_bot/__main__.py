@@ -1,25 +1,49 @@
 """Main of the module, mainly used to point to the right script"""
 
+# Every mode imports only the modules it needs, such that e.g. the bot doesn't load selenium
+# pylint: disable=import-outside-toplevel
 import sys
 
-from usc_sign_in_bot.telegram_bot import TelegramBot
-from usc_sign_in_bot.usc_bot import start_bot_job
+MODES = ("bot", "job", "dispatch", "maintenance", "rotate-keys")
 
 
 def main() -> None:
     """main function for this script, points into the right direction for the givenmode"""
     if len(sys.argv) != 2:
-        raise ValueError("Please give a valid mode, bot or job")
+        raise ValueError(
+            "Please give a valid mode, bot, job, dispatch, maintenance or rotate-keys"
+        )
 
-    if sys.argv[1] not in ("bot", "job"):
+    if sys.argv[1] not in MODES:
         raise ValueError("Unknown input")
 
     if sys.argv[1] == "bot":
+        from usc_sign_in_bot.telegram_bot import TelegramBot
+
         TelegramBot()
 
     elif sys.argv[1] == "job":
+        from usc_sign_in_bot.usc_bot import start_bot_job
+
         start_bot_job()
 
+    elif sys.argv[1] == "dispatch":
+        import asyncio
+
+        from usc_sign_in_bot.outbox import run_dispatcher
+
+        asyncio.run(run_dispatcher())
+
+    elif sys.argv[1] == "maintenance":
+        from usc_sign_in_bot.maintenance import run_maintenance
+
+        run_maintenance()
+
+    elif sys.argv[1] == "rotate-keys":
+        from usc_sign_in_bot.key_rotation import run_key_rotation
+
+        run_key_rotation()
+
 
 if __name__ == "__main__":
     main()
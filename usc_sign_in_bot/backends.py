@@ -0,0 +1,159 @@
+"""Hold the storage backends the database can run on in this module"""
+
+import functools
+import os
+import sqlite3
+import time
+from datetime import datetime as dt
+
+import psycopg2
+from psycopg2.errors import UniqueViolation
+
+from usc_sign_in_bot.query_stats import QUERY_STATS, TimedCursor
+
+# The backend to store the data in, either postgres or sqlite
+DATABASE_BACKEND = os.environ.get("DATABASE_BACKEND", "postgres")
+
+# The file the SQLite database is stored in
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "usc.db")
+
+# Store timestamps as ISO text in SQLite, and turn them back into datetimes when read
+sqlite3.register_adapter(dt, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: dt.fromisoformat(value.decode()))
+
+
+class PostgresBackend:
+    """
+    Store the data in a separate Postgres server, the default backend.
+
+    This backend supports everything: notifications between processes, partitioned lessons and
+    several dispatchers sending from the same outbox.
+    """
+
+    name = "postgres"
+    init_script = "init.sql"
+
+    # The error raised when a unique constraint is violated
+    unique_violation = UniqueViolation
+
+    # Claimed rows are locked, and rows locked by another dispatcher are skipped
+    row_lock = "FOR UPDATE SKIP LOCKED"
+
+    supports_notify = True
+    supports_partitions = True
+    supports_writable_ctes = True
+    supports_returning_joins = True
+
+    @staticmethod
+    def connect() -> psycopg2.extensions.connection:
+        """Open a new connection to the database"""
+        return psycopg2.connect(
+            dbname=os.environ.get("POSTGRES_DB", "usc_db"),
+            user=os.environ.get("POSTGRES_USER"),
+            password=os.environ.get("POSTGRES_PASSWORD"),
+            host=os.environ.get("POSTGRES_HOST", "localhost"),
+            port=int(os.environ.get("POSTGRES_PORT", 5432)),
+        )
+
+    @staticmethod
+    def cursor(conn, name: str = None) -> TimedCursor:
+        """Return a measured cursor, a server-side cursor if it is given a name"""
+        if name is None:
+            return conn.cursor(cursor_factory=TimedCursor)
+
+        # Hold the cursor open over commits, such that the caller can commit while iterating
+        return conn.cursor(name=name, withhold=True, cursor_factory=TimedCursor)
+
+
+@functools.lru_cache(maxsize=256)
+def _translate(query: str) -> str:
+    """Turn the `%s` placeholders into the `?` placeholders of SQLite"""
+    return query.replace("%s", "?")
+
+
+# pylint: disable=too-few-public-methods
+class SqliteCursor(sqlite3.Cursor):
+    """Cursor taking the queries written for Postgres, and reporting them to `QUERY_STATS`"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(_translate(sql), parameters or ())
+        finally:
+            QUERY_STATS.record_statement(
+                self, sql, parameters, (time.perf_counter() - start) * 1000
+            )
+
+    def query_plan(self, sql, parameters=()) -> str:
+        """Return the plan SQLite estimates for a statement with `EXPLAIN QUERY PLAN`"""
+        # The connection executes the plan on a plain cursor, such that it is not measured itself
+        rows = self.connection.execute(
+            "EXPLAIN QUERY PLAN " + _translate(sql), parameters or ()
+        ).fetchall()
+        return "\n".join(row[3] for row in rows)
+
+
+class SqliteBackend:
+    """
+    Store the data in an embedded SQLite database, for single-node installs and benchmarks.
+
+    The database is opened in WAL mode, such that the bot can read while the job is writing.
+    Statements are prepared once per connection and reused from the statement cache of SQLite, as
+    the queries are always the same text with different parameters.
+
+    SQLite has no notifications, so the outbox is polled instead, and no partitions, so lessons are
+    kept in a single table. Writes lock the whole database, so there is no need to skip locked rows.
+    Statements that Postgres does in one round trip are split up where SQLite does not support them,
+    which costs little as there is no network in between.
+
+    Parameters
+    ----------
+    path : str, optional
+        The file to store the database in, or ":memory:" for a database that is not stored.
+    """
+
+    name = "sqlite"
+    init_script = "init_sqlite.sql"
+    unique_violation = sqlite3.IntegrityError
+    row_lock = ""
+    supports_notify = False
+    supports_partitions = False
+    supports_writable_ctes = False
+    supports_returning_joins = False
+
+    def __init__(self, path: str = None):
+        self.path = path or SQLITE_PATH
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection to the database"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=10,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=256,
+        )
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+
+        # Notifications are not needed with a single node, so sending them does nothing
+        conn.create_function("pg_notify", 2, lambda channel, payload: None)
+
+        return conn
+
+    # pylint: disable=unused-argument
+    @staticmethod
+    def cursor(conn, name: str = None) -> SqliteCursor:
+        """Return a measured cursor, SQLite cursors always fetch their rows lazily"""
+        return conn.cursor(factory=SqliteCursor)
+
+
+def get_backend(name: str = None) -> PostgresBackend | SqliteBackend:
+    """Return the backend with the given name, defaults to `DATABASE_BACKEND`"""
+    name = name or DATABASE_BACKEND
+
+    if name == "postgres":
+        return PostgresBackend()
+    if name == "sqlite":
+        return SqliteBackend()
+
+    raise ValueError(f"Unknown database backend {name}")
@@ -1,53 +1,112 @@
+# pylint: disable=too-many-lines
 """In here, define functionsn to help with the sqlite tasks of the program"""
 
+import functools
+import gzip
+import itertools
 import logging
 import os
 import traceback
 from asyncio import streams
+from contextlib import contextmanager
 from datetime import datetime as dt
+from datetime import timedelta
+from typing import Iterator
 
-import psycopg2
-from psycopg2.errors import UniqueViolation
-
-from usc_sign_in_bot.encryptor import Encryptor
+from usc_sign_in_bot.backends import (PostgresBackend, SqliteBackend,
+                                      get_backend)
+from usc_sign_in_bot.encryptor import LEGACY_HASH_KEY_LENGTH, Encryptor
+from usc_sign_in_bot.models import (LESSON_ID_SEPARATOR, Lesson, Notification,
+                                    OutboxMessage, ScheduledLesson, User)
+from usc_sign_in_bot.query_stats import QUERY_STATS
 
 logger = logging.getLogger(__name__)
 
+# Column names can not be passed as query parameters, so only the columns listed here can be written
+# with `update_fields`. The key columns are the columns a record can be looked up by.
+UPDATABLE_COLUMNS = {
+    "users": ("login_method", "sport", "username", "password", "active"),
+    "lessons": ("message_sent", "response", "trainer"),
+}
+KEY_COLUMNS = {
+    "users": ("user_id", "telegram_id"),
+    "lessons": ("lesson_id",),
+}
+
+# The columns of a user that are needed to send them a message
+SUBSCRIBER_COLUMNS = ("user_id", "telegram_id")
+
+# Server-side cursors need a name that is unique within the connection
+_cursor_names = itertools.count()
+
+# Monthly partitions of the lessons table are named after the month they hold
+LESSON_PARTITION_FORMAT = "lessons_%Y_%m"
+
+# Channel used to wake up the bot when the job has added messages to the outbox
+OUTBOX_CHANNEL = "usc_outbox"
+
+# Lessons are looked up by their key together with their datetime from `lesson_keys`, such that
+# Postgres only reads the partition of the lesson instead of every partition. The condition takes
+# the key as parameter twice
+LESSON_BY_KEY = (
+    "lesson_id = %s AND datetime = "
+    + "(SELECT k.datetime FROM lesson_keys AS k WHERE k.lesson_id = %s)"
+)
+
+# The tables with rows of a user, with the columns that tell the rows of a single user apart
+USER_ROWS = {"lessons": ("sport", "datetime"), "preferences": ("kind", "value")}
+
+# The number of keys tried for a new lesson or broadcast. A key is only taken when a lesson moved
+# away from the time of the new one, so the second key is free in practice
+KEY_ATTEMPTS = 10
+
 
 def rollback_on_error(method):
-    """Define wraper to rollback and log error in case of error in database connect function"""
+    """
+    Define wraper to rollback and log error in case of error in database connect function. The
+    wrapper also measures the latency, round trips and rows of every call in `QUERY_STATS`.
+    """
 
+    @functools.wraps(method)
     def wrapper(self, *args, **kwargs) -> any:
         try:
-            return method(self, *args, **kwargs)
+            with QUERY_STATS.measure(method.__name__):
+                return method(self, *args, **kwargs)
 
         except Exception as error:
-            self.conn.rollback()
+            # Within a transaction the rollback is left to the transaction itself, such that all
+            # earlier statements of the transaction are undone as well
+            if not self.in_transaction:
+                self.rollback()
             logger.error("Error in %s: %s", method.__name__, traceback.format_exc())
             raise error
 
     return wrapper
 
 
+# pylint: disable=too-many-public-methods, too-many-instance-attributes
 class UscDataBase:
     """Make a connection to the USC database and hold functions to fix it"""
 
-    def __init__(self, create_if_not_exists: bool = True):
-        self.conn = psycopg2.connect(
-            dbname=os.environ.get("POSTGRES_DB", "usc_db"),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            host=os.environ.get("POSTGRES_HOST", "localhost"),
-            port=int(os.environ.get("POSTGRES_PORT", 5432)),
+    def __init__(
+        self,
+        create_if_not_exists: bool = True,
+        backend: PostgresBackend | SqliteBackend = None,
+    ):
+        # Store the data in Postgres, or in SQLite for single-node installs
+        self.backend = backend or get_backend()
+        self.conn = self.backend.connect()
+        self.cursor = self.backend.cursor(self.conn)
+        self.encrypt = Encryptor(
+            os.environ.get("ENCRYPT_KEY"), os.environ.get("ENCRYPT_KEY_PREVIOUS")
         )
-        self.cursor = self.conn.cursor()
-        self.encrypt = Encryptor(os.environ.get("ENCRYPT_KEY"))
+        self._transaction_depth = 0
 
         # Don't continue checking if the database exists if it's not wanted
         if not create_if_not_exists:
             return
 
-        with open("init.sql", "r", encoding="UTF-8") as file:
+        with open(self.backend.init_script, "r", encoding="UTF-8") as file:
             init_query = file.read()
 
         self._multiple_query(init_query)
@@ -65,6 +124,77 @@ class UscDataBase:
         if self.conn:
             self.conn.close()
 
+    @property
+    def in_transaction(self) -> bool:
+        """Whether the database is currently within a `transaction` block"""
+        return self._transaction_depth > 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several operations into one database transaction with a single commit.
+
+        All methods called within the block skip their own commit. The changes are committed once
+        when the block is left, or rolled back entirely if an error occurs within the block. Nested
+        blocks join the outer transaction.
+
+        Yields
+        ------
+        UscDataBase
+            The database object itself, for convenience.
+
+        Examples
+        --------
+        >>> with database.transaction():
+        ...     database.insert_user(telegram_id, dt.now(), "uva")
+        ...     database.update_fields("users", telegram_id, key_column="telegram_id", sport="X")
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+
+        except Exception:
+            # Only the outermost block ends the transaction
+            if self._transaction_depth == 1:
+                self.rollback()
+            raise
+
+        else:
+            if self._transaction_depth == 1:
+                self.conn.commit()
+
+        finally:
+            self._transaction_depth -= 1
+
+    def _commit(self) -> None:
+        """Commit the changes, unless a transaction is open which will commit them at its end"""
+        if not self.in_transaction:
+            self.conn.commit()
+
+    def rollback(self) -> None:
+        """Roll back all the changes made since the last commit"""
+        self.conn.rollback()
+
+    def listen_for_outbox(self) -> None:
+        """
+        Listen on this connection for messages added to the outbox by other processes.
+
+        The connection is switched to autocommit, such that notifications are received while the
+        connection is idle. Call `process_outbox_notifications` whenever the connection becomes
+        readable.
+        """
+        self.conn.autocommit = True
+        self.cursor.execute(f"LISTEN {OUTBOX_CHANNEL};")
+
+    def process_outbox_notifications(self) -> int:
+        """Consume the pending notifications about the outbox, return the count"""
+        self.conn.poll()
+
+        count = len(self.conn.notifies)
+        self.conn.notifies.clear()
+
+        return count
+
     def _multiple_query(self, query: str) -> None:
         """Execute a query with multiple statements"""
         # Execute some scripts to make sure the table is in there
@@ -102,13 +232,19 @@ class UscDataBase:
         Returns
         -------
         str
-            The unique `user_id` generated for the user.
+            The unique `user_id` generated for the user, or the `user_id` the user already has if
+            the user signed up before.
         """
         # Create the user idea as a hash of the telegram ID, we could of course use the telegram
         # id, but because we might want to use the user_id for sending it away later on we don't
         # want to send the telegram_id in the message to everyone
         user_id = self.encrypt.generate_hash_key(str(telegram_id))
 
+        # In a transaction, a failing insert should not undo the earlier statements. Guard it with a
+        # savepoint such that only the insert itself can be rolled back.
+        if self.in_transaction:
+            self.cursor.execute("SAVEPOINT insert_user")
+
         try:
             self.cursor.execute(
                 """
@@ -119,14 +255,26 @@ class UscDataBase:
             )
 
             # Commit the changes to the database
-            self.conn.commit()
+            self._commit()
 
             return user_id
 
-        # If the user allready exists, return the user_id
-        except UniqueViolation:
+        # If the user allready exists, return the user_id it has. Users who signed up before the
+        # compact keys still have their legacy key until the keys are compacted
+        except self.backend.unique_violation:
+            if self.in_transaction:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT insert_user")
+            else:
+                self.conn.rollback()
+
+            self.cursor.execute(
+                "SELECT user_id FROM users WHERE telegram_id = %s;", (telegram_id,)
+            )
+            row = self.cursor.fetchone()
+            if row:
+                user_id = row[0]
+
             logger.warning("User %s allready exists.", user_id)
-            self.conn.rollback()
             return user_id
 
     # pylint: disable=too-many-positional-arguments
@@ -175,7 +323,9 @@ class UscDataBase:
         """
         # Generate a hash key based on sport and datetime. This combination should be unique. This
         # is done such that we don't have any key colissions as well as unsafe indenting keys
-        key = self.encrypt.generate_hash_key(f"{sport}{daytime.isoformat()}{user_id}")
+        key = self._reserve_lesson_key(
+            f"{sport}{daytime.isoformat()}{user_id}", daytime
+        )
 
         # Execute query to insert the values into the database
         self.cursor.execute(
@@ -188,20 +338,54 @@ class UscDataBase:
         )
 
         # Commit the changes to the database
-        self.conn.commit()
+        self._commit()
 
         # Return the generated key sush that it can be used in the program for querying the record
         # later on
         return key
 
+    def _reserve_lesson_key(self, hash_str: str, daytime: dt) -> str:
+        """Reserve the key of a new lesson in `lesson_keys`, which keeps the keys unique"""
+        return self._insert_with_free_key(
+            self.encrypt.generate_hash_key,
+            hash_str,
+            """
+            INSERT INTO lesson_keys (lesson_id, datetime)
+            VALUES (%s, %s)
+            ON CONFLICT (lesson_id) DO NOTHING
+            RETURNING lesson_id;
+        """,
+            (str(daytime),),
+        )
+
+    def _insert_with_free_key(
+        self, generate, hash_str: str, query: str, params: tuple
+    ) -> str:
+        """
+        Insert a row under the key generated from the hash string, unless that key is taken.
+
+        A lesson keeps its key when it moves, so a new lesson at the time it moved from would get
+        the same key. The row is inserted under the key of the hash string with a number added to
+        it then. The query gets the key as its first parameter, and must only return a row if it
+        inserted one, e.g. with `ON CONFLICT (key) DO NOTHING RETURNING key`. As the key is unique
+        in the table, two writers never get the same key.
+        """
+        for attempt in range(KEY_ATTEMPTS):
+            key = generate(f"{hash_str}#{attempt}" if attempt else hash_str)
+            self.cursor.execute(query, (key, *params))
+            if self.cursor.fetchone() is not None:
+                return key
+
+        raise ValueError(f"No free key left for {hash_str}")
+
     @rollback_on_error
     def has_received_update(self, sport: str, daytime: dt, user_id: str) -> bool:
         """
         Check if the specified sport and datetime combination has already received an email.
 
         This function queries the `lessons` table in the database to determine if a record with the
-        given sport and datetime exists and indicates that an email has been sent (i.e.,
-        `message_sent` is True).
+        given sport and datetime exists for the user. Once the record exists its message is in the
+        outbox, which retries the sending itself, so the job does not have to add it again.
 
         Parameters
         ----------
@@ -213,16 +397,16 @@ class UscDataBase:
         Returns
         -------
         bool
-            Returns True if a record with the given sport and datetime exists and `message_sent` is
-            True, otherwise returns False.
+            Returns True if a record with the given sport and datetime exists, otherwise returns
+            False.
         """
-        # Start with querying all the records with the sport, datetime and a message sent
+        # Start with querying all the records with the sport, datetime and user
         self.cursor.execute(
             """
             SELECT lesson_id FROM lessons
-            WHERE sport = %s AND datetime = %s AND message_sent = %s AND user_id = %s
+            WHERE sport = %s AND datetime = %s AND user_id = %s
         """,
-            (sport, str(daytime), True, user_id),
+            (sport, str(daytime), user_id),
         )
 
         # Then get the first result of the query
@@ -233,13 +417,344 @@ class UscDataBase:
         return bool(result)
 
     @rollback_on_error
-    def get_lesson_data_by_key(self, key_les) -> list[str, int, bool]:
+    def add_broadcast(
+        self, sport: str, daytime: dt, chat_id: int, trainer: str = None
+    ) -> str:
+        """
+        Add a lesson that is announced once in a group chat, instead of to every user.
+
+        The lessons of the users are only added once they answer the announcement, with
+        `join_broadcast`.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport (e.g., "Basketball").
+        daytime : datetime.datetime
+            The date and time of the lesson.
+        chat_id : int
+            The Telegram ID of the group chat or channel the lesson is announced in.
+        trainer : str, optional
+            The name of the trainer. Default is None.
+
+        Returns
+        -------
+        str
+            The key of the broadcast, used in the buttons of the announcement.
+        """
+        key = self._insert_with_free_key(
+            self.encrypt.generate_broadcast_key,
+            f"{sport}{daytime.isoformat()}",
+            """
+            INSERT INTO broadcasts (broadcast_id, sport, datetime, trainer, chat_id)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (broadcast_id) DO NOTHING
+            RETURNING broadcast_id;
+        """,
+            (sport, str(daytime), trainer, chat_id),
+        )
+
+        # Commit the changes to the database
+        self._commit()
+
+        return key
+
+    @rollback_on_error
+    def has_broadcast(self, sport: str, daytime: dt) -> bool:
+        """Check if the lesson with the sport and datetime has been announced in a group chat"""
+        self.cursor.execute(
+            "SELECT 1 FROM broadcasts WHERE sport = %s AND datetime = %s",
+            (sport, str(daytime)),
+        )
+        return self.cursor.fetchone() is not None
+
+    @rollback_on_error
+    def is_lesson_cancelled(self, key_les: str) -> bool:
+        """Check if the lesson with the key was cancelled since it was asked about"""
+        self.cursor.execute(
+            f"SELECT 1 FROM lessons WHERE {LESSON_BY_KEY} AND cancelled",
+            (key_les, key_les),
+        )
+        return self.cursor.fetchone() is not None
+
+    @rollback_on_error
+    def join_broadcast(self, broadcast_id: str, telegram_id: int) -> str | None:
+        """
+        Add the lesson of a broadcast for the user answering it, unless it was added already.
+
+        The lesson of a cancelled broadcast is added as cancelled, such that it can't be claimed.
+
+        Parameters
+        ----------
+        broadcast_id : str
+            The key of the broadcast the user answered.
+        telegram_id : int
+            The Telegram ID of the user answering.
+
+        Returns
+        -------
+        str or None
+            The key of the lesson of the user, the same key the job would have given it. None if
+            the broadcast or the user is not known.
+        """
+        self.cursor.execute(
+            """
+            SELECT b.sport, b.datetime, b.trainer, b.cancelled, u.user_id
+            FROM broadcasts AS b, users AS u
+            WHERE b.broadcast_id = %s AND u.telegram_id = %s;
+        """,
+            (broadcast_id, telegram_id),
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+
+        sport, daytime, trainer, cancelled, user_id = row
+        select_lesson = (
+            """
+            SELECT lesson_id FROM lessons
+            WHERE sport = %s AND datetime = %s AND user_id = %s;
+        """,
+            (sport, daytime, user_id),
+        )
+
+        # A lesson of the user may exist already, from an earlier tap or another mode of the job.
+        # It keeps its key when the lesson moved, so the key is read back
+        self.cursor.execute(*select_lesson)
+        existing = self.cursor.fetchone()
+        if existing is not None:
+            self._commit()
+            return existing[0]
+
+        # Another tap may add the lesson at the same time. The lesson that is added first is kept,
+        # and the key reserved by the other tap is released again
+        key = self._reserve_lesson_key(
+            f"{sport}{daytime.isoformat()}{user_id}", daytime
+        )
+        self.cursor.execute(
+            """
+            INSERT INTO lessons (lesson_id, user_id, datetime, sport, trainer, message_sent,
+                cancelled)
+            VALUES (%s, %s, %s, %s, %s, TRUE, %s)
+            ON CONFLICT DO NOTHING;
+        """,
+            (key, user_id, daytime, sport, trainer, cancelled),
+        )
+        self.cursor.execute(*select_lesson)
+        lesson_id = self.cursor.fetchone()[0]
+        if lesson_id != key:
+            self.cursor.execute("DELETE FROM lesson_keys WHERE lesson_id = %s;", (key,))
+
+        # Commit the changes to the database
+        self._commit()
+
+        return lesson_id
+
+    @rollback_on_error
+    def add_to_outbox(self, telegram_id: int, lesson_id: str, text: str) -> int:
+        """
+        Add a message for the bot to send to the outbox, and wake up the bot.
+
+        The notification is only delivered once the transaction commits, so the bot never sees a
+        message of which the lesson is rolled back. Add the lesson and its message within a single
+        `transaction` to make sure of that.
+
+        Parameters
+        ----------
+        telegram_id : int
+            The Telegram ID of the user to send the message to.
+        lesson_id : str
+            The unique identifier of the lesson the message asks about, used for the buttons. For a
+            digest the identifiers of all its lessons, separated by `LESSON_ID_SEPARATOR`.
+        text : str
+            The text of the message.
+
+        Returns
+        -------
+        int
+            The unique identifier of the message in the outbox.
+        """
+        # Insert the message and notify the bot in a single round trip
+        self.cursor.execute(
+            """
+            INSERT INTO outbox (telegram_id, lesson_id, text)
+            VALUES (%s, %s, %s)
+            RETURNING outbox_id, pg_notify(%s, '');
+        """,
+            (telegram_id, lesson_id, text, OUTBOX_CHANNEL),
+        )
+        outbox_id = self.cursor.fetchone()[0]
+
+        # Commit the changes to the database
+        self._commit()
+
+        return outbox_id
+
+    @rollback_on_error
+    def claim_outbox(
+        self, limit: int, lease: timedelta = timedelta(minutes=5), now: dt = None
+    ) -> list[OutboxMessage]:
+        """
+        Claim a batch of messages from the outbox that are due to be sent, oldest first.
+
+        Claimed messages are marked as in flight and their attempt is counted. Rows claimed by
+        another dispatcher are skipped instead of waited for, such that several dispatchers can
+        drain the outbox in parallel without sending a message twice. Messages that have been in
+        flight for longer than the lease are claimed again, as their dispatcher must have died.
+
+        Parameters
+        ----------
+        limit : int
+            The maximum number of messages to claim.
+        lease : datetime.timedelta, optional
+            The time a dispatcher has to send a message before it may be claimed again.
+        now : datetime.datetime, optional
+            The current time, defaults to now.
+
+        Returns
+        -------
+        list of OutboxMessage
+            The claimed messages, an empty list if no messages are due.
+        """
+        now = now or dt.now()
+
+        self.cursor.execute(
+            f"""
+            UPDATE outbox SET state = 'in_flight', claimed_at = %s, attempts = attempts + 1
+            WHERE outbox_id IN (
+                SELECT outbox_id FROM outbox
+                WHERE (state = 'pending' AND next_attempt_at <= %s)
+                    OR (state = 'in_flight' AND claimed_at <= %s)
+                ORDER BY next_attempt_at, outbox_id
+                LIMIT %s
+                {self.backend.row_lock}
+            )
+            RETURNING {", ".join(OutboxMessage.COLUMNS)};
+        """,
+            (now, now, now - lease, limit),
+        )
+        results = self.cursor.fetchall()
+
+        # Commit the changes to the database
+        self._commit()
+
+        # RETURNING does not keep the order of the subquery
+        return sorted(
+            (OutboxMessage(row) for row in results),
+            key=lambda message: message.outbox_id,
+        )
+
+    @rollback_on_error
+    def mark_outbox_sent(
+        self, outbox_id: int, message_id: int = None, now: dt = None
+    ) -> None:
+        """
+        Mark a message from the outbox as sent, and its lessons as well.
+
+        Parameters
+        ----------
+        outbox_id : int
+            The unique identifier of the message in the outbox.
+        message_id : int, optional
+            The identifier Telegram gave the sent message, needed to edit it later on.
+        now : datetime.datetime, optional
+            The time the message was sent, defaults to now.
+        """
+        now = now or dt.now()
+
+        # Update the message and its lessons in a single round trip. The lessons keep the id of the
+        # message, such that it can be edited when they change
+        if self.backend.supports_writable_ctes:
+            self.cursor.execute(
+                """
+                WITH message AS (
+                    UPDATE outbox
+                    SET state = 'sent', sent_at = %s, message_id = %s, last_error = NULL
+                    WHERE outbox_id = %s
+                    RETURNING lesson_id, message_id
+                ), lesson AS (
+                    UPDATE lessons SET message_sent = TRUE, message_id = message.message_id
+                    FROM message
+                    WHERE lessons.lesson_id IN (
+                        SELECT unnest(string_to_array(message.lesson_id, %s))
+                    )
+                )
+                UPDATE broadcasts SET message_id = message.message_id
+                FROM message
+                WHERE broadcasts.broadcast_id = message.lesson_id;
+            """,
+                (now, message_id, outbox_id, LESSON_ID_SEPARATOR),
+            )
+
+        else:
+            self.cursor.execute(
+                """
+                UPDATE outbox
+                SET state = 'sent', sent_at = %s, message_id = %s, last_error = NULL
+                WHERE outbox_id = %s
+                RETURNING lesson_id;
+            """,
+                (now, message_id, outbox_id),
+            )
+            row = self.cursor.fetchone()
+
+            # SQLite can't split the ids of a digest, so they are split here
+            lesson_ids = row[0].split(LESSON_ID_SEPARATOR) if row else []
+            if lesson_ids and Encryptor.is_broadcast_key(lesson_ids[0]):
+                self.cursor.execute(
+                    "UPDATE broadcasts SET message_id = %s WHERE broadcast_id = %s;",
+                    (message_id, lesson_ids[0]),
+                )
+            elif lesson_ids:
+                self.cursor.execute(
+                    f"""
+                    UPDATE lessons SET message_sent = TRUE, message_id = %s
+                    WHERE lesson_id IN ({", ".join(["%s"] * len(lesson_ids))});
+                """,
+                    (message_id, *lesson_ids),
+                )
+
+        # Commit the changes to the database
+        self._commit()
+
+    @rollback_on_error
+    def mark_outbox_failed(
+        self, outbox_id: int, error: str, retry_at: dt = None
+    ) -> None:
+        """
+        Record a failed attempt to send a message from the outbox.
+
+        Parameters
+        ----------
+        outbox_id : int
+            The unique identifier of the message in the outbox.
+        error : str
+            The error the attempt failed with.
+        retry_at : datetime.datetime, optional
+            The time from which the message may be sent again. If not given, the message is not
+            retried and stays failed.
+        """
+        self.cursor.execute(
+            """
+            UPDATE outbox
+            SET state = %s, last_error = %s, claimed_at = NULL,
+                next_attempt_at = COALESCE(%s, next_attempt_at)
+            WHERE outbox_id = %s;
+        """,
+            ("failed" if retry_at is None else "pending", error, retry_at, outbox_id),
+        )
+
+        # Commit the changes to the database
+        self._commit()
+
+    @rollback_on_error
+    def get_lesson_data_by_key(self, key_les) -> Lesson:
         """
         Retrieve lesson data from the database by lesson ID.
 
         This function queries the `lessons` table using a unique lesson ID (`lesson_id`). It
         retrieves the corresponding record, converts the data to appropriate types, and returns it
-        as a list. The unique lesson ID ensures that only one record is returned.
+        as a `Lesson`. The unique lesson ID ensures that only one record is returned.
 
         Parameters
         ----------
@@ -249,12 +764,13 @@ class UscDataBase:
 
         Returns
         -------
-        list
-            A list containing the lesson data. The list includes:
+        Lesson
+            The lesson data. The columns can be read as attributes or as `lesson["column"]` and
+            include:
             - `lesson_id` (str): The unique identifier of the lesson.
             - `datetime` (datetime.datetime): The date and time of the lesson.
             - `message_sent` (bool): A flag indicating whether a message was sent for this lesson.
-            - Additional fields from the `lessons` table, depending on the schema.
+            - The other columns of the `lessons` table listed in `Lesson.COLUMNS`.
 
         Raises
         ------
@@ -266,62 +782,104 @@ class UscDataBase:
         """
         # Start with querying the records we want to by key
         self.cursor.execute(
-            """
-            SELECT * FROM lessons
-            WHERE lesson_id = %s
+            f"""
+            SELECT {", ".join(Lesson.COLUMNS)} FROM lessons
+            WHERE {LESSON_BY_KEY}
         """,
-            (key_les,),
+            (key_les, key_les),
         )
 
         # Because the key should be unique, there should only be one record. So take that one
-        result = self.cursor.fetchone()
-
-        # Create a dictionary for the result for easy handling
-        cols = [desc[0] for desc in self.cursor.description]
-        dict_result = dict(zip(cols, result))
+        (
+            lesson_id,
+            user_id,
+            daytime,
+            sport,
+            trainer,
+            message_sent,
+            response,
+            cancelled,
+        ) = self.cursor.fetchone()
 
         # Edit some types to the correct type
-        dict_result["datetime"] = dict_result["datetime"]
-        dict_result["message_sent"] = bool(dict_result["message_sent"])
+        return Lesson(
+            (
+                lesson_id,
+                user_id,
+                daytime,
+                sport,
+                trainer,
+                bool(message_sent),
+                response,
+                bool(cancelled),
+            )
+        )
 
-        return dict_result
+    @rollback_on_error
+    def resolve_lesson_key(self, key_les: str) -> str:
+        """
+        Return the lesson id of a lesson key from before the keys were compacted.
+
+        Parameters
+        ----------
+        key_les : str
+            The legacy key of the lesson, e.g. from the buttons of an older message.
+
+        Returns
+        -------
+        str
+            The compact key the lesson has now, or the key itself if there is no alias for it, as
+            the keys of the database might not be compacted yet.
+        """
+        self.cursor.execute(
+            "SELECT lesson_id FROM lesson_key_aliases WHERE legacy_key = %s;",
+            (key_les,),
+        )
+        row = self.cursor.fetchone()
+
+        return row[0] if row else key_les
 
     @rollback_on_error
-    def get_user(
-        self, unit_id: str, query_key: streams = "user_id"
-    ) -> dict[str, object]:
+    def get_user(self, unit_id: str, query_key: streams = "user_id") -> User:
         """
         Retrieve a user's information from the database based on a specified query key.
 
-        This function queries the `users` table to fetch all columns for a user whose
-        column specified by `query_key` matches the provided `id`. The result is returned
-        as a dictionary where the keys are the column names and the values are the respective
-        data from the row. The user's password is decrypted before returning.
+        This function queries the `users` table to fetch the columns in `User.COLUMNS` for a user
+        whose column specified by `query_key` matches the provided `id`. The result is returned
+        as a `User`. The user's password is only decrypted once it is read from the user.
+
+        The bot itself does not look up users, as claiming a response reads the user in the same
+        statement. This lookup is left for scripts and tests, so users are not cached.
 
         Parameters
         ----------
         unit_id : str
             The value to search for in the specified column (`query_key`). This can be a
-            user ID, email, username, or any other unique identifier.
+            user ID or a telegram ID.
 
         query_key : str, optional
-            The column name to search by in the `users` table (default is `"user_id"`).
+            The column name to search by in the `users` table (default is `"user_id"`). Must be
+            one of the columns in `KEY_COLUMNS["users"]`.
 
         Returns
         -------
-        dict[str, object]
-            A dictionary containing the user's information with column names as keys.
-            The `password` field is decrypted before returning.
+        User
+            The user's information. The columns can be read as attributes or as
+            `user["column"]`. The `password` is decrypted when it is first read.
 
         Raises
         ------
         ValueError
-            If no record is found in the database that matches the query.
+            If no record is found in the database that matches the query, or if the query key is
+            not a key column.
         """
+        if query_key not in KEY_COLUMNS["users"]:
+            raise ValueError(f"Users can not be looked up by {query_key}")
+
         # Start with querying the records we want
         self.cursor.execute(
             f"""
-            SELECT * FROM users
+            SELECT {", ".join(User.COLUMNS)} FROM users
             WHERE {query_key} = %s;
         """,
             (unit_id,),
@@ -334,15 +892,92 @@ class UscDataBase:
         if not result:
             raise ValueError(f"User {unit_id} not found")
 
-        # Create a dictionary for the result for easy handling
-        cols = [desc[0] for desc in self.cursor.description]
-        result_dict = dict(zip(cols, result))
+        # The password is decrypted by the user when it is needed
+        return User(result, encryptor=self.encrypt)
+
+    @rollback_on_error
+    def claim_lesson_response(
+        self, key_les: str, response: str, telegram_id: int
+    ) -> Notification | None:
+        """
+        Record the response of a user on a lesson and return what is needed to act on it.
+
+        The response is only written if no response was recorded yet, which makes claiming a
+        response atomic: out of several concurrent callbacks for the same lesson only one gets the
+        lesson data back. The lesson is joined with the login fields of the user it belongs to,
+        such that everything is done in a single round trip.
+
+        Parameters
+        ----------
+        key_les : str
+            The unique identifier of the lesson record.
+        response : str
+            The response of the user, "Y" or "N".
+        telegram_id : int
+            The Telegram ID of the user responding. Only the user the lesson was sent to can claim
+            it.
+
+        Returns
+        -------
+        Notification or None
+            The `sport` and `datetime` of the lesson and the `username`, `password` and
+            `login_method` of the user. The password is only decrypted when it is read, which is
+            only needed for a "Y" response. None if the response was allready known, the lesson
+            was cancelled or the lesson does not belong to the user.
+        """
+        # Only update the lesson if there is no response yet, and return the joined user fields
+        if self.backend.supports_returning_joins:
+            self.cursor.execute(
+                f"""
+                UPDATE lessons AS l
+                SET response = %s
+                FROM users AS u
+                WHERE {LESSON_BY_KEY} AND l.response IS NULL AND NOT l.cancelled
+                    AND u.user_id = l.user_id AND u.telegram_id = %s
+                RETURNING l.sport, l.datetime, u.username, u.password, u.login_method;
+            """,
+                (response, key_les, key_les, telegram_id),
+            )
+            result = self.cursor.fetchone()
+
+        else:
+            result = self._claim_lesson_response_separately(
+                key_les, response, telegram_id
+            )
+
+        # Commit the changes to the database
+        self._commit()
+
+        # If nothing was updated, the response was allready claimed
+        if result is None:
+            return None
+
+        return Notification(result, encryptor=self.encrypt)
+
+    def _claim_lesson_response_separately(
+        self, key_les: str, response: str, telegram_id: int
+    ) -> tuple | None:
+        """Claim the response and select the user fields after, for backends that can't join"""
+        self.cursor.execute(
+            f"""
+            UPDATE lessons
+            SET response = %s
+            WHERE {LESSON_BY_KEY} AND response IS NULL AND NOT cancelled
+                AND user_id IN (SELECT user_id FROM users WHERE telegram_id = %s)
+            RETURNING user_id, sport, datetime;
+        """,
+            (response, key_les, key_les, telegram_id),
+        )
+        lesson = self.cursor.fetchone()
 
-        # Decrypt the password
-        result_dict["password"] = self.encrypt.decrypt_data(result_dict["password"])
+        if lesson is None:
+            return None
 
-        # Return the result
-        return result_dict
+        self.cursor.execute(
+            "SELECT username, password, login_method FROM users WHERE user_id = %s;",
+            (lesson[0],),
+        )
+        return (*lesson[1:], *self.cursor.fetchone())
 
     # pylint: disable=too-many-positional-arguments
     @rollback_on_error
@@ -393,45 +1028,959 @@ class UscDataBase:
         )
 
         # Commit the changes to the database
-        self.conn.commit()
+        self._commit()
 
     @rollback_on_error
-    def get_all_users_in_sport(self, sport: str) -> list[dict[str, str]]:
+    def update_fields(
+        self, table: str, key: str, key_column: str = None, **cols: object
+    ) -> None:
         """
-        Retrieve a list of all users participating in a specific sport.
+        Update several columns of a single record in one statement.
 
-        This function executes a SQL query to fetch all user IDs and Telegram IDs of users
-        who are associated with the given sport. The results are returned as a list of
-        dictionaries, where each dictionary represents a row in the result set and
-        contains column names as keys.
+        Where `edit_data_point` writes one column per call, this function writes all given columns
+        with a single `UPDATE`. Because column names can not be passed as query parameters, the
+        table, key column and columns are checked against `UPDATABLE_COLUMNS` and `KEY_COLUMNS`.
 
         Parameters
         ----------
-        sport : str
-            The name of the sport for which the users are to be retrieved.
+        table : str
+            The table to update, either `users` or `lessons`.
+        key : str
+            The value of the key column identifying the record.
+        key_column : str, optional
+            The column to identify the record by. Defaults to the primary key of the table.
+        **cols : object
+            The columns to update, mapped to their new values.
 
-        Returns
-        -------
-        list of dict[str, any]
-            A list of dictionaries, where each dictionary contains the columns `user_id`
-            and `telegram_id` for a user. Each key in the dictionary corresponds to a column
-            name, and the values correspond to the respective values in the row.
+        Raises
+        ------
+        ValueError
+            If the table, key column or any of the columns is not allowed to be updated, or if no
+            columns are given.
         """
-        # Execute the query to get all the users in the sport
-        self.cursor.execute(
-            """
-            SELECT user_id, telegram_id
-            FROM users
-            WHERE sport = %s;
-        """,
-            (sport,),
-        )
+        if table not in UPDATABLE_COLUMNS:
+            raise ValueError(f"Table {table} can not be updated")
+
+        key_column = key_column or KEY_COLUMNS[table][0]
+        if key_column not in KEY_COLUMNS[table]:
+            raise ValueError(f"Column {key_column} is not a key column of {table}")
+
+        if not cols:
+            raise ValueError("No columns given to update")
+
+        unknown_cols = set(cols) - set(UPDATABLE_COLUMNS[table])
+        if unknown_cols:
+            raise ValueError(
+                f"Columns {sorted(unknown_cols)} of {table} can not be updated"
+            )
+
+        # Build a single statement setting all the columns at once
+        set_clause = ", ".join(f"{col} = %s" for col in cols)
+        self.cursor.execute(
+            f"""
+            UPDATE {table}
+            SET {set_clause}
+            WHERE {key_column} = %s;
+        """,
+            (*cols.values(), key),
+        )
+
+        # Commit the changes to the database
+        self._commit()
+
+    @rollback_on_error
+    def get_schedule(self, sport: str) -> list[ScheduledLesson]:
+        """Return the lessons of the sport as they were found by the last scrape, by time"""
+        self.cursor.execute(
+            f"""
+            SELECT {", ".join(ScheduledLesson.COLUMNS)} FROM schedule
+            WHERE sport = %s
+            ORDER BY datetime;
+        """,
+            (sport,),
+        )
+        return [ScheduledLesson(row) for row in self.cursor.fetchall()]
+
+    @rollback_on_error
+    def get_schedule_sports(self) -> list[str]:
+        """Return the sports of which lessons were found by the last scrape, by name"""
+        self.cursor.execute("SELECT DISTINCT sport FROM schedule ORDER BY sport;")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    @rollback_on_error
+    def save_schedule(self, sport: str, lessons: list[dict], now: dt = None) -> None:
+        """
+        Replace the lessons of the sport found by the last scrape, in a single transaction.
+
+        Only the lessons up to the last lesson of the scrape are replaced, as the lessons after it
+        were not scraped at all. A scrape without lessons, which is most likely a failed scrape,
+        replaces nothing, such that the next scrape still finds the lessons that changed.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport the lessons are of.
+        lessons : list of dict
+            The scraped lessons, with their `time` and `trainer`.
+        now : datetime.datetime, optional
+            The time of the scrape, defaults to now.
+        """
+        if not lessons:
+            logger.warning("No %s lessons scraped, keeping the last scrape", sport)
+            return
+
+        now = now or dt.now()
+
+        with self.transaction():
+            self.cursor.execute(
+                "DELETE FROM schedule WHERE sport = %s AND datetime <= %s;",
+                (sport, max(les["time"] for les in lessons)),
+            )
+            self.cursor.execute(
+                f"""
+                INSERT INTO schedule (sport, datetime, trainer, scraped_at)
+                VALUES {", ".join(["(%s, %s, %s, %s)"] * len(lessons))};
+            """,
+                tuple(
+                    value
+                    for les in lessons
+                    for value in (sport, les["time"], les["trainer"], now)
+                ),
+            )
+
+    @rollback_on_error
+    def change_lesson(
+        self, sport: str, daytime: dt, new_time: dt = None, trainer: str = None
+    ) -> list[tuple[int, int]]:
+        """
+        Apply a change of a lesson to the lessons of all users and its broadcast.
+
+        The lessons keep their keys when they move, such that the buttons of their messages keep
+        working and the job does not ask about them again at their new time.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport of the lesson.
+        daytime : datetime.datetime
+            The date and time the lesson was at.
+        new_time : datetime.datetime, optional
+            The date and time the lesson is at now, None if the lesson is cancelled.
+        trainer : str, optional
+            The trainer of the lesson now.
+
+        Returns
+        -------
+        list of tuple
+            The chat and Telegram id of every message sent about the lesson, to edit them.
+        """
+        with self.transaction():
+            # Find the messages before the lessons move, as not every lesson may be able to move
+            self.cursor.execute(
+                """
+                SELECT u.telegram_id, l.message_id
+                FROM lessons AS l JOIN users AS u ON u.user_id = l.user_id
+                WHERE l.sport = %s AND l.datetime = %s AND l.message_id IS NOT NULL
+                UNION
+                SELECT chat_id, message_id FROM broadcasts
+                WHERE sport = %s AND datetime = %s AND message_id IS NOT NULL;
+            """,
+                (sport, daytime) * 2,
+            )
+            messages = [tuple(row) for row in self.cursor.fetchall()]
+
+            for table in ("lessons", "broadcasts"):
+                # Don't move a lesson onto one the user has at the new time already
+                if new_time is not None:
+                    key, user = (
+                        ("lesson_id", "AND other.user_id = t.user_id")
+                        if table == "lessons"
+                        else ("broadcast_id", "")
+                    )
+                    self.cursor.execute(
+                        f"""
+                        UPDATE {table} AS t SET datetime = %s, trainer = %s
+                        WHERE sport = %s AND datetime = %s AND NOT EXISTS (
+                            SELECT 1 FROM {table} AS other
+                            WHERE other.sport = t.sport AND other.datetime = %s
+                                AND other.{key} <> t.{key} {user}
+                        );
+                    """,
+                        (new_time, trainer, sport, daytime, new_time),
+                    )
+
+                # The lessons left at the old time are cancelled, as the lesson is not there any
+                # more. The users of the lessons that could not move are asked about the lesson
+                # they have at the new time already
+                if new_time != daytime:
+                    self.cursor.execute(
+                        f"""
+                        UPDATE {table} SET cancelled = TRUE
+                        WHERE sport = %s AND datetime = %s;
+                    """,
+                        (sport, daytime),
+                    )
+
+            # The moved lessons keep their key, at their new time
+            if new_time is not None:
+                self.cursor.execute(
+                    """
+                    UPDATE lesson_keys SET datetime = %s
+                    WHERE lesson_id IN (
+                        SELECT lesson_id FROM lessons WHERE sport = %s AND datetime = %s
+                    );
+                """,
+                    (new_time, sport, new_time),
+                )
+
+            return messages
+
+    @rollback_on_error
+    def get_message_lessons(self, chat_id: int, message_id: int) -> list[Lesson]:
+        """
+        Return the lessons a sent message asks about, in the order of the message.
+
+        The lesson of a broadcast has the key of the broadcast, and no user or response.
+
+        Parameters
+        ----------
+        chat_id : int
+            The Telegram ID of the chat the message was sent to.
+        message_id : int
+            The identifier Telegram gave the message.
+
+        Returns
+        -------
+        list of Lesson
+            The lessons of the message, empty if the message is not known.
+        """
+        self.cursor.execute(
+            """
+            SELECT lesson_id FROM outbox
+            WHERE telegram_id = %s AND message_id = %s
+            ORDER BY outbox_id
+            LIMIT 1;
+        """,
+            (chat_id, message_id),
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return []
+
+        keys = row[0].split(LESSON_ID_SEPARATOR)
+        if Encryptor.is_broadcast_key(keys[0]):
+            self.cursor.execute(
+                """
+                SELECT broadcast_id, datetime, sport, trainer, cancelled FROM broadcasts
+                WHERE broadcast_id = %s;
+            """,
+                (keys[0],),
+            )
+            columns = ("lesson_id", "datetime", "sport", "trainer", "cancelled")
+
+        else:
+            self.cursor.execute(
+                f"""
+                SELECT {", ".join(Lesson.COLUMNS)} FROM lessons
+                WHERE lesson_id IN ({", ".join(["%s"] * len(keys))});
+            """,
+                keys,
+            )
+            columns = Lesson.COLUMNS
+
+        lessons = {
+            lesson.lesson_id: lesson
+            for lesson in (Lesson(row, columns) for row in self.cursor.fetchall())
+        }
+        return [lessons[key] for key in keys if key in lessons]
+
+    @rollback_on_error
+    def add_edits_to_outbox(self, edits: list[tuple[int, int, str, str, str]]) -> None:
+        """
+        Add edits of sent messages for the bot to make to the outbox, and wake up the bot.
+
+        Parameters
+        ----------
+        edits : list of tuple
+            The chat and Telegram id of the message, the lesson ids of the message, and its new text
+            and buttons as JSON, for every edit. The buttons are None if none are left.
+        """
+        if not edits:
+            return
+
+        self.cursor.execute(
+            f"""
+            INSERT INTO outbox (telegram_id, message_id, lesson_id, text, reply_markup)
+            VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(edits))};
+        """,
+            tuple(value for edit in edits for value in edit),
+        )
+        self.cursor.execute("SELECT pg_notify(%s, '');", (OUTBOX_CHANNEL,))
+
+        # Commit the changes to the database
+        self._commit()
+
+    @rollback_on_error
+    def get_preferences(self, sport: str) -> list[tuple[str, str, str]]:
+        """Return the user id, kind and value of the preferences of the active users of a sport"""
+        self.cursor.execute(
+            """
+            SELECT p.user_id, p.kind, p.value
+            FROM preferences AS p JOIN users AS u ON u.user_id = p.user_id
+            WHERE u.sport = %s AND u.active;
+        """,
+            (sport,),
+        )
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    @rollback_on_error
+    def get_user_preferences(self, telegram_id: int) -> list[tuple[str, str]]:
+        """Return the kind and value of the preferences of a user, ordered by kind and value"""
+        self.cursor.execute(
+            """
+            SELECT p.kind, p.value
+            FROM preferences AS p JOIN users AS u ON u.user_id = p.user_id
+            WHERE u.telegram_id = %s
+            ORDER BY p.kind, p.value;
+        """,
+            (telegram_id,),
+        )
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    @rollback_on_error
+    def add_preference(self, telegram_id: int, kind: str, value: str) -> bool:
+        """
+        Add a preference of a user, nothing changes if the user has it already.
+
+        Parameters
+        ----------
+        telegram_id : int
+            The Telegram ID of the user.
+        kind : str
+            The kind of the preference, "day", "time" or "trainer".
+        value : str
+            The value of the preference as it is stored, see `preferences.parse_preference`.
+
+        Returns
+        -------
+        bool
+            Whether the user is known, the preference is only added then.
+        """
+        self.cursor.execute(
+            """
+            INSERT INTO preferences (user_id, kind, value)
+            SELECT user_id, %s, %s FROM users WHERE telegram_id = %s
+            ON CONFLICT DO NOTHING;
+        """,
+            (kind, value, telegram_id),
+        )
+        self.cursor.execute(
+            "SELECT 1 FROM users WHERE telegram_id = %s;", (telegram_id,)
+        )
+        known = self.cursor.fetchone() is not None
+
+        # Commit the changes to the database
+        self._commit()
+
+        return known
+
+    @rollback_on_error
+    def remove_preferences(
+        self, telegram_id: int, kind: str = None, value: str = None
+    ) -> int:
+        """
+        Remove preferences of a user.
+
+        Parameters
+        ----------
+        telegram_id : int
+            The Telegram ID of the user.
+        kind : str, optional
+            Only remove the preferences of this kind, defaults to all kinds.
+        value : str, optional
+            Only remove the preference with this value, defaults to all values.
+
+        Returns
+        -------
+        int
+            The number of preferences that were removed.
+        """
+        conditions, params = "", [telegram_id]
+        for column, param in (("kind", kind), ("value", value)):
+            if param is not None:
+                conditions += f" AND {column} = %s"
+                params.append(param)
+
+        self.cursor.execute(
+            f"""
+            DELETE FROM preferences
+            WHERE user_id IN (SELECT user_id FROM users WHERE telegram_id = %s){conditions};
+        """,
+            params,
+        )
+        removed = self.cursor.rowcount
+
+        # Commit the changes to the database
+        self._commit()
+
+        return removed
+
+    @rollback_on_error
+    def get_conversations(self, name: str) -> dict[str, str]:
+        """
+        Retrieve the states of all the conversations of a conversation handler.
+
+        Parameters
+        ----------
+        name : str
+            The name of the conversation handler.
+
+        Returns
+        -------
+        dict
+            The state of every conversation as JSON, by the key of the conversation as JSON.
+        """
+        self.cursor.execute(
+            "SELECT key, state FROM conversations WHERE name = %s;", (name,)
+        )
+        return dict(self.cursor.fetchall())
+
+    @rollback_on_error
+    def save_conversations(self, states: dict[tuple[str, str], str | None]) -> None:
+        """
+        Store the states of several conversations at once, in a single transaction.
+
+        Parameters
+        ----------
+        states : dict
+            The new state of every conversation as JSON, by the name of the conversation handler
+            and the key of the conversation as JSON. Conversations with a state of None have ended
+            and are removed.
+        """
+        now = dt.now()
+        changed = [
+            (*conv, state, now) for conv, state in states.items() if state is not None
+        ]
+        ended = [conv for conv, state in states.items() if state is None]
+
+        with self.transaction():
+            if changed:
+                self.cursor.execute(
+                    f"""
+                    INSERT INTO conversations (name, key, state, updated_at)
+                    VALUES {", ".join(["(%s, %s, %s, %s)"] * len(changed))}
+                    ON CONFLICT (name, key)
+                    DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at;
+                """,
+                    tuple(value for row in changed for value in row),
+                )
+
+            if ended:
+                self.cursor.execute(
+                    f"""
+                    DELETE FROM conversations
+                    WHERE (name, key) IN (VALUES {", ".join(["(%s, %s)"] * len(ended))});
+                """,
+                    tuple(value for conv in ended for value in conv),
+                )
+
+    @rollback_on_error
+    def deactivate_user(self, telegram_id: int, reason: str) -> None:
+        """
+        Stop sending messages to a user, e.g. because they blocked the bot.
+
+        The user is skipped by the job from now on, and the messages still waiting in the outbox
+        for the user are failed right away. The user is active again once they send /start.
+
+        Parameters
+        ----------
+        telegram_id : int
+            The Telegram ID of the user to deactivate.
+        reason : str
+            Why the user is deactivated, recorded as the error of the failed messages.
+        """
+        with self.transaction():
+            self.update_fields(
+                "users", telegram_id, key_column="telegram_id", active=False
+            )
+
+            self.cursor.execute(
+                """
+                UPDATE outbox SET state = 'failed', last_error = %s
+                WHERE telegram_id = %s AND state = 'pending';
+            """,
+                (reason, telegram_id),
+            )
+
+    @rollback_on_error
+    def get_all_users_in_sport(self, sport: str) -> list[User]:
+        """
+        Retrieve a list of all users participating in a specific sport.
+
+        This function executes a SQL query to fetch all user IDs and Telegram IDs of active users
+        who are associated with the given sport. The results are returned as a list of
+        `User` objects holding only those two columns. Users who blocked the bot are inactive and
+        are skipped.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport for which the users are to be retrieved.
+
+        Returns
+        -------
+        list of User
+            A list of users with the columns `user_id` and `telegram_id`, which can be read as
+            attributes or as `user["column"]`. The other columns are None.
+        """
+        # Execute the query to get all the users in the sport
+        self.cursor.execute(
+            """
+            SELECT user_id, telegram_id
+            FROM users
+            WHERE sport = %s AND active;
+        """,
+            (sport,),
+        )
 
         # Fetch all the rows that are selected
         rows = self.cursor.fetchall()
 
-        # Make sure the result is a list of dictionaries
-        cols = [desc[0] for desc in self.cursor.description]
-        result = [dict(zip(cols, row)) for row in rows]
+        # Make sure the result is a list of users, sharing the tuple of columns
+        return [User(row, SUBSCRIBER_COLUMNS) for row in rows]
+
+    def iter_users_in_sport(self, sport: str, itersize: int = 1000) -> Iterator[User]:
+        """
+        Stream all active users participating in a specific sport.
+
+        Where `get_all_users_in_sport` fetches all users at once, this generator uses a named
+        server-side cursor and only fetches `itersize` users at a time. This keeps the memory use
+        flat, no matter the number of users. The cursor is declared `WITH HOLD`, such that it stays
+        open when the caller commits other changes while iterating.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport for which the users are to be retrieved.
+        itersize : int, optional
+            The number of users to fetch from the database per round trip.
+
+        Yields
+        ------
+        User
+            Users with the columns `user_id` and `telegram_id`.
+        """
+        batches = self._iter_batches(
+            "users_in_sport",
+            """
+            SELECT user_id, telegram_id
+            FROM users
+            WHERE sport = %s AND active;
+        """,
+            (sport,),
+            itersize,
+        )
+
+        for rows in batches:
+            for row in rows:
+                yield User(row, SUBSCRIBER_COLUMNS)
+
+    def iter_passwords_to_rotate(
+        self, key_id: str, itersize: int = 500
+    ) -> Iterator[list[tuple[str, str]]]:
+        """
+        Stream the passwords that are not encrypted with the given key yet, in batches.
+
+        The passwords are read through a server-side cursor, in the order of the users. Passwords
+        that are rotated are skipped, such that a rotation that was interrupted continues where it
+        stopped when it is started again.
+
+        Parameters
+        ----------
+        key_id : str
+            The id of the key the passwords should be encrypted with.
+        itersize : int, optional
+            The number of passwords to fetch from the database per round trip.
+
+        Yields
+        ------
+        list of tuple
+            Batches of the `user_id` and encrypted `password` of the users.
+        """
+        return self._iter_batches(
+            "passwords_to_rotate",
+            """
+            SELECT user_id, password
+            FROM users
+            WHERE password IS NOT NULL AND password NOT LIKE %s
+            ORDER BY user_id;
+        """,
+            (key_id + "$%",),
+            itersize,
+        )
+
+    def _iter_batches(
+        self, name: str, query: str, params: tuple, itersize: int
+    ) -> Iterator[list[tuple]]:
+        """Execute the query on a named server-side cursor and yield its rows in batches"""
+        cursor = self.backend.cursor(self.conn, name=f"{name}_{next(_cursor_names)}")
+
+        try:
+            cursor.execute(query, params)
+
+            # Fetch the rows in batches, until the cursor is exhausted
+            while rows := cursor.fetchmany(itersize):
+                yield rows
+
+        # The rollback decorator does not work for generators, so roll back ourselves
+        except Exception as error:
+            if not self.in_transaction:
+                self.rollback()
+            logger.error("Error in %s: %s", name, traceback.format_exc())
+            raise error
+
+        finally:
+            cursor.close()
+
+    @rollback_on_error
+    def update_passwords(self, changes: list[tuple[str, str, str]]) -> int:
+        """
+        Replace the encrypted passwords of several users in a single statement.
+
+        A password is only replaced if it was not changed since it was read, such that a user who
+        changes their password during a key rotation keeps their new password.
+
+        Parameters
+        ----------
+        changes : list of tuple
+            The `user_id`, the encrypted password as it was read, and the new encrypted password.
+
+        Returns
+        -------
+        int
+            The number of passwords that were replaced.
+        """
+        if not changes:
+            return 0
+
+        values = ", ".join(["(%s, %s, %s)"] * len(changes))
+        self.cursor.execute(
+            f"""
+            UPDATE users SET password = v.column3
+            FROM (VALUES {values}) AS v
+            WHERE users.user_id = v.column1 AND users.password = v.column2;
+        """,
+            tuple(value for change in changes for value in change),
+        )
+        count = self.cursor.rowcount
+
+        # Commit the changes to the database
+        self._commit()
+
+        return count
+
+    @rollback_on_error
+    def lessons_partitioned(self) -> bool:
+        """Whether the lessons table is partitioned, older databases have a plain table"""
+        self.cursor.execute("""
+            SELECT relkind FROM pg_class
+            WHERE relname = 'lessons' AND relkind IN ('r', 'p');
+        """)
+        result = self.cursor.fetchone()
+        return result is not None and result[0] == "p"
+
+    @rollback_on_error
+    def create_lesson_partition(self, month: dt) -> str:
+        """
+        Create the partition of the lessons table holding the lessons of a month.
+
+        Parameters
+        ----------
+        month : datetime.datetime
+            A date within the month the partition is for.
+
+        Returns
+        -------
+        str
+            The name of the partition, which is created only if it did not exist yet.
+        """
+        month = month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        name = month.strftime(LESSON_PARTITION_FORMAT)
+
+        # The name is derived from a date, so it is safe to use in the query
+        self.cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {name} PARTITION OF lessons
+            FOR VALUES FROM (%s) TO (%s);
+        """,
+            (month, next_month),
+        )
+
+        self._commit()
+        return name
+
+    @rollback_on_error
+    def get_lesson_partitions(self) -> dict[str, dt]:
+        """Return the partitions of the lessons table, mapped to the month they hold"""
+        self.cursor.execute("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'lessons';
+        """)
+
+        partitions = {}
+        for (name,) in self.cursor.fetchall():
+            try:
+                partitions[name] = dt.strptime(name, LESSON_PARTITION_FORMAT)
+
+            # Partitions not created by us are left alone
+            except ValueError:
+                logger.warning("Unknown partition %s of lessons", name)
+
+        return partitions
+
+    @rollback_on_error
+    def archive_lesson_partition(self, name: str, path: str) -> None:
+        """
+        Export a partition of the lessons table to a compressed file, then remove it.
+
+        The rows are written as gzipped CSV with a header. The file is first written under a
+        temporary name and only gets its final name once the partition is removed, such that an
+        archive file always means the partition is gone.
+
+        Parameters
+        ----------
+        name : str
+            The name of the partition, as returned by `get_lesson_partitions`.
+        path : str
+            The path of the archive file to create.
+        """
+        partitions = self.get_lesson_partitions()
+        if name not in partitions:
+            raise ValueError(f"{name} is not a partition of lessons")
+
+        temp_path = path + ".partial"
+        with gzip.open(temp_path, "wt", encoding="UTF-8") as file:
+            self.cursor.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", file)
+
+        # The keys of the archived lessons may be used by new lessons again
+        month = partitions[name]
+        self.cursor.execute(
+            "DELETE FROM lesson_keys WHERE datetime >= %s AND datetime < %s;",
+            (month, (month + timedelta(days=32)).replace(day=1)),
+        )
+        self.cursor.execute(f"ALTER TABLE lessons DETACH PARTITION {name};")
+        self.cursor.execute(f"DROP TABLE {name};")
+        self._commit()
+
+        os.replace(temp_path, path)
+        logger.info("Archived lesson partition %s to %s", name, path)
+
+    @rollback_on_error
+    def partition_lessons(self) -> None:
+        """
+        Convert the plain lessons table of an older database into a partitioned table.
+
+        The plain table is renamed, the partitioned table is created from the init script of the
+        backend, and the lessons are copied over into a partition per month. All of this happens in
+        one transaction. Lessons without a datetime can't be placed in a partition and are dropped.
+        """
+        with self.transaction():
+            self.cursor.execute("ALTER TABLE lessons RENAME TO lessons_unpartitioned;")
+
+            with open(self.backend.init_script, "r", encoding="UTF-8") as file:
+                for command in file.read().split(";"):
+                    if command.strip():
+                        self.cursor.execute(command)
+
+            # Create the partitions for all the months in the old table
+            self.cursor.execute("""
+                SELECT DISTINCT date_trunc('month', datetime)
+                FROM lessons_unpartitioned
+                WHERE datetime IS NOT NULL;
+            """)
+            for (month,) in self.cursor.fetchall():
+                self.create_lesson_partition(month)
+
+            self.cursor.execute("""
+                INSERT INTO lessons
+                SELECT * FROM lessons_unpartitioned
+                WHERE datetime IS NOT NULL;
+            """)
+            self.cursor.execute("DROP TABLE lessons_unpartitioned;")
+
+        logger.info("Converted the lessons table into a partitioned table")
+
+    @rollback_on_error
+    def compact_keys(self, batch_size: int = 1000) -> int:
+        """
+        Replace the legacy hexadecimal keys of the users and lessons with compact keys.
+
+        The compact keys are derived from the legacy keys, so they are the same keys the users and
+        lessons would get now. The legacy keys of the lessons are kept as aliases, such that the
+        buttons of messages sent before still work. All of this happens in one transaction, and
+        keys that are compact already are left alone.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of keys replaced per statement.
+
+        Returns
+        -------
+        int
+            The number of keys that were replaced.
+        """
+        with self.transaction():
+            # A user who signed up again with a compact key before the telegram_id was unique
+            # has rows under both keys, only the rows of the compact key are kept then
+            users = self._legacy_keys("users", "user_id")
+            self._drop_replaced("users", "user_id", users, (), batch_size)
+            self._replace_keys("users", "user_id", users, batch_size)
+            for table, columns in USER_ROWS.items():
+                keys = self._legacy_keys(table, "user_id")
+                self._drop_replaced(table, "user_id", keys, columns, batch_size)
+                self._replace_keys(table, "user_id", keys, batch_size)
+
+            lessons = self._legacy_keys("lessons", "lesson_id")
+            self._replace_keys("lessons", "lesson_id", lessons, batch_size)
+            self._replace_keys("lesson_keys", "lesson_id", lessons, batch_size)
+            self._replace_keys("outbox", "lesson_id", lessons, batch_size)
+            self._replace_keys(
+                "outbox",
+                "lesson_id",
+                self._digests_with_keys(lessons),
+                batch_size,
+                key_column="outbox_id",
+            )
+
+            aliases = list(lessons.items())
+            for start in range(0, len(aliases), batch_size):
+                batch = aliases[start : start + batch_size]
+                self.cursor.execute(
+                    f"""
+                    INSERT INTO lesson_key_aliases (legacy_key, lesson_id)
+                    VALUES {", ".join(["(%s, %s)"] * len(batch))}
+                    ON CONFLICT (legacy_key) DO NOTHING;
+                """,
+                    tuple(key for alias in batch for key in alias),
+                )
+
+        logger.info(
+            "Compacted the keys of %s users and %s lessons", len(users), len(lessons)
+        )
+
+        return len(users) + len(lessons)
+
+    def _legacy_keys(self, table: str, column: str) -> dict[str, str]:
+        """Return the legacy keys in the column of the table, with the compact key for each"""
+        self.cursor.execute(
+            f"SELECT DISTINCT {column} FROM {table} WHERE length({column}) = %s;",
+            (LEGACY_HASH_KEY_LENGTH,),
+        )
+        return {
+            key: Encryptor.compact_legacy_key(key) for (key,) in self.cursor.fetchall()
+        }
+
+    def _drop_replaced(
+        self,
+        table: str,
+        column: str,
+        keys: dict[str, str],
+        columns: tuple[str, ...],
+        batch_size: int,
+    ) -> None:
+        """Remove the rows with a legacy key for which the same row with the compact key exists"""
+        keys = list(keys.items())
+        same = "".join(f" AND t.{name} = {table}.{name}" for name in columns)
+
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start : start + batch_size]
+            replaced = f"""
+                EXISTS (
+                    SELECT 1 FROM (VALUES {", ".join(["(%s, %s)"] * len(batch))}) AS v
+                    JOIN {table} AS t ON t.{column} = v.column2
+                    WHERE {table}.{column} = v.column1{same}
+                )
+            """
+            params = tuple(key for pair in batch for key in pair)
+
+            # The key of a lesson is removed along with the lesson
+            if table == "lessons":
+                self.cursor.execute(
+                    f"""
+                    DELETE FROM lesson_keys WHERE lesson_id IN (
+                        SELECT lesson_id FROM lessons WHERE {replaced}
+                    );
+                """,
+                    params,
+                )
+            self.cursor.execute(f"DELETE FROM {table} WHERE {replaced};", params)
+
+    def _digests_with_keys(self, keys: dict[str, str]) -> dict[int, str]:
+        """Return the lesson keys of the digests in the outbox that contain any of the keys"""
+        self.cursor.execute(
+            "SELECT outbox_id, lesson_id FROM outbox WHERE lesson_id LIKE %s;",
+            (f"%{LESSON_ID_SEPARATOR}%",),
+        )
+
+        digests = {}
+        for outbox_id, lesson_ids in self.cursor.fetchall():
+            lesson_ids = lesson_ids.split(LESSON_ID_SEPARATOR)
+            if any(key in keys for key in lesson_ids):
+                digests[outbox_id] = LESSON_ID_SEPARATOR.join(
+                    keys.get(key, key) for key in lesson_ids
+                )
+        return digests
+
+    def _replace_keys(
+        self,
+        table: str,
+        column: str,
+        keys: dict[str, str],
+        batch_size: int,
+        key_column: str = None,
+    ) -> None:
+        """Replace the keys in the column of the table, a batch of keys per statement"""
+        # The rows are found by the key to replace, unless another column to find them is given
+        key_column = key_column or column
+        keys = list(keys.items())
+
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start : start + batch_size]
+            self.cursor.execute(
+                f"""
+                UPDATE {table} SET {column} = v.column2
+                FROM (VALUES {", ".join(["(%s, %s)"] * len(batch))}) AS v
+                WHERE {table}.{key_column} = v.column1;
+            """,
+                tuple(key for pair in batch for key in pair),
+            )
+
+    @rollback_on_error
+    def purge_lesson_key_aliases(self, older_than: dt) -> int:
+        """
+        Remove the aliases of the legacy lesson keys that were created before the given time.
+
+        Parameters
+        ----------
+        older_than : datetime.datetime
+            The aliases created before this time are removed.
+
+        Returns
+        -------
+        int
+            The number of aliases that were removed.
+        """
+        self.cursor.execute(
+            "DELETE FROM lesson_key_aliases WHERE created_at < %s;", (older_than,)
+        )
+        count = self.cursor.rowcount
+
+        # Commit the changes to the database
+        self._commit()
 
-        return result
+        return count
@@ -1,65 +1,199 @@
 """Hold the encrytor class in this module"""
 
+import functools
 import hashlib
 import os
-from base64 import b64decode, b64encode
+import threading
+from base64 import b64decode, b64encode, urlsafe_b64encode
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+# Values are stored as "<key id>$<base64 of IV and ciphertext>", the key id tells which key they
+# were encrypted with. Values from before the key ids have no prefix, they were encrypted with the
+# padded instead of the derived key
+SEPARATOR = "$"
 
-class Encryptor:
-    """Hold and use encryption functions for a specific entryption key"""
+# Settings of the key derivation. The salt is fixed, as every process has to derive the same key
+# from ENCRYPT_KEY. Changing any of these makes the values encrypted so far unreadable
+KDF_SALT = b"usc-sign-in-bot"
+KDF_ITERATIONS = 600_000
+
+# Keys of users and lessons are the first bytes of a SHA-256 digest in URL-safe base64. A multiple
+# of 3 bytes has no base64 padding, 12 bytes give keys of 16 characters
+HASH_KEY_BYTES = 12
+
+# Keys from before, the first 60 characters of the hexadecimal digest
+LEGACY_HASH_KEY_LENGTH = 60
+
+# Lessons broadcast to a group chat have a key of their own, told apart from the keys of the lessons
+# of users by this prefix. Base64 and hexadecimal keys never start with it
+BROADCAST_KEY_PREFIX = "#"
+
+# The padding is the same for every value, so it is created only once
+_PADDING = padding.PKCS7(128)
+
+# Deriving a key is slow on purpose, make sure it's done only once per key, even across threads
+_setup_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8)
+def _derive_key(encrypt_key: str) -> bytes:
+    """Derive the AES key from the encryption key, only call this while holding `_setup_lock`"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32, salt=KDF_SALT, iterations=KDF_ITERATIONS
+    )
+    return kdf.derive(encrypt_key.encode("utf-8"))
 
-    def __init__(self, encrypt_key: str):
+
+def _key_id(derived_key: bytes) -> str:
+    """Return the id of a derived key, a fingerprint from which the key can't be recovered"""
+    return hashlib.sha256(derived_key).hexdigest()[:8]
+
+
+class Encryptor:
+    """
+    Hold and use encryption functions for a specific entryption key.
+
+    The AES key is derived from the encryption key with PBKDF2 when it is first needed, or on
+    `derive_keys`, and the derived key is shared by all encryptors with the same encryption key in
+    this process. Values are encrypted with AES in CBC mode with a random IV for every value, and
+    prefixed with the id of the key.
+
+    To rotate the key, set the new key as the encryption key and the old one as the previous key.
+    Values are always encrypted with the encryption key, and decrypted with the key they were
+    encrypted with. Values from before the key ids belong to the previous key if there is one, and
+    to the encryption key otherwise.
+
+    Parameters
+    ----------
+    encrypt_key : str
+        The key to encrypt with.
+    previous_key : str, optional
+        The key that was used before the encryption key, to decrypt the values not rotated yet.
+    """
+
+    def __init__(self, encrypt_key: str, previous_key: str = None):
         self._key = encrypt_key
+        self._previous_key = previous_key
+        self._key_id = None
+        self._algorithms = None
 
     @staticmethod
     def generate_hash_key(hash_str: str) -> str:
         """Create a hashed key based on sport and datetime"""
         # Create a SHA_256 hash for the combined string
-        hash_object = hashlib.sha256(hash_str.encode())
+        digest = hashlib.sha256(hash_str.encode()).digest()
 
-        # Return the hexadecimal string of the hash. Only get the first 60 characters as the
-        # fuckers at telegrem does not support longer than 64 characters and we need to add some
-        # other info as well
-        return hash_object.hexdigest()[:60]
+        # Return the first bytes in base64, such that the key is short in the indexes and leaves
+        # room in the 64 bytes of callback data Telegram allows
+        return urlsafe_b64encode(digest[:HASH_KEY_BYTES]).decode("ascii")
 
-    def _get_key(self) -> str:
-        """Return the padded an encoded key"""
-        return self._key.ljust(32)[:32].encode("utf-8")
+    @staticmethod
+    def is_legacy_key(key: str) -> bool:
+        """Return whether the key is a hexadecimal key from before the compact keys"""
+        return len(key) == LEGACY_HASH_KEY_LENGTH
+
+    @staticmethod
+    def compact_legacy_key(key: str) -> str:
+        """Return the compact key of a legacy key, the same key `generate_hash_key` creates now"""
+        # Both keys start with the same digest, so the hash itself is not needed
+        digest = bytes.fromhex(key[: 2 * HASH_KEY_BYTES])
+        return urlsafe_b64encode(digest).decode("ascii")
+
+    @staticmethod
+    def generate_broadcast_key(hash_str: str) -> str:
+        """Create a hashed key for a lesson broadcast to a group chat"""
+        return BROADCAST_KEY_PREFIX + Encryptor.generate_hash_key(hash_str)
+
+    @staticmethod
+    def is_broadcast_key(key: str) -> bool:
+        """Return whether the key belongs to a lesson broadcast to a group chat"""
+        return key.startswith(BROADCAST_KEY_PREFIX)
+
+    @property
+    def key_id(self) -> str:
+        """The id of the key new values are encrypted with"""
+        self._setup()
+        return self._key_id
+
+    def derive_keys(self) -> None:
+        """Derive the keys now instead of on first use, e.g. in a thread at start up"""
+        self._setup()
+
+    def _get_legacy_key(self) -> bytes:
+        """Return the padded and encoded key, which values without a key id use"""
+        return (self._previous_key or self._key).ljust(32)[:32].encode("utf-8")
+
+    def _setup(self) -> dict[str, algorithms.AES]:
+        """Return the algorithms by the key id they belong to, setting them up once"""
+        if self._algorithms is None:
+            with _setup_lock:
+                if self._algorithms is None:
+                    derived_key = _derive_key(self._key)
+                    legacy_key = _derive_key(self._previous_key or self._key)
+
+                    self._key_id = _key_id(derived_key)
+                    self._algorithms = {
+                        "": algorithms.AES(self._get_legacy_key()),
+                        _key_id(legacy_key): algorithms.AES(legacy_key),
+                        self._key_id: algorithms.AES(derived_key),
+                    }
+
+        return self._algorithms
+
+    def needs_rotation(self, encrypted_data: str) -> bool:
+        """Return whether the value is encrypted with another key than the encryption key"""
+        return not encrypted_data.startswith(self.key_id + SEPARATOR)
 
     def encrypt_data(self, text_to_be_encripted: str) -> str:
         """Encrypt the data using the key in the object"""
+        return self._encrypt(os.urandom(16), text_to_be_encripted)
 
-        # Get the encription key from the environment
-        key = self._get_key()
+    def encrypt_many(self, texts: list[str]) -> list[str]:
+        """Encrypt several values in one go, e.g. to re-encrypt the passwords of all users"""
+        # Get the random IVs of all the values at once
+        rand_ivs = os.urandom(16 * len(texts))
 
-        # Use the cipher with AES algorithm in CBC mode and add a random IV
-        rand_iv = os.urandom(16)
-        cipher = Cipher(
-            algorithms.AES(key), modes.CBC(rand_iv), backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
+        return [
+            self._encrypt(rand_ivs[i * 16 : (i + 1) * 16], text)
+            for i, text in enumerate(texts)
+        ]
+
+    def decrypt_data(self, encrypted_data: str) -> str:
+        """Decrypt the object as given earlier"""
+        return self._decrypt(encrypted_data)
+
+    def decrypt_many(self, encrypted_values: list[str]) -> list[str]:
+        """Decrypt several values in one go, e.g. to load the passwords of all users"""
+        return [self._decrypt(value) for value in encrypted_values]
+
+    def _encrypt(self, rand_iv: bytes, text: str) -> str:
+        """Encrypt a single value with the encryption key and the IV"""
+        algorithm = self._setup()[self._key_id]
+        encryptor = Cipher(algorithm, modes.CBC(rand_iv)).encryptor()
 
         # pad the plaintext such that it becomes a multiple of the wanted block size
-        padder = padding.PKCS7(128).padder()
-        padded_data = (
-            padder.update(text_to_be_encripted.encode("utf-8")) + padder.finalize()
-        )
+        padder = _PADDING.padder()
+        padded_data = padder.update(text.encode("utf-8")) + padder.finalize()
 
         # Encrypt the padded data
         ciphertext = encryptor.update(padded_data) + encryptor.finalize()
 
-        # Return the IV and the ciphertext, for easy storage
-        return b64encode(rand_iv + ciphertext).decode("utf-8")
+        # Return the key id, IV and the ciphertext, for easy storage
+        return (
+            self._key_id + SEPARATOR + b64encode(rand_iv + ciphertext).decode("utf-8")
+        )
 
-    def decrypt_data(self, encrypted_data: str) -> str:
-        """Decrypt the object as given earlier"""
+    def _decrypt(self, encrypted_data: str) -> str:
+        """Decrypt a single value, with the key its key id points to"""
+        # Base64 has no separator in it, so values without a key id have an empty key id
+        key_id, _, encrypted_data = encrypted_data.rpartition(SEPARATOR)
 
-        # Get the encription key from the environment
-        key = self._get_key()
+        algorithm = self._setup().get(key_id)
+        if algorithm is None:
+            raise ValueError(f"Value is encrypted with an unknown key {key_id}")
 
         # Decode the base64-encoded text
         ciphertext = b64decode(encrypted_data)
@@ -67,17 +201,12 @@ class Encryptor:
         # split the data in the random string and the actual encrypted text
         rand_iv, actual_ciphertext = ciphertext[:16], ciphertext[16:]
 
-        # Now create the right decryptor objects to decrypt the text
-        cipher = Cipher(
-            algorithms.AES(key), modes.CBC(rand_iv), backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-
         # Decrypt the actual decrypted text
+        decryptor = Cipher(algorithm, modes.CBC(rand_iv)).decryptor()
         padded_plaintext = decryptor.update(actual_ciphertext) + decryptor.finalize()
 
         # Now unpadd the text
-        unpadder = padding.PKCS7(128).unpadder()
+        unpadder = _PADDING.unpadder()
         plaintext = unpadder.update(padded_plaintext) + unpadder.finalize()
 
         return plaintext.decode("utf-8")
@@ -0,0 +1,93 @@
+"""Module for coalescing duplicate requests onto the one that is already running"""
+
+import asyncio
+import contextlib
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightRegistry:
+    """
+    Keep track of the calls that are running by their key, such that a duplicate call for the same
+    key waits for the running one instead of doing the work again.
+
+    This only coalesces the calls within this process. Work that must happen only once across
+    processes, like booking a lesson, needs an atomic claim in the database as well, which the
+    first call makes. A duplicate that comes in while the first call runs costs a lookup in the
+    registry, a duplicate that comes in after costs the claim.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._calls
+
+    async def run(
+        self, key: str, function: Callable[..., Awaitable[Any]], *args
+    ) -> tuple[bool, Any]:
+        """
+        Run the coroutine function for the key, or wait for the call already running for it.
+
+        Parameters
+        ----------
+        key : str
+            The key of the work, calls with the same key do the same work.
+        function : callable
+            The coroutine function doing the work, called with the arguments.
+        *args
+            The arguments to call the function with.
+
+        Returns
+        -------
+        tuple
+            Whether this call did the work, and the result of the work. Calls that waited for
+            another call get None as result, errors are only raised to the call that did the work.
+        """
+        running = self._calls.get(key)
+        if running is not None:
+            logger.info("Waiting for the running call for %s", key)
+            await asyncio.wait({running})
+            return False, None
+
+        task = asyncio.ensure_future(function(*args))
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # Don't cancel the work when the caller is cancelled, duplicates might wait for it
+        return True, await asyncio.shield(task)
+
+
+class KeyedLocks:
+    """
+    Hold a lock per key, such that the work for the same key is done one at a time while the work
+    for other keys goes on. A lock is only kept while it is held or waited for.
+    """
+
+    def __init__(self):
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+        self._waiting: dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """Hold the lock of the key for the duration of the block"""
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+
+        try:
+            async with lock:
+                yield
+
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
@@ -0,0 +1,70 @@
+"""Module for rotating the key the passwords of the users are encrypted with"""
+
+import logging
+import os
+import time
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+
+# The number of passwords that are re-encrypted and updated at once
+ROTATION_BATCH_SIZE = int(os.environ.get("ROTATION_BATCH_SIZE", 500))
+
+# The number of seconds to wait between batches, to leave room for the live traffic
+ROTATION_PAUSE = float(os.environ.get("ROTATION_PAUSE", 0.5))
+
+logger = logging.getLogger(__name__)
+
+
+def rotate_passwords(
+    usc_db: UscDataBase,
+    batch_size: int = ROTATION_BATCH_SIZE,
+    pause: float = ROTATION_PAUSE,
+) -> int:
+    """
+    Re-encrypt the passwords that are not encrypted with the current key yet.
+
+    The passwords are streamed from the database in batches, and every batch is decrypted,
+    encrypted with the current key and written back in a single update. Every batch is committed
+    on its own, so an interrupted rotation continues with the passwords that are left when it is
+    started again.
+
+    Parameters
+    ----------
+    usc_db : UscDataBase
+        The database holding the passwords, with the new key as the encryption key and the old key
+        as the previous key.
+    batch_size : int, optional
+        The number of passwords to re-encrypt at once.
+    pause : float, optional
+        The number of seconds to wait after every batch.
+
+    Returns
+    -------
+    int
+        The number of passwords that were re-encrypted.
+    """
+    encryptor = usc_db.encrypt
+    rotated = 0
+
+    for batch in usc_db.iter_passwords_to_rotate(encryptor.key_id, batch_size):
+        user_ids, passwords = zip(*batch)
+        new_passwords = encryptor.encrypt_many(encryptor.decrypt_many(passwords))
+
+        rotated += usc_db.update_passwords(
+            list(zip(user_ids, passwords, new_passwords))
+        )
+        logger.info("Re-encrypted %s passwords", rotated)
+
+        time.sleep(pause)
+
+    return rotated
+
+
+def run_key_rotation() -> None:
+    """Re-encrypt all the passwords with the current key, can safely run next to the bot"""
+    with UscDataBase(create_if_not_exists=False) as usc_db:
+        rotated = rotate_passwords(usc_db)
+
+    logger.info(
+        "Re-encrypted %s passwords, ENCRYPT_KEY_PREVIOUS is no longer needed", rotated
+    )
@@ -0,0 +1,153 @@
+"""Module for the maintenance of the database, keeping the partitions of the lessons in order"""
+
+import logging
+import os
+from datetime import datetime as dt
+from datetime import timedelta
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+
+# The number of months ahead for which partitions are created
+PARTITION_MONTHS_AHEAD = int(os.environ.get("LESSON_PARTITION_MONTHS_AHEAD", 2))
+
+# The number of months of lessons that are kept in the database, older months are archived
+RETENTION_MONTHS = int(os.environ.get("LESSON_RETENTION_MONTHS", 6))
+
+# The directory the archived lessons are written to
+ARCHIVE_DIR = os.environ.get("LESSON_ARCHIVE_DIR", "archive")
+
+# The number of days the legacy keys of the lessons keep working in the buttons of older messages
+LESSON_KEY_ALIAS_DAYS = int(os.environ.get("LESSON_KEY_ALIAS_DAYS", 30))
+
+logger = logging.getLogger(__name__)
+
+
+def add_months(month: dt, months: int) -> dt:
+    """Return the first day of the month the given number of months after the given month"""
+    month_index = month.year * 12 + month.month - 1 + months
+    return dt(month_index // 12, month_index % 12 + 1, 1)
+
+
+def ensure_lesson_partitions(
+    usc_db: UscDataBase, now: dt = None, months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> list[str]:
+    """
+    Make sure there are partitions for the lessons of this month and the coming months.
+
+    Older databases with a plain lessons table are converted into a partitioned table first.
+
+    Parameters
+    ----------
+    usc_db : UscDataBase
+        The database to create the partitions in.
+    now : datetime.datetime, optional
+        The current time, defaults to now.
+    months_ahead : int, optional
+        The number of months after the current month to create partitions for.
+
+    Returns
+    -------
+    list of str
+        The names of the partitions for the current and coming months, empty if the backend has no
+        partitions.
+    """
+    now = now or dt.now()
+
+    # Backends without partitions keep all the lessons in a single table
+    if not usc_db.backend.supports_partitions:
+        return []
+
+    if not usc_db.lessons_partitioned():
+        usc_db.partition_lessons()
+
+    return [
+        usc_db.create_lesson_partition(add_months(now, months))
+        for months in range(months_ahead + 1)
+    ]
+
+
+def archive_old_lessons(
+    usc_db: UscDataBase,
+    now: dt = None,
+    retention_months: int = RETENTION_MONTHS,
+    archive_dir: str = ARCHIVE_DIR,
+) -> list[str]:
+    """
+    Archive the partitions of lessons older than the retention period to compressed files.
+
+    Parameters
+    ----------
+    usc_db : UscDataBase
+        The database to archive the partitions of.
+    now : datetime.datetime, optional
+        The current time, defaults to now.
+    retention_months : int, optional
+        The number of months before the current month that are kept in the database.
+    archive_dir : str, optional
+        The directory to write the archive files to, one gzipped CSV file per month.
+
+    Returns
+    -------
+    list of str
+        The paths of the archive files that were written.
+    """
+    if not usc_db.backend.supports_partitions:
+        return []
+
+    cutoff = add_months(now or dt.now(), -retention_months)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    archived = []
+    for name, month in sorted(usc_db.get_lesson_partitions().items()):
+        if month >= cutoff:
+            continue
+
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        usc_db.archive_lesson_partition(name, path)
+        archived.append(path)
+
+    return archived
+
+
+def expire_lesson_key_aliases(
+    usc_db: UscDataBase, now: dt = None, alias_days: int = LESSON_KEY_ALIAS_DAYS
+) -> int:
+    """
+    Remove the legacy keys of lessons that were compacted longer than `alias_days` days ago.
+
+    By then the lessons of the messages with the legacy keys are over, so their buttons are of no
+    use anymore.
+
+    Parameters
+    ----------
+    usc_db : UscDataBase
+        The database to remove the legacy keys from.
+    now : datetime.datetime, optional
+        The current time, defaults to now.
+    alias_days : int, optional
+        The number of days the legacy keys are kept.
+
+    Returns
+    -------
+    int
+        The number of legacy keys that were removed.
+    """
+    return usc_db.purge_lesson_key_aliases(
+        (now or dt.now()) - timedelta(days=alias_days)
+    )
+
+
+def run_maintenance() -> None:
+    """Run all the maintenance on the database, best done daily in a cronjob"""
+    with UscDataBase() as usc_db:
+        compacted = usc_db.compact_keys()
+        logger.info("Compacted %s legacy keys", compacted)
+
+        expired = expire_lesson_key_aliases(usc_db)
+        logger.info("Removed %s expired legacy lesson keys", expired)
+
+        partitions = ensure_lesson_partitions(usc_db)
+        logger.info("Lesson partitions up to date: %s", ", ".join(partitions))
+
+        archived = archive_old_lessons(usc_db)
+        logger.info("Archived %s lesson partitions", len(archived))
@@ -0,0 +1,178 @@
+"""Render the messages that are sent to the users in this module"""
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from usc_sign_in_bot.models import Lesson, ScheduledLesson
+
+
+def lesson_message(les: dict) -> str:
+    """Return the text asking the user if they want to go to the lesson"""
+    return (
+        f"There is a fencing lesson {les['time'].strftime('%A')} at "
+        + les["time"].strftime("%H:%M")
+        + f". The trainer is {les['trainer']}. Would you like to go?"
+    )
+
+
+def lesson_markup(key_les: str) -> InlineKeyboardMarkup:
+    """Return the buttons for the user to answer the question about the lesson with"""
+    return InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("Yes", callback_data=key_les + ",Y")],
+            [InlineKeyboardButton("No", callback_data=key_les + ",N")],
+        ]
+    )
+
+
+def digest_message(lessons: list[dict]) -> str:
+    """Return the text asking the user which of the lessons they want to go to, numbered"""
+    lines = [
+        f"{number}. "
+        + (
+            cancelled_message(les)
+            if les.get("cancelled")
+            else f"{les['time'].strftime('%A')} at {les['time'].strftime('%H:%M')}"
+            + f", the trainer is {les['trainer']}."
+        )
+        for number, les in enumerate(lessons, 1)
+    ]
+    return (
+        "There are new fencing lessons:\n"
+        + "\n".join(lines)
+        + "\nWhich would you like to go to?"
+    )
+
+
+def digest_markup(keys: list[str], open_keys: set[str] = None) -> InlineKeyboardMarkup:
+    """
+    Return a row of buttons for every lesson of a digest, numbered as in its text.
+
+    Parameters
+    ----------
+    keys : list of str
+        The keys of all the lessons of the digest, in the order of its text.
+    open_keys : set of str, optional
+        The keys of the lessons that can still be answered, defaults to all of them.
+    """
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(f"{number}: Yes", callback_data=key + ",Y"),
+                InlineKeyboardButton(f"{number}: No", callback_data=key + ",N"),
+            ]
+            for number, key in enumerate(keys, 1)
+            if open_keys is None or key in open_keys
+        ]
+    )
+
+
+def outbox_markup(keys: list[str]) -> InlineKeyboardMarkup:
+    """Return the buttons for a message from the outbox, about a single lesson or a digest"""
+    if len(keys) == 1:
+        return lesson_markup(keys[0])
+    return digest_markup(keys)
+
+
+def answer_markup(
+    markup: InlineKeyboardMarkup | None, key_les: str
+) -> tuple[str | None, InlineKeyboardMarkup | None]:
+    """
+    Take the buttons of an answered lesson off the buttons of its message.
+
+    Parameters
+    ----------
+    markup : telegram.InlineKeyboardMarkup or None
+        The buttons of the message the lesson was answered in.
+    key_les : str
+        The key of the lesson that was answered.
+
+    Returns
+    -------
+    str or None
+        The number of the lesson in the digest, None if the message was about this lesson alone.
+    telegram.InlineKeyboardMarkup or None
+        The buttons of the other lessons of the digest, None if there are none left to answer.
+    """
+    number = None
+    rows = []
+    for row in markup.inline_keyboard if markup else ():
+        answered = [
+            button
+            for button in row
+            if str(button.callback_data).startswith(key_les + ",")
+        ]
+        if not answered:
+            rows.append(row)
+        elif ":" in answered[0].text:
+            number = answered[0].text.partition(":")[0]
+
+    return number, InlineKeyboardMarkup(rows) if rows else None
+
+
+def choice_message(response: str, number: str = None) -> str:
+    """Return the line telling the user their answer to a lesson was recorded"""
+    lesson = f" for lesson {number}" if number else ""
+    text_choice = "Yes" if response == "Y" else "No"
+    return f"We have recorded your choice{lesson} as being {text_choice}. Good luck!"
+
+
+def updated_message(lessons: list[Lesson]) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+    Render a sent message again, after its lessons changed or were cancelled.
+
+    Parameters
+    ----------
+    lessons : list of Lesson
+        The lessons of the message as they are now, in the order of the message.
+
+    Returns
+    -------
+    str
+        The new text of the message, with the answers recorded so far.
+    telegram.InlineKeyboardMarkup or None
+        The buttons of the lessons that can still be answered, None if there are none.
+    """
+    scraped = [
+        {"time": les.datetime, "trainer": les.trainer, "cancelled": les.cancelled}
+        for les in lessons
+    ]
+    open_keys = {
+        les.lesson_id for les in lessons if not les.cancelled and les.response is None
+    }
+
+    if len(lessons) == 1:
+        (les,) = lessons
+        text = (
+            cancelled_message(scraped[0])
+            if les.cancelled
+            else lesson_message(scraped[0])
+        )
+        if les.response is not None:
+            text += "\n\n" + choice_message(les.response)
+        return text, lesson_markup(les.lesson_id) if open_keys else None
+
+    text = digest_message(scraped)
+    for number, les in enumerate(lessons, 1):
+        if les.response is not None:
+            text += "\n\n" + choice_message(les.response, str(number))
+
+    keys = [les.lesson_id for les in lessons]
+    return text, digest_markup(keys, open_keys) if open_keys else None
+
+
+def cancelled_message(les: dict) -> str:
+    """Return the text telling the user the lesson was cancelled"""
+    return (
+        f"The fencing lesson {les['time'].strftime('%A')} at "
+        + les["time"].strftime("%H:%M")
+        + " has been cancelled."
+    )
+
+
+def schedule_day_message(lessons: list[ScheduledLesson]) -> str:
+    """Return the lessons of a single day as they are listed by the /lessons command"""
+    lines = [
+        f"{les.datetime.strftime('%H:%M')}, the trainer is {les.trainer}"
+        for les in lessons
+    ]
+    return lessons[0].datetime.strftime("%A %d %B") + ":\n" + "\n".join(lines)
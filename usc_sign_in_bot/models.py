@@ -0,0 +1,237 @@
+"""Hold the row objects that are returned by the database in this module"""
+
+from datetime import datetime as dt
+
+from usc_sign_in_bot.encryptor import Encryptor
+
+
+class Row:
+    """
+    Base for a row of the database with a fixed set of columns.
+
+    Rows use `__slots__` instead of a dictionary per row, which keeps them small when many of them
+    are held at once. A row can be created with only part of its columns, the other columns are
+    None then. For compatibility with the dictionaries the database used to return, the columns can
+    also be read as `row["column"]`.
+
+    Rows are read-only once created, such that the same row can safely be shared.
+
+    Parameters
+    ----------
+    values : sequence
+        The values of the row, in the order of `columns`.
+    columns : tuple of str, optional
+        The columns the values belong to. Defaults to all the columns of the row.
+    """
+
+    __slots__ = ("_columns",)
+
+    _columns: tuple[str, ...]
+
+    # The columns of the row, in the order they are selected in
+    COLUMNS: tuple[str, ...] = ()
+
+    # Columns that are stored under another attribute name
+    _STORED_AS: dict[str, str] = {}
+
+    def __init__(self, values, columns: tuple[str, ...] = None):
+        columns = columns or self.COLUMNS
+        object.__setattr__(self, "_columns", columns)
+
+        # Columns that are not selected are None, the others get their value
+        for col in self.COLUMNS:
+            object.__setattr__(self, self._STORED_AS.get(col, col), None)
+
+        for col, value in zip(columns, values):
+            object.__setattr__(self, self._STORED_AS.get(col, col), value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __getitem__(self, key: str) -> object:
+        if key not in self.COLUMNS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._columns
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Row):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        # Don't show the columns stored under another name, as those hold the passwords
+        values = ", ".join(
+            f"{col}={'***' if col in self._STORED_AS else repr(getattr(self, col))}"
+            for col in self._columns
+        )
+        return f"{type(self).__name__}({values})"
+
+    def keys(self) -> tuple[str, ...]:
+        """Return the columns that were selected for this row"""
+        return self._columns
+
+    def get(self, key: str, default: object = None) -> object:
+        """Return the value of a column, or the default if the column was not selected"""
+        return getattr(self, key) if key in self._columns else default
+
+    def to_dict(self) -> dict[str, object]:
+        """Return the selected columns of the row as a dictionary"""
+        return {col: getattr(self, col) for col in self._columns}
+
+
+class _EncryptedPasswordRow(Row):
+    """Row holding an encrypted password, which is only decrypted once it is read"""
+
+    __slots__ = ("_encrypted_password", "_password", "_encryptor")
+
+    _encrypted_password: str | None
+    _password: str | None
+    _encryptor: Encryptor
+
+    _STORED_AS = {"password": "_encrypted_password"}
+
+    def __init__(
+        self, values, columns: tuple[str, ...] = None, encryptor: Encryptor = None
+    ):
+        super().__init__(values, columns)
+        object.__setattr__(self, "_password", None)
+        object.__setattr__(self, "_encryptor", encryptor)
+
+    @property
+    def password(self) -> str | None:
+        """The decrypted password, decrypted on first access"""
+        if self._password is None and self._encrypted_password is not None:
+            object.__setattr__(
+                self,
+                "_password",
+                self._encryptor.decrypt_data(self._encrypted_password),
+            )
+        return self._password
+
+
+class User(_EncryptedPasswordRow):
+    """A row of the `users` table"""
+
+    __slots__ = (
+        "user_id",
+        "sign_up_date",
+        "login_method",
+        "sport",
+        "username",
+        "telegram_id",
+    )
+
+    COLUMNS = (
+        "user_id",
+        "sign_up_date",
+        "login_method",
+        "sport",
+        "username",
+        "password",
+        "telegram_id",
+    )
+
+    user_id: str
+    sign_up_date: dt
+    login_method: str
+    sport: str
+    username: str
+    telegram_id: int
+
+
+class Lesson(Row):
+    """A row of the `lessons` table, which is a lesson as sent to a single user"""
+
+    __slots__ = (
+        "lesson_id",
+        "user_id",
+        "datetime",
+        "sport",
+        "trainer",
+        "message_sent",
+        "response",
+        "cancelled",
+    )
+
+    COLUMNS = __slots__
+
+    lesson_id: str
+    user_id: str
+    datetime: dt
+    sport: str
+    trainer: str
+    message_sent: bool
+    response: str
+    cancelled: bool
+
+
+class Notification(_EncryptedPasswordRow):
+    """A lesson joined with the login fields of the user it was sent to, to act on a response"""
+
+    __slots__ = ("sport", "datetime", "username", "login_method")
+
+    COLUMNS = ("sport", "datetime", "username", "password", "login_method")
+
+    sport: str
+    datetime: dt
+    username: str
+    login_method: str
+
+
+# A digest asks about several lessons, their ids are stored in the single lesson id column of the
+# outbox. The keys are base64 or hexadecimal, so they never hold the separator
+LESSON_ID_SEPARATOR = " "
+
+
+class OutboxMessage(Row):
+    """A row of the `outbox` table, a message waiting to be sent by the bot"""
+
+    __slots__ = (
+        "outbox_id",
+        "telegram_id",
+        "lesson_id",
+        "text",
+        "attempts",
+        "message_id",
+        "reply_markup",
+    )
+
+    COLUMNS = __slots__
+
+    outbox_id: int
+    telegram_id: int
+    lesson_id: str
+    text: str
+    attempts: int
+    message_id: int
+    reply_markup: str
+
+    @property
+    def lesson_ids(self) -> list[str]:
+        """The ids of the lessons the message asks about, several for a digest"""
+        return self.lesson_id.split(LESSON_ID_SEPARATOR)
+
+    @property
+    def is_edit(self) -> bool:
+        """Whether the message is an edit of a message that was sent before"""
+        return self.message_id is not None
+
+
+class ScheduledLesson(Row):
+    """A row of the `schedule` table, a lesson as it was found by the last scrape"""
+
+    __slots__ = ("sport", "datetime", "trainer", "scraped_at")
+
+    COLUMNS = __slots__
+
+    sport: str
+    datetime: dt
+    trainer: str
+    scraped_at: dt
@@ -0,0 +1,283 @@
+"""Module for sending the messages the job has put in the outbox, from the long-running bot"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+from datetime import datetime as dt
+from datetime import timedelta
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.messages import outbox_markup
+from usc_sign_in_bot.models import OutboxMessage
+from usc_sign_in_bot.telegram_request import make_request
+
+# The maximum number of messages that are claimed from the outbox at once
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+
+# The maximum number of messages sent per second, Telegram allows about 30 in total
+OUTBOX_MESSAGES_PER_SECOND = float(os.environ.get("OUTBOX_MESSAGES_PER_SECOND", 25))
+
+# The number of seconds after which the outbox is checked even without a notification
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", 60))
+
+# The number of attempts after which a message is given up on
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5))
+
+# The number of seconds before the first retry, doubled for every next attempt
+OUTBOX_RETRY_DELAY = float(os.environ.get("OUTBOX_RETRY_DELAY", 30))
+
+# The number of seconds a dispatcher has to send a message before another one may claim it again
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", 300))
+
+logger = logging.getLogger(__name__)
+
+
+# pylint: disable=too-many-instance-attributes
+class OutboxDispatcher:
+    """
+    Send the messages from the outbox through the bot, at a limited rate.
+
+    The job adds messages to the outbox and notifies the `usc_outbox` channel. The dispatcher
+    listens on that channel and drains the outbox in batches whenever it is notified. The outbox is
+    also drained on start and every `poll_interval` seconds, such that messages added while the bot
+    was not listening, and messages that are due for a retry, are still sent.
+
+    A message is only marked as sent once Telegram accepted it. Messages that failed because of the
+    network or flood control are retried with an exponential backoff, up to `OUTBOX_MAX_ATTEMPTS`
+    attempts. Messages Telegram refuses are not retried, and if the user blocked the bot or their
+    chat is gone, the user is deactivated such that the job skips them from then on.
+    Several dispatchers can drain the same outbox, as every message is claimed by only one of them.
+    Messages that have a message id already are edits of a message sent before, e.g. because its
+    lesson changed, and are edited instead of sent.
+
+    Parameters
+    ----------
+    bot : telegram.Bot
+        The bot to send the messages with.
+    batch_size : int, optional
+        The maximum number of messages claimed from the outbox at once.
+    messages_per_second : float, optional
+        The maximum number of messages sent per second.
+    poll_interval : float, optional
+        The number of seconds after which the outbox is checked without a notification.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        messages_per_second: float = OUTBOX_MESSAGES_PER_SECOND,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+    ):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.messages_per_second = messages_per_second
+        self.poll_interval = poll_interval
+
+        self.database = None
+        self.listener = None
+        self._connections = contextlib.ExitStack()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._next_send = 0.0
+
+    async def start(self) -> None:
+        """Start listening for notifications and sending the messages in the background"""
+        self.database = self._connections.enter_context(
+            UscDataBase(create_if_not_exists=False)
+        )
+
+        # Listen on a separate connection, as listening needs autocommit. Without notifications the
+        # outbox is only checked every poll interval
+        if self.database.backend.supports_notify:
+            self.listener = self._connections.enter_context(
+                UscDataBase(create_if_not_exists=False)
+            )
+            self.listener.listen_for_outbox()
+            asyncio.get_running_loop().add_reader(
+                self.listener.conn.fileno(), self._on_notification
+            )
+
+        self._task = asyncio.create_task(self.run())
+        logger.info("Sending the messages from the outbox")
+
+    async def stop(self) -> None:
+        """Stop sending messages and close the connections to the database"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+        if self.listener is not None:
+            asyncio.get_running_loop().remove_reader(self.listener.conn.fileno())
+
+        self._connections.close()
+
+    def _on_notification(self) -> None:
+        """Wake up the dispatcher when the job has added messages to the outbox"""
+        if self.listener.process_outbox_notifications():
+            self._wakeup.set()
+
+    async def run(self) -> None:
+        """Drain the outbox every time we are woken up, until cancelled"""
+        while True:
+            # Clear before draining, such that notifications during the drain cause another drain
+            self._wakeup.clear()
+
+            try:
+                await self.drain()
+
+            # Keep the dispatcher alive, the messages are picked up again on the next drain
+            # pylint: disable=broad-exception-caught
+            except Exception as error:
+                logger.error("Could not drain the outbox: %s", error)
+
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    async def drain(self) -> int:
+        """Send all the messages in the outbox, return the number of messages sent"""
+        count = 0
+
+        while batch := self.database.claim_outbox(
+            self.batch_size, lease=timedelta(seconds=OUTBOX_LEASE)
+        ):
+            tasks = []
+            for message in batch:
+                await self._throttle()
+                tasks.append(asyncio.create_task(self.send(message)))
+
+            await asyncio.gather(*tasks)
+            count += len(batch)
+
+        if count:
+            logger.info("Sent %s messages from the outbox", count)
+
+        return count
+
+    async def send(self, message: OutboxMessage) -> None:
+        """Send a single message from the outbox with the buttons to answer it, and record it"""
+        try:
+            if message.is_edit:
+                await self._edit(message)
+                sent = message
+            else:
+                sent = await self.bot.send_message(
+                    message.telegram_id,
+                    message.text,
+                    reply_markup=outbox_markup(message.lesson_ids),
+                )
+
+        # Respect the flood control of Telegram, this does not count as a failure of the message
+        except RetryAfter as error:
+            self._retry(message, error, delay=error.retry_after)
+
+        # The user blocked the bot, stop sending to them at all until they /start again
+        except Forbidden as error:
+            self._deactivate(message, error)
+
+        # If the action is not possible, retrying won't help
+        except BadRequest as error:
+            if "chat not found" in str(error).lower():
+                self._deactivate(message, error)
+                return
+
+            logger.error(
+                "Could not send message %s, with error message: %s",
+                message.outbox_id,
+                error,
+            )
+            self.database.mark_outbox_failed(message.outbox_id, str(error))
+
+        except TelegramError as error:
+            self._retry(message, error)
+
+        else:
+            self.database.mark_outbox_sent(message.outbox_id, sent.message_id)
+
+    async def _edit(self, message: OutboxMessage) -> None:
+        """Edit a message that was sent before, with the buttons it keeps"""
+        markup = None
+        if message.reply_markup is not None:
+            markup = InlineKeyboardMarkup.de_json(
+                json.loads(message.reply_markup), self.bot
+            )
+
+        try:
+            await self.bot.edit_message_text(
+                message.text,
+                chat_id=message.telegram_id,
+                message_id=message.message_id,
+                reply_markup=markup,
+            )
+
+        # Editing the message into what it is already counts as done
+        except BadRequest as error:
+            if "message is not modified" not in str(error).lower():
+                raise
+
+    def _deactivate(self, message: OutboxMessage, error: TelegramError) -> None:
+        """Fail the message and deactivate the user it was for, who can't be reached anymore"""
+        logger.warning(
+            "Deactivating the user of message %s, with error message: %s",
+            message.outbox_id,
+            error,
+        )
+        self.database.mark_outbox_failed(message.outbox_id, str(error))
+        self.database.deactivate_user(message.telegram_id, str(error))
+
+    def _retry(
+        self, message: OutboxMessage, error: TelegramError, delay: float = None
+    ) -> None:
+        """Send the message again later, or give up on it after too many attempts"""
+        if delay is None and message.attempts >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(
+                "Giving up on message %s after %s attempts: %s",
+                message.outbox_id,
+                message.attempts,
+                error,
+            )
+            self.database.mark_outbox_failed(message.outbox_id, str(error))
+            return
+
+        if delay is None:
+            delay = OUTBOX_RETRY_DELAY * 2 ** (message.attempts - 1)
+
+        logger.warning(
+            "Retrying message %s in %s seconds: %s", message.outbox_id, delay, error
+        )
+        self.database.mark_outbox_failed(
+            message.outbox_id, str(error), retry_at=dt.now() + timedelta(seconds=delay)
+        )
+
+    async def _throttle(self) -> None:
+        """Wait until the next message may be sent according to the rate limit"""
+        loop = asyncio.get_running_loop()
+
+        wait = self._next_send - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        self._next_send = (
+            max(self._next_send, loop.time()) + 1 / self.messages_per_second
+        )
+
+
+async def run_dispatcher() -> None:
+    """Run a dispatcher on its own, without the rest of the bot, until it is stopped"""
+    # Every message of a batch may be sent at once, so they all get a connection of their own
+    async with Bot(
+        os.environ["BOTTOKEN"], request=make_request(OUTBOX_BATCH_SIZE)
+    ) as bot:
+        dispatcher = OutboxDispatcher(bot)
+        await dispatcher.start()
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await dispatcher.stop()
@@ -0,0 +1,130 @@
+"""Module for storing the state of the conversations of the bot in the database"""
+
+import asyncio
+import json
+import logging
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+
+# The number of seconds between writing the changed conversations to the database
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 10))
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Store the state of the conversations in the database, such that a restarted bot continues
+    the sign ups where they were.
+
+    The bot itself only keeps the conversations, so the user, chat, bot and callback data are not
+    stored. The application hands the changed conversations over every `update_interval` seconds,
+    and once more when it stops. A conversation that changed several times since is only handed
+    over once, and all the conversations handed over at once are written in a single transaction.
+
+    The conversations are read when the bot starts, so a bot started next to a running one
+    continues the conversations as they were at that moment.
+
+    Parameters
+    ----------
+    update_interval : float, optional
+        The number of seconds between writing the changed conversations to the database.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=False, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.database = None
+        self._pending: dict[tuple[str, str], str | None] = {}
+
+    def _get_database(self) -> UscDataBase:
+        """Return the connection to the database, connecting when it is first needed"""
+        if self.database is None:
+            self.database = UscDataBase(create_if_not_exists=False)
+        return self.database
+
+    async def get_conversations(self, name: str) -> dict:
+        """Return the conversations of the conversation handler with the name, by their key"""
+        conversations = self._get_database().get_conversations(name)
+
+        # Keys are tuples of ids, which JSON stores as lists
+        return {
+            tuple(json.loads(key)): json.loads(state)
+            for key, state in conversations.items()
+        }
+
+    async def update_conversation(
+        self, name: str, key: tuple, new_state: object
+    ) -> None:
+        """Store the new state of a conversation, None if the conversation has ended"""
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending[(name, json.dumps(list(key)))] = state
+
+        # All the changed conversations are handed over at once. Let the others be added before
+        # writing, such that they are written together
+        await asyncio.sleep(0)
+        self._write_pending()
+
+    async def flush(self) -> None:
+        """Write the conversations that are not written yet, and close the database connection"""
+        self._write_pending()
+
+        if self.database is not None:
+            self.database.__exit__(None, None, None)
+            self.database = None
+
+    def _write_pending(self) -> None:
+        """Write all the pending conversations to the database"""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        self._get_database().save_conversations(pending)
+        logger.debug("Stored %s conversations", len(pending))
+
+    # The bot only has conversations, so there is no other data to get or store
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,204 @@
+"""Module for the preferences of the users, which lessons they want to be asked about"""
+
+import bisect
+from datetime import datetime as dt
+from typing import Iterable
+
+WEEKDAYS = (
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+)
+
+# The kinds of preferences. A user is asked about a lesson if it matches one of their preferences of
+# every kind they have preferences of
+PREFERENCE_KINDS = ("day", "time", "trainer")
+
+
+def _minutes(text: str) -> int:
+    """Return the minutes since midnight of a time written as HH:MM, times are compared in these"""
+    time = dt.strptime(text.strip(), "%H:%M")
+    return time.hour * 60 + time.minute
+
+
+def parse_preference(kind: str, value: str) -> str:
+    """
+    Return the value of a preference as it is stored.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the preference, one of `PREFERENCE_KINDS`.
+    value : str
+        The value as the user wrote it: a weekday (or the start of one, like "tue"), a time range
+        like "18:00-21:00" or the name of a trainer.
+
+    Returns
+    -------
+    str
+        The number of the weekday, the time range as "HH:MM-HH:MM", or the name of the trainer.
+
+    Raises
+    ------
+    ValueError
+        If the kind is not known or the value does not fit the kind.
+    """
+    value = value.strip()
+
+    if kind == "day":
+        days = [
+            number
+            for number, day in enumerate(WEEKDAYS)
+            if len(value) >= 2 and day.startswith(value.lower())
+        ]
+        if len(days) != 1:
+            raise ValueError(f"{value} is not a day of the week")
+        return str(days[0])
+
+    if kind == "time":
+        start, _, end = value.partition("-")
+        try:
+            start, end = _minutes(start), _minutes(end)
+        except ValueError as error:
+            raise ValueError(f"{value} is not a time range like 18:00-21:00") from error
+
+        if start > end:
+            raise ValueError(f"The time range {value} ends before it starts")
+        return f"{start // 60:02}:{start % 60:02}-{end // 60:02}:{end % 60:02}"
+
+    if kind == "trainer":
+        if not value:
+            raise ValueError("Please give the name of the trainer")
+        return value
+
+    raise ValueError(f"Unknown kind of preference {kind}")
+
+
+def describe_preference(kind: str, value: str) -> str:
+    """Return a stored preference as it is shown to the user"""
+    if kind == "day":
+        return WEEKDAYS[int(value)].capitalize()
+    return value
+
+
+# pylint: disable=too-few-public-methods
+class _Matches:
+    """The users that want to be asked about a lesson, without listing the users without rules"""
+
+    def __init__(self, matched: set[str], with_rules: set[str]):
+        self.matched = matched
+        self.with_rules = with_rules
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.matched or user_id not in self.with_rules
+
+
+class PreferenceIndex:
+    """
+    Find the users that want to be asked about a lesson, from the preferences of all users.
+
+    The preferences are compiled once into an index per kind, such that the users of a lesson are
+    found without going over every user:
+    - the days as a set of users per weekday, from a bitmap of days per user,
+    - the time ranges as the set of users for every stretch of the day in which no range starts or
+      ends, found by bisecting the bounds of those stretches,
+    - the trainers as a set of users per trainer.
+
+    Users without preferences of a kind match every lesson for that kind, and users without any
+    preferences are not in the index at all, they are asked about every lesson.
+
+    Parameters
+    ----------
+    rules : iterable of tuple
+        The user id, kind and stored value of every preference.
+    """
+
+    def __init__(self, rules: Iterable[tuple[str, str, str]]):
+        days: dict[str, int] = {}
+        times: dict[str, list[tuple[int, int]]] = {}
+        self._by_trainer: dict[str, set[str]] = {}
+        self.users: set[str] = set()
+
+        for user_id, kind, value in rules:
+            self.users.add(user_id)
+
+            if kind == "day":
+                days[user_id] = days.get(user_id, 0) | 1 << int(value)
+            elif kind == "time":
+                start, _, end = value.partition("-")
+                times.setdefault(user_id, []).append((_minutes(start), _minutes(end)))
+            elif kind == "trainer":
+                self._by_trainer.setdefault(value.casefold(), set()).add(user_id)
+
+        # Users without preferences of a kind match every value of it
+        any_day = self.users - days.keys()
+        self._by_weekday = [
+            any_day | {user_id for user_id, bitmap in days.items() if bitmap & 1 << day}
+            for day in range(len(WEEKDAYS))
+        ]
+        self._any_time = self.users - times.keys()
+        self._any_trainer = self.users - set().union(*self._by_trainer.values())
+        self._compile_times(times)
+
+    def _compile_times(self, times: dict[str, list[tuple[int, int]]]) -> None:
+        """Compile the time ranges into the users of every stretch between their bounds"""
+        # The ranges include the minute they end on, so they stop being active a minute after
+        events = sorted(
+            (minute, user_id, step)
+            for user_id, ranges in times.items()
+            for start, end in ranges
+            for minute, step in ((start, 1), (end + 1, -1))
+        )
+
+        self._time_bounds: list[int] = []
+        self._time_users: list[frozenset[str]] = []
+        active: dict[str, int] = {}
+
+        for index, (minute, user_id, step) in enumerate(events):
+            active[user_id] = active.get(user_id, 0) + step
+            if not active[user_id]:
+                del active[user_id]
+
+            # Only store the stretch once all the events at this minute are handled
+            if index + 1 == len(events) or events[index + 1][0] != minute:
+                self._time_bounds.append(minute)
+                self._time_users.append(frozenset(active))
+
+    def _users_at(self, minute: int) -> frozenset[str]:
+        """Return the users with a time range that includes the minute"""
+        index = bisect.bisect_right(self._time_bounds, minute) - 1
+        if index < 0:
+            return frozenset()
+        return self._time_users[index]
+
+    def matching_users(self, les: dict) -> _Matches:
+        """
+        Return the users that want to be asked about the lesson.
+
+        Parameters
+        ----------
+        les : dict
+            The lesson, with its `time` and `trainer`.
+
+        Returns
+        -------
+        container of str
+            The ids of the users that want to be asked about the lesson, check a user with `in`.
+        """
+        if not self.users:
+            return _Matches(set(), set())
+
+        time = les["time"]
+        trainer = (les["trainer"] or "").casefold()
+
+        matched = self._by_weekday[time.weekday()]
+        matched = matched & (
+            self._users_at(time.hour * 60 + time.minute) | self._any_time
+        )
+        matched = matched & (self._by_trainer.get(trainer, set()) | self._any_trainer)
+
+        return _Matches(matched, self.users)
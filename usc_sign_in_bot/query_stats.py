@@ -0,0 +1,251 @@
+"""Hold the timing of the database queries, and log the slow ones, in this module"""
+
+import bisect
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from psycopg2.extensions import cursor as PgCursor
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in milliseconds, the last bucket catches everything else
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Statements that are not executed from a measured method are recorded under this name
+UNATTRIBUTED = "unattributed"
+
+# The words that may be followed by parentheses in a statement that is explained, any other word
+# is taken to be a function that might have side effects, like `pg_notify`
+EXPLAINABLE_CALLS = frozenset(
+    (
+        "all any and as avg coalesce count exists from greatest in join least lower max min not "
+        + "nullif on or over string_to_array sum unnest upper using values where"
+    ).split()
+)
+
+# The method that is currently being measured, if any
+_current_method: ContextVar["_MethodProbe | None"] = ContextVar(
+    "_current_method", default=None
+)
+
+
+# pylint: disable=too-few-public-methods
+class _MethodProbe:
+    """Collects the round trips and rows of a single call of a database method"""
+
+    __slots__ = ("name", "round_trips", "rows")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.round_trips = 0
+        self.rows = 0
+
+
+class QueryStats:
+    """
+    Collect per method latency histograms, row counts and round trips of the database.
+
+    Methods are measured with `measure`, which the `rollback_on_error` decorator does for every
+    database method. The statements themselves are reported by `TimedCursor`. Any statement slower
+    than `slow_query_ms` is logged with its SQL, and for a sample of the slow `SELECT` statements
+    the plan is logged as well, which the cursor makes with `query_plan`. The plan is only
+    estimated, the statement is not executed again, and statements calling other functions than
+    those in `EXPLAINABLE_CALLS` are not explained at all.
+
+    Parameters
+    ----------
+    slow_query_ms : float, optional
+        Statements that take longer than this number of milliseconds are logged.
+    explain_sample_rate : float, optional
+        The fraction of slow `SELECT` statements for which the query plan is logged, between 0 and
+        1.
+    """
+
+    def __init__(self, slow_query_ms: float = 100.0, explain_sample_rate: float = 0.0):
+        self.slow_query_ms = slow_query_ms
+        self.explain_sample_rate = explain_sample_rate
+        self._methods: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name: str):
+        """Measure the latency, round trips and rows of a call of the method with the name"""
+        probe = _MethodProbe(name)
+        token = _current_method.set(probe)
+        start = time.perf_counter()
+        failed = False
+
+        try:
+            yield probe
+
+        except Exception:
+            failed = True
+            raise
+
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _current_method.reset(token)
+            self._record(probe, elapsed_ms, failed)
+
+    def record_statement(
+        self, cursor: PgCursor, query: str, params, elapsed_ms: float
+    ) -> None:
+        """Add an executed statement to the measured method and log it if it was slow"""
+        probe = _current_method.get()
+
+        # Still count statements that are not executed from a measured method, as a call on its own
+        unattributed = probe is None
+        if unattributed:
+            probe = _MethodProbe(UNATTRIBUTED)
+
+        probe.round_trips += 1
+        if cursor.rowcount > 0:
+            probe.rows += cursor.rowcount
+
+        if unattributed:
+            self._record(probe, elapsed_ms, False)
+
+        if elapsed_ms > self.slow_query_ms:
+            self._log_slow_query(cursor, query, params, probe.name, elapsed_ms)
+
+    def record_fetch(self, rows: int) -> None:
+        """Add a round trip fetching rows from a server-side cursor to the measured method"""
+        probe = _current_method.get()
+        if probe is not None:
+            probe.round_trips += 1
+            probe.rows += rows
+
+    def snapshot(self) -> dict[str, dict]:
+        """Return a copy of the statistics per method, e.g. to expose them as metrics"""
+        with self._lock:
+            result = {}
+            for name, stats in self._methods.items():
+                result[name] = {
+                    **stats,
+                    "buckets": dict(zip((*BUCKETS_MS, float("inf")), stats["buckets"])),
+                    "mean_ms": stats["total_ms"] / stats["calls"],
+                    "p95_ms": self._percentile(stats, 0.95),
+                }
+            return result
+
+    def reset(self) -> None:
+        """Forget all the collected statistics"""
+        with self._lock:
+            self._methods.clear()
+
+    def _record(self, probe: _MethodProbe, elapsed_ms: float, failed: bool) -> None:
+        """Add the measurement of a single call to the statistics of its method"""
+        with self._lock:
+            stats = self._methods.setdefault(
+                probe.name,
+                {
+                    "calls": 0,
+                    "errors": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "rows": 0,
+                    "round_trips": 0,
+                    "buckets": [0] * (len(BUCKETS_MS) + 1),
+                },
+            )
+            stats["calls"] += 1
+            stats["errors"] += failed
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["rows"] += probe.rows
+            stats["round_trips"] += probe.round_trips
+            stats["buckets"][bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    @staticmethod
+    def _percentile(stats: dict, fraction: float) -> float:
+        """Estimate a percentile as the upper bound of the bucket it falls in"""
+        target = fraction * stats["calls"]
+        seen = 0
+        for bound, amount in zip(BUCKETS_MS, stats["buckets"]):
+            seen += amount
+            if seen >= target:
+                return bound
+        return stats["max_ms"]
+
+    # pylint: disable=too-many-positional-arguments
+    def _log_slow_query(
+        self, cursor: PgCursor, query: str, params, name: str, elapsed_ms: float
+    ) -> None:
+        """Log a slow statement, and for a sample of the selects their query plan"""
+        # Only log the statement itself, as the parameters might hold passwords
+        sql = " ".join(str(query).split())
+        logger.warning("Slow query in %s took %.1f ms: %s", name, elapsed_ms, sql)
+
+        if (
+            not sql.upper().startswith("SELECT")
+            or not self._explainable(sql)
+            or random.random() >= self.explain_sample_rate
+        ):
+            return
+
+        # Every database explains its statements differently, so leave the plan to the cursor
+        try:
+            plan = cursor.query_plan(query, params)
+            logger.warning("Query plan of slow query in %s:\n%s", name, plan)
+
+        # pylint: disable=broad-exception-caught
+        except Exception as error:
+            logger.warning("Could not explain slow query in %s: %s", name, error)
+
+    @staticmethod
+    def _explainable(sql: str) -> bool:
+        """Check if the statement only calls functions without side effects"""
+        calls = re.findall(r"([a-z_][a-z0-9_]*)\s*\(", sql.lower())
+        return all(call in EXPLAINABLE_CALLS for call in calls)
+
+
+class TimedCursor(PgCursor):
+    """Cursor reporting the duration and rows of every statement to `QUERY_STATS`"""
+
+    # pylint: disable=redefined-builtin
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            QUERY_STATS.record_statement(
+                self, query, vars, (time.perf_counter() - start) * 1000
+            )
+
+    def query_plan(self, query, vars=None) -> str:
+        """Return the estimated plan of a statement with `EXPLAIN`, without executing it"""
+        # Use a plain cursor for the plan, such that it is not measured itself. The plan is made
+        # in a savepoint, such that a failure does not abort the transaction of the caller
+        savepoint = not self.connection.autocommit
+        with self.connection.cursor() as explain_cursor:
+            if savepoint:
+                explain_cursor.execute("SAVEPOINT explain_slow_query;")
+            try:
+                explain_cursor.execute("EXPLAIN " + query, vars)
+                return "\n".join(row[0] for row in explain_cursor.fetchall())
+            finally:
+                if savepoint:
+                    explain_cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query;")
+                    explain_cursor.execute("RELEASE SAVEPOINT explain_slow_query;")
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+
+        # Only named cursors fetch their rows from the server
+        if self.name:
+            QUERY_STATS.record_fetch(len(rows))
+
+        return rows
+
+
+# The statistics of all the database connections in this process
+QUERY_STATS = QueryStats(
+    slow_query_ms=float(os.environ.get("SLOW_QUERY_MS", 100)),
+    explain_sample_rate=float(os.environ.get("EXPLAIN_SAMPLE_RATE", 0)),
+)
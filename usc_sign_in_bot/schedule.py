@@ -0,0 +1,276 @@
+"""Module for finding the lessons that changed since the last scrape, and editing their messages"""
+
+import logging
+import os
+import threading
+import time as timer
+from collections import OrderedDict
+from datetime import date
+from datetime import datetime as dt
+from datetime import timedelta
+from itertools import groupby
+from typing import Callable
+
+from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.messages import schedule_day_message, updated_message
+from usc_sign_in_bot.models import LESSON_ID_SEPARATOR, ScheduledLesson
+
+# The number of seconds the lessons listed by the /lessons command are reused before they are read
+# from the last scrape again
+LESSONS_CACHE_TTL = float(os.environ.get("LESSONS_CACHE_TTL", 300))
+
+logger = logging.getLogger(__name__)
+
+
+def diff_schedule(
+    previous: list[ScheduledLesson], lessons: list[dict], now: dt = None
+) -> list[tuple[dt, dict | None]]:
+    """
+    Find the lessons of the last scrape that changed in the new scrape.
+
+    A lesson that is gone from the new scrape is taken to have moved if a new lesson with the same
+    trainer is on the same day, and to be cancelled otherwise. Only lessons up to the last lesson of
+    the new scrape can be gone, as the lessons after it were not scraped at all.
+
+    Parameters
+    ----------
+    previous : list of ScheduledLesson
+        The lessons of the last scrape.
+    lessons : list of dict
+        The lessons of the new scrape, with their `time` and `trainer`.
+    now : datetime.datetime, optional
+        The current time, lessons before it are over and no longer change. Defaults to now.
+
+    Returns
+    -------
+    list of tuple
+        The time the lesson was at and the lesson as it is now for every changed lesson, with None
+        as the lesson if it is cancelled.
+    """
+    if not lessons:
+        return []
+
+    now = now or dt.now()
+    before = {les.datetime: les.trainer for les in previous if les.datetime >= now}
+    after = {les["time"]: les for les in lessons}
+    horizon = max(after)
+
+    changes = [
+        (time, after[time])
+        for time, trainer in before.items()
+        if time in after and after[time]["trainer"] != trainer
+    ]
+
+    added = [time for time in after if time not in before]
+    for time, trainer in sorted(before.items()):
+        if time in after or time > horizon:
+            continue
+
+        # Take the closest new lesson of the trainer on the same day as the lesson it moved to
+        moved = [
+            new
+            for new in added
+            if new.date() == time.date() and after[new]["trainer"] == trainer
+        ]
+        if not moved:
+            changes.append((time, None))
+            continue
+
+        new = min(moved, key=lambda new, time=time: abs(new - time))
+        added.remove(new)
+        changes.append((time, after[new]))
+
+    return changes
+
+
+def update_schedule(
+    usc_db: UscDataBase, sport: str, lessons: list[dict], now: dt = None
+) -> int:
+    """
+    Apply the changes of the lessons since the last scrape, and store the new scrape.
+
+    The messages sent about changed lessons are edited through the outbox, once per message, also
+    when several of its lessons changed. Run this before adding the new lessons, such that the
+    lessons that moved are not asked about again.
+
+    Parameters
+    ----------
+    usc_db : UscDataBase
+        The database to apply the changes to.
+    sport : str
+        The name of the sport the lessons are of.
+    lessons : list of dict
+        The lessons of the new scrape, with their `time` and `trainer`.
+    now : datetime.datetime, optional
+        The current time, defaults to now.
+
+    Returns
+    -------
+    int
+        The number of messages that are edited.
+    """
+    changes = diff_schedule(usc_db.get_schedule(sport), lessons, now)
+
+    # Nothing changed, so only the new scrape is stored
+    if not changes:
+        usc_db.save_schedule(sport, lessons, now)
+        return 0
+
+    with usc_db.transaction():
+        # The messages in the order they were first found, every message only once
+        messages = {}
+        for time, les in changes:
+            logger.info(
+                "Lesson %s of %s is %s",
+                time.isoformat(),
+                sport,
+                "cancelled" if les is None else "changed",
+            )
+            new_time, trainer = (
+                (None, None) if les is None else (les["time"], les["trainer"])
+            )
+            messages.update(
+                dict.fromkeys(usc_db.change_lesson(sport, time, new_time, trainer))
+            )
+
+        edits = render_edits(usc_db, messages)
+        usc_db.add_edits_to_outbox(edits)
+        usc_db.save_schedule(sport, lessons, now)
+
+    return len(edits)
+
+
+def render_edits(
+    usc_db: UscDataBase, messages: list[tuple[int, int]]
+) -> list[tuple[int, int, str, str, str | None]]:
+    """Render the sent messages again with their lessons as they are now, to edit them"""
+    edits = []
+    for chat_id, message_id in messages:
+        lessons = usc_db.get_message_lessons(chat_id, message_id)
+        if not lessons:
+            continue
+
+        text, markup = updated_message(lessons)
+        lesson_ids = LESSON_ID_SEPARATOR.join(les.lesson_id for les in lessons)
+        edits.append(
+            (chat_id, message_id, lesson_ids, text, markup and markup.to_json())
+        )
+
+    return edits
+
+
+class ScheduleCache:
+    """
+    Cache the lessons of the last scrape as they are listed by the /lessons command.
+
+    The lessons of a sport are read from the database once per time to live, and every day is
+    rendered once when they are read. The rendered days are shared by all the users asking for the
+    lessons, so listing them costs the same no matter how many users do. The lessons are never
+    scraped here, the job stores every scrape. The sports that were scraped are cached as well,
+    such that only those are asked for, and at most `max_size` sports are kept.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        The number of seconds the lessons of a sport stay valid.
+    max_size : int, optional
+        The maximum number of sports of which the lessons are kept, the least recently used sport
+        is dropped first.
+    clock : callable, optional
+        Function returning the current time in seconds, replaceable for testing.
+    """
+
+    def __init__(
+        self,
+        ttl: float = LESSONS_CACHE_TTL,
+        max_size: int = 16,
+        clock: Callable[[], float] = timer.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, dt | None, dict[date, str]]] = (
+            OrderedDict()
+        )
+        self._sports: tuple[float, list[str]] | None = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_sports(self, load: Callable[[], list[str]]) -> list[str]:
+        """Return the sports that were scraped, reading them with `load` if they are not cached"""
+        with self._lock:
+            if self._sports is None or self._sports[0] <= self._clock():
+                self._sports = (self._clock() + self.ttl, load())
+            return self._sports[1]
+
+    def get_days(
+        self, sport: str, load: Callable[[], list[ScheduledLesson]]
+    ) -> tuple[dt | None, dict[date, str]]:
+        """
+        Return the rendered lessons of the sport per day, reading them if they are not cached.
+
+        Parameters
+        ----------
+        sport : str
+            The name of the sport.
+        load : callable
+            Function returning the lessons of the sport from the last scrape, ordered by time. It
+            is only called when the lessons are not cached.
+
+        Returns
+        -------
+        datetime.datetime or None
+            The time of the last scrape, None if the sport was never scraped.
+        dict
+            The rendered lessons of every day with lessons, by day.
+        """
+        with self._lock:
+            entry = self._entries.get(sport)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(sport)
+                return entry[1], entry[2]
+
+            lessons = load()
+            days = {
+                day: schedule_day_message(list(day_lessons))
+                for day, day_lessons in groupby(
+                    lessons, key=lambda les: les.datetime.date()
+                )
+            }
+            scraped_at = max((les.scraped_at for les in lessons), default=None)
+
+            self._entries[sport] = (self._clock() + self.ttl, scraped_at, days)
+            self._entries.move_to_end(sport)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            logger.debug("Rendered the lessons of %s on %s days", sport, len(days))
+
+            return scraped_at, days
+
+    def lessons_message(
+        self,
+        sport: str,
+        days: int,
+        load: Callable[[], list[ScheduledLesson]],
+        today: date = None,
+    ) -> str:
+        """Return the message listing the lessons of the sport from today on, for the days"""
+        today = today or date.today()
+        scraped_at, rendered = self.get_days(sport, load)
+
+        listed = [
+            rendered[day]
+            for day in (today + timedelta(days=offset) for offset in range(days))
+            if day in rendered
+        ]
+        if not listed:
+            return f"There are no {sport} lessons in the next {days} days"
+
+        return (
+            f"The {sport} lessons of the next {days} days, as found "
+            + scraped_at.strftime("%A %d %B at %H:%M")
+            + ":\n\n"
+            + "\n\n".join(listed)
+        )
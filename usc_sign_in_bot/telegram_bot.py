@@ -1,5 +1,6 @@
 """Module to store all the telegram communication"""
 
+import asyncio
 import logging
 import os
 import traceback
@@ -7,13 +8,26 @@ from datetime import datetime as dt
 
 from dotenv import load_dotenv
 from telegram import Update
+from telegram.constants import ChatType
+from telegram.error import BadRequest
 from telegram.ext import (Application, CallbackContext, CallbackQueryHandler,
                           CommandHandler, ContextTypes, ConversationHandler,
                           MessageHandler, filters)
 
 from usc_sign_in_bot.db_helpers import UscDataBase
 from usc_sign_in_bot.encryptor import Encryptor
-from usc_sign_in_bot.usc_interface import UscInterface
+from usc_sign_in_bot.in_flight import InFlightRegistry, KeyedLocks
+from usc_sign_in_bot.messages import (answer_markup, choice_message,
+                                      updated_message)
+from usc_sign_in_bot.models import Notification
+from usc_sign_in_bot.outbox import OUTBOX_BATCH_SIZE, OutboxDispatcher
+from usc_sign_in_bot.persistence import DatabasePersistence
+from usc_sign_in_bot.preferences import (PREFERENCE_KINDS, describe_preference,
+                                         parse_preference)
+from usc_sign_in_bot.schedule import ScheduleCache
+from usc_sign_in_bot.telegram_request import make_request
+from usc_sign_in_bot.update_processor import (UPDATE_CONCURRENCY,
+                                              PerUserUpdateProcessor)
 
 # Enable logging
 logging.basicConfig(
@@ -26,6 +40,33 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 LOGIN_METHOD, USERNAME, PASSWORD, WRAP_UP, *_ = range(50)
 LOGIN_METHODS = ["uva"]
 
+# The chats that are shared by several users, the lessons broadcast to them must not be edited
+GROUP_CHAT_TYPES = (ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL)
+
+# Whether the bot polls Telegram for updates, or Telegram sends them to a webhook
+TELEGRAM_MODE = os.environ.get("TELEGRAM_MODE", "polling")
+
+# The address and path the webhook listens on, and the public URL Telegram sends the updates to
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# Telegram sends this secret along with every update, such that no one else can send updates
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+# The Bot API to talk to instead of the one of Telegram, e.g. a local fake one for benchmarks
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# The sport the /lessons command lists when none is given, and the number of days it lists by
+# default and at most
+LESSONS_SPORT = "Schermen"
+LESSONS_DAYS = int(os.environ.get("LESSONS_DAYS", 7))
+LESSONS_MAX_DAYS = int(os.environ.get("LESSONS_MAX_DAYS", 14))
+
+# The only updates the bot handles, Telegram doesn't send us the others
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 logger = logging.getLogger(__name__)
 
 
@@ -34,7 +75,31 @@ class TelegramBot:
 
     def __init__(self) -> None:
         """Start the bot"""
-        self.app = Application.builder().token(os.environ["BOTTOKEN"]).build()
+        # Make sure the tables exist once at start up, such that the handlers don't have to
+        with UscDataBase():
+            pass
+        self.outbox = None
+        self.responses = InFlightRegistry()
+        self.message_locks = KeyedLocks()
+        self.schedule = ScheduleCache()
+        self.database = None
+
+        # All the calls share a pool of connections, large enough for a batch of the outbox and the
+        # updates that are handled at the same time. Polling gets its own connection, as it waits
+        # for the updates most of the time
+        builder = (
+            Application.builder()
+            .token(os.environ["BOTTOKEN"])
+            .request(make_request(OUTBOX_BATCH_SIZE + UPDATE_CONCURRENCY))
+            .get_updates_request(make_request(1))
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .concurrent_updates(PerUserUpdateProcessor())
+            .persistence(DatabasePersistence())
+        )
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        self.app = builder.build()
 
         conv_handler = ConversationHandler(
             entry_points=[CommandHandler("start", self.start)],
@@ -50,24 +115,86 @@ class TelegramBot:
                 ],
             },
             fallbacks=[CommandHandler("cancel_setup", self.cancel_setup)],
+            # Keep the state of the sign ups in the database, such that they survive a restart
+            name="sign_up",
+            persistent=True,
         )
 
         # Add some handlers for commands that might occur
         self.app.add_handler(conv_handler)
         self.app.add_handler(CommandHandler("help", self.help_command))
+        self.app.add_handler(CommandHandler("prefer", self.prefer))
+        self.app.add_handler(CommandHandler("preferences", self.list_preferences))
+        self.app.add_handler(CommandHandler("unprefer", self.unprefer))
+        self.app.add_handler(CommandHandler("lessons", self.list_lessons))
         self.app.add_handler(CallbackQueryHandler(self.message_handler))
 
         # Also add an error handler for if something goes wrong
         self.app.add_error_handler(self.error_handler)
 
         # Now run the bot
-        self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+        self.run()
 
-    @staticmethod
-    async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    def run(self) -> None:
+        """Receive and handle updates until the bot is stopped, through a webhook or by polling"""
+        if TELEGRAM_MODE == "polling":
+            self.app.run_polling(allowed_updates=ALLOWED_UPDATES)
+            return
+
+        if TELEGRAM_MODE != "webhook":
+            raise ValueError(f"Unknown Telegram mode {TELEGRAM_MODE}")
+
+        if not WEBHOOK_URL:
+            raise ValueError("Please set WEBHOOK_URL to run the bot with a webhook")
+
+        # Serve the updates from the HTTP server of the application itself
+        self.app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+
+    async def post_init(self, application: Application) -> None:
+        """Set up the things that need the running event loop, before updates are processed"""
+        # Send the messages the job puts in the outbox, all messages go through this bot
+        self.outbox = OutboxDispatcher(application.bot)
+        await self.outbox.start()
+
+        # Deriving the keys is slow on purpose, so derive them in a thread now. Otherwise the first
+        # handler to encrypt or decrypt a password would block the event loop while deriving them
+        await asyncio.to_thread(
+            Encryptor(
+                os.environ.get("ENCRYPT_KEY"), os.environ.get("ENCRYPT_KEY_PREVIOUS")
+            ).derive_keys
+        )
+
+    async def post_stop(self, _: Application) -> None:
+        """Stop sending the messages from the outbox, and close the database connection"""
+        if self.outbox is not None:
+            await self.outbox.stop()
+
+        if self.database is not None:
+            self.database.__exit__(None, None, None)
+            self.database = None
+
+    def _get_database(self) -> UscDataBase:
+        """Return the connection to the database kept by the bot, connecting when first needed"""
+        if self.database is None:
+            self.database = UscDataBase(create_if_not_exists=False)
+        return self.database
+
+    async def start(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message that the user will now receive updates for the sport they choose"""
         user = update.effective_user
 
+        # A user who blocked the bot before is back, so send them the lessons again
+        self._get_database().update_fields(
+            "users", user.id, key_column="telegram_id", active=True
+        )
+
         await update.message.reply_html(
             rf"Heyhoy {user.mention_html()}, Welcome in our service for USC sports. To start, "
             + "I need some info from you. What login method would you like to use? You can try "
@@ -79,8 +206,7 @@ class TelegramBot:
         logger.info("A user with telegram_id %s started sign up", user.id)
         return LOGIN_METHOD
 
-    @staticmethod
-    async def ask_username(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    async def ask_username(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """Get the login method of the user, now ask for the Username"""
         login_method = update.message.text.strip(" ").lower()
         telegram_id = update.effective_user.id
@@ -88,10 +214,12 @@ class TelegramBot:
         if login_method not in LOGIN_METHODS:
             raise ValueError("Login method is not known")
 
-        UscDataBase().insert_user(telegram_id, dt.now(), login_method)
-        UscDataBase().edit_data_point(
-            telegram_id, "sport", "Schermen", table="users", key_column="telegram_id"
-        )
+        database = self._get_database()
+        with database.transaction():
+            database.insert_user(telegram_id, dt.now(), login_method)
+            database.update_fields(
+                "users", telegram_id, key_column="telegram_id", sport="Schermen"
+            )
 
         await update.message.reply_html(
             "Because the way this scraper work, we need to be able to log in on your behalf. If "
@@ -104,13 +232,12 @@ class TelegramBot:
         logger.info("Asked for the username to user with telegram_id %s", telegram_id)
         return USERNAME
 
-    @staticmethod
-    async def ask_password(update: Update, _: CallbackContext) -> None:
+    async def ask_password(self, update: Update, _: CallbackContext) -> None:
         """Register the username from the response, next ask for the passord"""
         username = update.message.text
         telegram_id = update.effective_user.id
 
-        UscDataBase().edit_data_point(
+        self._get_database().edit_data_point(
             telegram_id, "username", username, table="users", key_column="telegram_id"
         )
 
@@ -118,8 +245,7 @@ class TelegramBot:
         logger.info("Asked for the password to user with telegram_id %s", telegram_id)
         return PASSWORD
 
-    @staticmethod
-    async def finish_sign_up(update: Update, _: CallbackContext) -> None:
+    async def finish_sign_up(self, update: Update, _: CallbackContext) -> None:
         """Register the password and fix the next workflow"""
         password = update.message.text
         telegram_id = update.effective_user.id
@@ -131,7 +257,7 @@ class TelegramBot:
         # a reminder to not reuse your passwords.
         encryptor = Encryptor(os.environ.get("ENCRYPT_KEY"))
         password_encrypt = encryptor.encrypt_data(password)
-        UscDataBase().edit_data_point(
+        self._get_database().edit_data_point(
             telegram_id,
             "password",
             password_encrypt,
@@ -163,8 +289,159 @@ class TelegramBot:
         """Send a message explaining what to do"""
         await update.message.reply_text(
             "We'll send you updates on all the trainings. You can sign up via the buttons. To "
-            + "stop, use the /cancel command"
+            + "stop, use the /cancel command. To only get the trainings you like, use /prefer "
+            + "day <day>, /prefer time <from>-<to> or /prefer trainer <name>. See them with "
+            + "/preferences and remove them with /unprefer. To see the coming trainings, use "
+            + "/lessons [sport] [days]"
+        )
+
+    async def prefer(self, update: Update, context: CallbackContext) -> None:
+        """Add a preference of the user, from the kind and value after the command"""
+        if len(context.args) < 2 or context.args[0].lower() not in PREFERENCE_KINDS:
+            await update.message.reply_text(
+                "Please use /prefer day <day>, /prefer time <from>-<to> or /prefer trainer <name>"
+            )
+            return
+
+        kind = context.args[0].lower()
+        try:
+            value = parse_preference(kind, " ".join(context.args[1:]))
+        except ValueError as error:
+            await update.message.reply_text(str(error))
+            return
+
+        database = self._get_database()
+        if not database.add_preference(update.effective_user.id, kind, value):
+            await update.message.reply_text("Please sign up first, using /start")
+            return
+
+        await update.message.reply_text(
+            f"You will only get the trainings with {kind} {describe_preference(kind, value)}"
+            + ", next to your other preferences of this kind"
         )
+        logger.info("User with telegram_id %s added a preference", update.effective_user.id)
+
+    async def list_preferences(self, update: Update, _: CallbackContext) -> None:
+        """Send the preferences of the user"""
+        database = self._get_database()
+        preferences = database.get_user_preferences(update.effective_user.id)
+
+        if not preferences:
+            await update.message.reply_text(
+                "You have no preferences, so you get all the trainings"
+            )
+            return
+
+        await update.message.reply_text(
+            "You get the trainings with:\n"
+            + "\n".join(
+                f"{kind} {describe_preference(kind, value)}" for kind, value in preferences
+            )
+        )
+
+    async def unprefer(self, update: Update, context: CallbackContext) -> None:
+        """Remove the preferences of the user, all of them or those of a kind or value"""
+        kind, value = None, None
+        if context.args:
+            kind = context.args[0].lower()
+            if kind not in PREFERENCE_KINDS:
+                await update.message.reply_text(
+                    "Please use /unprefer, /unprefer <kind> or /unprefer <kind> <value>"
+                )
+                return
+
+        try:
+            if len(context.args) > 1:
+                value = parse_preference(kind, " ".join(context.args[1:]))
+        except ValueError as error:
+            await update.message.reply_text(str(error))
+            return
+
+        database = self._get_database()
+        removed = database.remove_preferences(update.effective_user.id, kind, value)
+        await update.message.reply_text(f"Removed {removed} preferences")
+
+    async def list_lessons(self, update: Update, context: CallbackContext) -> None:
+        """Send the lessons of the coming days, as they were found by the last scrape"""
+        database = self._get_database()
+        sports = {
+            sport.casefold(): sport
+            for sport in (LESSONS_SPORT, *self.schedule.get_sports(database.get_schedule_sports))
+        }
+
+        sport, days = LESSONS_SPORT, LESSONS_DAYS
+        for arg in context.args:
+            if arg.isdigit():
+                days = min(max(int(arg), 1), LESSONS_MAX_DAYS)
+            elif arg.casefold() in sports:
+                sport = sports[arg.casefold()]
+            else:
+                await update.message.reply_text(
+                    f"There are no lessons of {arg}, try one of {', '.join(sports.values())}"
+                )
+                return
+
+        # The lessons are only read from the database when they are not cached, never scraped
+        text = self.schedule.lessons_message(
+            sport, days, lambda: database.get_schedule(sport)
+        )
+        await update.message.reply_text(text)
+
+    @staticmethod
+    async def respond(
+        database: UscDataBase, key: str, s_choice: str, telegram_id: int
+    ) -> Notification | None:
+        """Claim the response to the lesson and book it if the answer is yes"""
+        # Claim the response in one go, this only returns data for the first tap on the buttons,
+        # also when the other taps are handled by other processes
+        data = database.claim_lesson_response(key, s_choice, telegram_id)
+
+        # Book in a thread, such that the updates of other users are handled in the meantime
+        if data is not None and s_choice == "Y":
+            await asyncio.to_thread(TelegramBot.sign_up_for_lesson, data)
+
+        return data
+
+    @staticmethod
+    def sign_up_for_lesson(data: Notification) -> None:
+        """Book the lesson of the notification with the account of the user"""
+        # Selenium is heavy and only needed to book, so it is loaded when the first lesson is booked
+        # pylint: disable=import-outside-toplevel
+        from usc_sign_in_bot.usc_interface import UscInterface
+
+        with UscInterface(
+            data["username"],
+            data["password"],
+            uva_login=data["login_method"] == "uva",
+        ) as usc:
+            usc.sign_up_for_lesson(data["sport"], data["datetime"])
+
+    @staticmethod
+    def _lesson_key(
+        database: UscDataBase, button_key: str, telegram_id: int
+    ) -> str | None:
+        """Return the key of the lesson of the user the button is about, None if there is none"""
+        # Buttons of messages sent before the keys were compacted still hold the legacy key
+        if Encryptor.is_legacy_key(button_key):
+            return database.resolve_lesson_key(button_key)
+
+        # The buttons of a broadcast are shared by everyone in the group chat, the lesson of the
+        # user tapping them is only added on their first tap
+        if Encryptor.is_broadcast_key(button_key):
+            return database.join_broadcast(button_key, telegram_id)
+
+        return button_key
+
+    @staticmethod
+    async def _reply_to_callback(update: Update, text: str) -> None:
+        """Reply to a tap on a button in its message, or to the user alone in a group chat"""
+        message = update.callback_query.message
+        if message is not None and message.chat.type in GROUP_CHAT_TYPES:
+            # Alerts are limited to 200 characters
+            await update.callback_query.answer(text[:200], show_alert=True)
+            return
+
+        await update.callback_query.edit_message_text(text)
 
     @staticmethod
     async def error_handler(update: Update, context: CallbackContext) -> None:
@@ -183,15 +460,16 @@ class TelegramBot:
             + '"selector":"button[data-test-id="bookable-slot-book-b'
         ):
             logger.info("User Allready registered for the course")
-            await update.callback_query.edit_message_text(
-                "You seem to be allready registered for that course. Good Luck!"
+            await TelegramBot._reply_to_callback(
+                update, "You seem to be allready registered for that course. Good Luck!"
             )
             return
 
         if update.callback_query:
-            await update.callback_query.edit_message_text(
+            await TelegramBot._reply_to_callback(
+                update,
                 "Sorry an error uccured. Please contact the Admins. Error="
-                + str(context.error)[:1000]
+                + str(context.error)[:1000],
             )
             return
 
@@ -201,33 +479,79 @@ class TelegramBot:
 
     async def message_handler(self, update: Update, _: CallbackContext) -> None:
         """Check for updates"""
-        database = UscDataBase()
+        database = self._get_database()
         telegram_id = update.effective_user.id
-        key, s_choice = update.callback_query.data.split(",")
-        choice = s_choice == "Y"
-        data = database.get_lesson_data_by_key(key)
+        button_key, _, s_choice = update.callback_query.data.rpartition(",")
+        broadcast = Encryptor.is_broadcast_key(button_key)
+
+        key = self._lesson_key(database, button_key, telegram_id)
+        if key is None:
+            await update.callback_query.answer(
+                "Please sign up in a private chat with the bot first, using /start",
+                show_alert=True,
+            )
+            return
 
-        if data["response"] is not None:
-            logger.info("Skip as this response is allready known")
+        # A tap while the response to the lesson is handled already is a duplicate, wait for the
+        # first tap instead of booking again
+        first, data = await self.responses.run(
+            key, self.respond, database, key, s_choice, telegram_id
+        )
+
+        if not first:
+            logger.info("Skip as this response is being handled allready")
             return
 
-        database.edit_data_point(key, "response", s_choice)
+        # The buttons of a cancelled lesson stay until its message is edited, so tell the user
+        if data is None and database.is_lesson_cancelled(key):
+            logger.info("Skip as the lesson was cancelled")
+            await update.callback_query.answer(
+                "This lesson was cancelled", show_alert=True
+            )
+            return
 
-        if choice:
-            user = database.get_user(telegram_id, query_key="telegram_id")
-            with UscInterface(
-                user["username"],
-                user["password"],
-                uva_login=user["login_method"] == "uva",
-            ) as usc:
-                usc.sign_up_for_lesson(data["sport"], data["datetime"])
+        if data is None:
+            logger.info("Skip as this response is allready known")
+            if broadcast:
+                await update.callback_query.answer("Your choice was recorded already")
+            return
 
-        text_choice = "Yes" if choice else "No"
+        # The message of a broadcast is the same for everyone, so only the user is told
+        if broadcast:
+            await update.callback_query.answer(choice_message(s_choice))
+            return
 
-        await update.callback_query.edit_message_text(
-            update.callback_query.message.text
-            + f"\n\nWe have recorded your choice as being {text_choice}. Good luck!"
-        )
+        await self._show_choice(update, database, button_key, s_choice)
+
+    async def _show_choice(
+        self, update: Update, database: UscDataBase, button_key: str, s_choice: str
+    ) -> None:
+        """Edit the answered message, a digest keeps the buttons of the lessons not answered yet"""
+        message = update.callback_query.message
+
+        # Taps on several lessons of a digest are handled at the same time, so the message is
+        # rendered from the database one tap at a time, such that the last edit has every answer
+        async with self.message_locks.hold((message.chat_id, message.message_id)):
+            lessons = database.get_message_lessons(message.chat_id, message.message_id)
+            if lessons:
+                text, markup = updated_message(lessons)
+            else:
+                # Messages that are not known from the outbox are edited from what they show
+                number, markup = answer_markup(message.reply_markup, button_key)
+                text = message.text + "\n\n" + choice_message(s_choice, number)
+
+            try:
+                if markup is None:
+                    await update.callback_query.edit_message_text(text)
+                else:
+                    await update.callback_query.edit_message_text(
+                        text, reply_markup=markup
+                    )
+
+            # A tap handled right before showed this answer already
+            except BadRequest as error:
+                if "message is not modified" not in str(error).lower():
+                    raise
 
 
 if __name__ == "__main__":
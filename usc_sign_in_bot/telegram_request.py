@@ -0,0 +1,51 @@
+"""Module for the connections to the Telegram Bot API, shared by all the calls of a bot"""
+
+import os
+
+import httpx
+from telegram.request import HTTPXRequest
+
+# The HTTP version to talk to the Bot API with, HTTP/2 sends the concurrent calls over a single
+# connection ("1.1" or "2"). Use "1.1" for a Bot API that is served without TLS, like a local fake
+TELEGRAM_HTTP_VERSION = os.environ.get("TELEGRAM_HTTP_VERSION", "2")
+
+# The number of seconds to wait for a connection to the Bot API, and for its answer
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", 5))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get("TELEGRAM_READ_TIMEOUT", 10))
+TELEGRAM_WRITE_TIMEOUT = float(os.environ.get("TELEGRAM_WRITE_TIMEOUT", 10))
+
+# The number of seconds a call waits for a free connection of the pool
+TELEGRAM_POOL_TIMEOUT = float(os.environ.get("TELEGRAM_POOL_TIMEOUT", 10))
+
+# The number of seconds an idle connection is kept open, to be reused by the next call
+TELEGRAM_KEEPALIVE = float(os.environ.get("TELEGRAM_KEEPALIVE", 60))
+
+
+def make_request(pool_size: int) -> HTTPXRequest:
+    """
+    Return the client for the calls of a bot to the Bot API, with a pool of warm connections.
+
+    The client is shared by all the calls of the bot, so it is opened and closed together with the
+    bot or application it is given to.
+
+    Parameters
+    ----------
+    pool_size : int
+        The maximum number of connections, best matched to the number of calls made at once.
+    """
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        http_version=TELEGRAM_HTTP_VERSION,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+        # Keep the connections open for longer than the few seconds httpx does by default
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=TELEGRAM_KEEPALIVE,
+            )
+        },
+    )
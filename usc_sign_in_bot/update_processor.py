@@ -0,0 +1,94 @@
+"""Module for processing the updates of different users concurrently, in order per user"""
+
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of updates that are processed at the same time
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 8))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process the updates of different users concurrently, but those of a single user one by one.
+
+    The steps of the sign up of a user depend on each other, so an update of a user is only
+    processed once their earlier updates are done. Updates of other users don't have to wait for
+    that, so a slow booking of one user doesn't hold up the others. Taps on buttons, and updates
+    that don't belong to a user, are processed right away.
+
+    The first update of a user processes the updates of that user that come in while it runs, one
+    by one. Those updates are queued for it and give their place among the concurrent updates back
+    right away, so a user who sends many updates at once takes a single place and the updates of
+    other users are not held up.
+
+    Parameters
+    ----------
+    max_concurrent_updates : int, optional
+        The maximum number of updates that are processed at the same time.
+    """
+
+    __slots__ = ("_queues",)
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._queues: dict[int, deque[Awaitable[Any]]] = {}
+
+    @staticmethod
+    def _user_key(update: object) -> int | None:
+        """Return the id of the user, or chat, the update belongs to"""
+        if not isinstance(update, Update):
+            return None
+
+        # Taps on buttons are not part of the sign up, and duplicate taps are coalesced per lesson
+        # by the bot, so they don't wait for the other updates of the user
+        if update.callback_query is not None:
+            return None
+
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+
+        return None
+
+    async def do_process_update(
+        self, update: object, coroutine: Awaitable[Any]
+    ) -> None:
+        key = self._user_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        # An update of a user whose updates are being processed already is left to the update
+        # doing that, which processes the updates of the user in the order they arrived
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+
+        # The queue is forgotten once the updates of the user are done, to not keep one for every
+        # user. An update that fails does not stop the ones queued after it
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue[0]
+                # pylint: disable=broad-exception-caught
+                except Exception:
+                    logger.exception("Error processing an update of user %s", key)
+                queue.popleft()
+        finally:
+            del self._queues[key]
+
+    async def initialize(self) -> None:
+        """Nothing to set up, the queues are created when they are needed"""
+
+    async def shutdown(self) -> None:
+        """Nothing to free, the queues are removed when they are not needed anymore"""
@@ -1,22 +1,40 @@
 """Module for calling the job checking for new lessons"""
 
-import asyncio
 import logging
 import os
-from itertools import product
 
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import Forbidden
-from telegram.ext import Application
 
 from usc_sign_in_bot.db_helpers import UscDataBase
+from usc_sign_in_bot.maintenance import ensure_lesson_partitions
+from usc_sign_in_bot.messages import digest_message, lesson_message
+from usc_sign_in_bot.models import LESSON_ID_SEPARATOR
+from usc_sign_in_bot.preferences import PreferenceIndex
+from usc_sign_in_bot.schedule import update_schedule
 from usc_sign_in_bot.usc_interface import UscInterface
 
 load_dotenv()
 
 SPORT = "Schermen"
 
+# Whether every lesson is asked about in a message of its own, all the new lessons of a user in a
+# single digest, or every lesson once in the group chat of the sport ("lesson", "digest" or "group")
+NOTIFICATION_MODE = os.environ.get("NOTIFICATION_MODE", "lesson")
+
+# The group chat or channel the lessons of each sport are announced in when broadcasting, as
+# comma-separated "<sport>=<chat id>" pairs
+BROADCAST_CHATS = {
+    sport: int(chat_id)
+    for sport, _, chat_id in (
+        pair.partition("=")
+        for pair in os.environ.get("BROADCAST_CHATS", "").split(",")
+        if pair
+    )
+}
+
+# The maximum number of lessons in a digest, Telegram allows up to 100 buttons in a message
+DIGEST_MAX_LESSONS = int(os.environ.get("DIGEST_MAX_LESSONS", 50))
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -27,62 +45,112 @@ logging.getLogger("httpx").setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def main(
-    application: Application, usc: UscInterface, usc_db: UscDataBase
-) -> None:
+def main(usc: UscInterface, usc_db: UscDataBase, mode: str = None) -> None:
     """Main function of the module, calling this will start the job"""
+    mode = mode or NOTIFICATION_MODE
+    if mode not in ("lesson", "digest", "group"):
+        raise ValueError(f"Unknown notification mode {mode}")
+
     lessons = usc.get_all_lessons("Schermen")
-    all_sport_users = usc_db.get_all_users_in_sport(SPORT)
 
-    tasks = []
-    for les, user in product(lessons, all_sport_users):
-        # Skip the sending of the message if the user has allready had a response
-        if usc_db.has_received_update(SPORT, les["time"], user["user_id"]):
-            continue
+    # Edit the messages of the lessons that changed since the last run, before the new lessons are
+    # added, such that lessons that moved are not asked about again
+    edited = update_schedule(usc_db, SPORT, lessons)
+    if edited:
+        logger.info("Edit %s messages of changed lessons", edited)
+
+    # The lessons are the same for every user, so they are announced once for all of them
+    if mode == "group":
+        add_broadcasts(usc_db, lessons)
+        return
+
+    # Find the users that want to be asked about every lesson once, instead of checking the
+    # preferences of every user against every lesson
+    index = PreferenceIndex(usc_db.get_preferences(SPORT))
+    matches = [index.matching_users(les) for les in lessons]
+
+    # Stream the users, such that the memory use stays flat no matter how many users there are. The
+    # messages themselves are put in the outbox, which is sent by the telegram bot
+    for user in usc_db.iter_users_in_sport(SPORT):
+        # Skip the lessons the user does not want to be asked about, and the lessons that were
+        # allready added for the user, the outbox retries the sending
+        new_lessons = [
+            les
+            for les, matching in zip(lessons, matches)
+            if user["user_id"] in matching
+            and not usc_db.has_received_update(SPORT, les["time"], user["user_id"])
+        ]
+
+        if mode == "digest":
+            add_digests(usc_db, user, new_lessons)
+        else:
+            add_lesson_messages(usc_db, user, new_lessons)
+
+
+def add_lesson_messages(usc_db: UscDataBase, user: dict, lessons: list[dict]) -> None:
+    """Add the lessons for the user, each with a message of its own asking about it"""
+    for les in lessons:
+        # Add the lesson together with its message, such that neither exists without the other.
+        # The lesson is marked as sent once the message has actually been sent
+        with usc_db.transaction():
+            key_les = usc_db.add_to_data(
+                SPORT, les["time"], user["user_id"], False, trainer=les["trainer"]
+            )
+            usc_db.add_to_outbox(user["telegram_id"], key_les, lesson_message(les))
 
-        # Create a unique key to give to
-        key_les = usc_db.add_to_data(
-            SPORT, les["time"], user["user_id"], True, trainer=les["trainer"]
-        )
+        logger.info("Ask for lesson %s and %s", les["time"].isoformat(), SPORT)
 
-        # Create the buttons for the user to press
-        markup = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("Yes", callback_data=key_les + ",Y")],
-                [InlineKeyboardButton("No", callback_data=key_les + ",N")],
-            ]
-        )
-        try:
-            tasks.append(
-                asyncio.create_task(
-                    application.bot.send_message(
-                        user["telegram_id"],
-                        f"There is a fencing lesson {les['time'].strftime('%A')} at "
-                        + les["time"].strftime("%H:%M")
-                        + f". The trainer is {les['trainer']}. Would you like to go?",
-                        reply_markup=markup,
-                    )
+
+def add_digests(usc_db: UscDataBase, user: dict, lessons: list[dict]) -> None:
+    """Add the lessons for the user, with a single message asking about all of them"""
+    for start in range(0, len(lessons), DIGEST_MAX_LESSONS):
+        digest = lessons[start : start + DIGEST_MAX_LESSONS]
+
+        # Add the lessons together with their digest, such that none exist without the others
+        with usc_db.transaction():
+            keys = [
+                usc_db.add_to_data(
+                    SPORT, les["time"], user["user_id"], False, trainer=les["trainer"]
                 )
+                for les in digest
+            ]
+            usc_db.add_to_outbox(
+                user["telegram_id"],
+                LESSON_ID_SEPARATOR.join(keys),
+                digest_message(digest),
             )
 
-            logger.info("Ask for lesson %s and %s", les["time"].isoformat(), SPORT)
-            await asyncio.gather(*tasks)
+        logger.info("Ask for %s lessons of %s in a digest", len(digest), SPORT)
+
+
+def add_broadcasts(usc_db: UscDataBase, lessons: list[dict]) -> None:
+    """Announce the lessons in the group chat of the sport, the users answer them there"""
+    if SPORT not in BROADCAST_CHATS:
+        raise ValueError(f"No group chat to broadcast the lessons of {SPORT} to")
 
-        # If the action is not allowed, log it but continue with other users
-        except Forbidden as error:
-            logger.error(
-                "Forbidden for user %s, with error message: %s", user["user_id"], error
+    for les in lessons:
+        if usc_db.has_broadcast(SPORT, les["time"]):
+            continue
+
+        # Add the broadcast together with its message, such that neither exists without the other
+        with usc_db.transaction():
+            key = usc_db.add_broadcast(
+                SPORT, les["time"], BROADCAST_CHATS[SPORT], trainer=les["trainer"]
             )
+            usc_db.add_to_outbox(BROADCAST_CHATS[SPORT], key, lesson_message(les))
+
+        logger.info("Announce lesson %s and %s", les["time"].isoformat(), SPORT)
 
 
 def start_bot_job():
-    """Start the bot and interface neeeded for the fnction, then calll the main"""
-    # Create the application and pass your bot's token
-    application = Application.builder().token(os.environ["BOTTOKEN"]).build()
+    """Start the interface neeeded for the fnction, then calll the main"""
     with UscInterface(
         os.environ["UVA_USERNAME"], os.environ["UVA_PASSWORD"], uva_login=True
     ) as usc:
 
         usc_db = UscDataBase()
 
-        asyncio.run(main(application, usc, usc_db))
+        # Make sure the lessons we are about to add have a partition to go in
+        ensure_lesson_partitions(usc_db)
+
+        main(usc, usc_db)
@@ -1,5 +1,6 @@
 """Module to hold the """
 
+import functools
 import json
 import logging
 import os
@@ -20,8 +21,8 @@ from webdriver_manager.chrome import ChromeDriverManager
 USC_URL = "https://my.uscsport.nl/pages/login"
 TIMEZONE = "Europe/Amsterdam"
 
-with open("shortened_weekdays.json", "r", encoding="UTF-8") as file:
-    weekdays = json.load(file)["NL"]
+# The Dutch abbreviations of the weekdays, as shown in the USC interface
+WEEKDAYS_FILE = "shortened_weekdays.json"
 
 # Enable logging
 logging.basicConfig(
@@ -32,6 +33,13 @@ logging.getLogger("httpx").setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
+def shortened_weekdays() -> dict[str, str]:
+    """Return the abbreviations of the weekdays by their number, only read once they're needed"""
+    with open(WEEKDAYS_FILE, "r", encoding="UTF-8") as file:
+        return json.load(file)["NL"]
+
+
 class UscInterface(webdriver.Chrome):
     """Interface to interact with USC"""
 
@@ -367,7 +375,8 @@ class UscInterface(webdriver.Chrome):
             date_str = "Vandaag"
 
         else:
-            date_str = f"{weekdays[go_to_date.strftime('%w')]} {go_to_date.strftime('%-d-%-m')}"
+            weekday = shortened_weekdays()[go_to_date.strftime("%w")]
+            date_str = f"{weekday} {go_to_date.strftime('%-d-%-m')}"
 
         while True:
             days = self._select_all_elements(